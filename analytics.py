@@ -0,0 +1,197 @@
+"""Statistics computed from a track's numpy arrays (see tracks.Track), in one vectorized pass."""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from geo import consecutive_distances
+
+METERS_PER_KILOMETER = 1000.0
+METERS_PER_MILE = 1609.344
+
+# slower than this (meters per second) counts as stopped when computing moving time, 1 km/h like gpxpy
+STOPPED_SPEED = 1000.0 / 3600
+
+# max speed is measured over this many consecutive steps, so a single gps jump can't set it
+MAX_SPEED_WINDOW = 5
+
+# Elevation cleaning, each can be overridden with the app.config key of the same name.
+# Elevations further than this many meters from the median of the surrounding ELEVATION_SPIKE_WINDOW points are spikes, 0 disables
+ELEVATION_SPIKE_THRESHOLD = 20.0
+ELEVATION_SPIKE_WINDOW = 7
+# points in the moving average applied after spike rejection, 1 disables
+ELEVATION_SMOOTHING_WINDOW = 9
+# climb/descent only counts changes of at least this many meters (a dead band against jitter), 0 disables
+ELEVATION_HYSTERESIS = 3.0
+
+
+def segment_bounds(segments):
+    '''The index of the first and last point of each run of equal segment numbers'''
+    starts = np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+    ends = np.r_[starts[1:] - 1, len(segments) - 1]
+    return starts, ends
+
+def elapsed_seconds(times, segments):
+    '''Sum of last time - first time over the segments, like gpxpy's get_duration'''
+    has_time = np.isfinite(times)
+    times, segments = times[has_time], segments[has_time]
+    if not len(times):
+        return 0.0
+    starts, ends = segment_bounds(segments)
+    durations = times[ends] - times[starts]
+    return float(durations[durations > 0].sum())
+
+def rolling_median(values, window):
+    '''The median of each point and its neighbours, the ends are padded with the first/last value'''
+    half = window // 2
+    padded = np.pad(values, half, mode = 'edge')
+    return np.median(sliding_window_view(padded, 2 * half + 1), axis = 1)
+
+def reject_spikes(elevations, threshold, window = ELEVATION_SPIKE_WINDOW):
+    '''Replace elevations more than threshold meters from the median of their neighbours (barometer/gps glitches) with that median'''
+    if threshold <= 0 or len(elevations) < 3:
+        return elevations
+    median = rolling_median(elevations, window)
+    return np.where(np.abs(elevations - median) > threshold, median, elevations)
+
+def moving_average(values, window):
+    '''Centered moving average over window points (rounded up to an odd number, and down to fit in values)
+
+    The ends are padded by mirroring the values through the first/last point, so the end points and straight climbs are
+    kept as they are, and a short segment's climb isn't averaged away.
+    '''
+    half = min(window // 2, (len(values) - 1) // 2)
+    if half < 1:
+        return values
+    padded = np.pad(values, half, mode = 'reflect', reflect_type = 'odd')
+    return np.convolve(padded, np.ones(2 * half + 1), mode = 'valid') / (2 * half + 1)
+
+def hysteresis_climb(elevations, threshold):
+    '''Total climb and descent, only counting changes of at least threshold meters since the last counted change
+
+    Between turning points the elevation only moves one way, so only the turning points are visited in python.
+    '''
+    differences = np.diff(elevations)
+    if threshold <= 0:
+        return float(differences[differences > 0].sum()), float(-differences[differences < 0].sum())
+
+    moves = np.flatnonzero(differences)
+    if not len(moves):
+        return 0.0, 0.0
+    directions = np.sign(differences[moves])
+    turning_points = moves[np.flatnonzero(directions[1:] != directions[:-1]) + 1]
+    extremes = elevations[np.r_[0, turning_points, len(elevations) - 1]].tolist()
+
+    climb = descent = 0.0
+    anchor = extremes[0]
+    for elevation in extremes[1:]:
+        if elevation - anchor >= threshold:
+            climb += elevation - anchor
+            anchor = elevation
+        elif anchor - elevation >= threshold:
+            descent += anchor - elevation
+            anchor = elevation
+    return climb, descent
+
+def elevation_statistics(elevations, segments, spike_threshold = ELEVATION_SPIKE_THRESHOLD,
+    smoothing_window = ELEVATION_SMOOTHING_WINDOW, hysteresis = ELEVATION_HYSTERESIS):
+    '''Climb, descent, min and max elevation, each segment is cleaned separately and points without an elevation are skipped'''
+    has_elevation = np.isfinite(elevations)
+    elevations = elevations[has_elevation].astype(np.float64)
+    segments = segments[has_elevation]
+    if not len(elevations):
+        return 0.0, 0.0, None, None
+
+    climb = descent = 0.0
+    minimum, maximum = np.inf, -np.inf
+    starts, ends = segment_bounds(segments)
+    for start, end in zip(starts, ends):
+        # extremes ignore spikes but not smoothing, which would flatten real summits
+        despiked = reject_spikes(elevations[start:end + 1], spike_threshold)
+        minimum, maximum = min(minimum, despiked.min()), max(maximum, despiked.max())
+        segment_climb, segment_descent = hysteresis_climb(moving_average(despiked, smoothing_window), hysteresis)
+        climb += segment_climb
+        descent += segment_descent
+    return climb, descent, float(minimum), float(maximum)
+
+def compute_splits(distances, times, split_length):
+    '''Seconds taken to cover each split_length meters, returns [distance, seconds] pairs where the last split may be shorter
+
+    distances and times are cumulative along the track, split boundaries are found by interpolating between points.
+    '''
+    total = float(distances[-1]) if len(distances) else 0.0
+    if total <= 0:
+        return []
+    boundaries = np.arange(split_length, total, split_length)
+
+    # the first point at or past each boundary, and the point before it
+    after = np.searchsorted(distances, boundaries, side = 'left')
+    before = after - 1
+    fraction = (boundaries - distances[before]) / (distances[after] - distances[before])
+    boundary_times = times[before] + fraction * (times[after] - times[before])
+
+    seconds = np.diff(np.r_[0.0, boundary_times, times[-1]])
+    lengths = np.r_[np.full(len(boundaries), float(split_length)), total - split_length * len(boundaries)]
+    if lengths[-1] < 1:
+        # drop a leftover split of less than a meter
+        seconds, lengths = seconds[:-1], lengths[:-1]
+    return [[round(float(length), 1), round(float(second), 1)] for length, second in zip(lengths, seconds)]
+
+def summarize_track(track, stopped_speed = STOPPED_SPEED, max_speed_window = MAX_SPEED_WINDOW, spike_threshold = ELEVATION_SPIKE_THRESHOLD,
+    smoothing_window = ELEVATION_SMOOTHING_WINDOW, hysteresis = ELEVATION_HYSTERESIS):
+    '''Compute an activity's statistics, bounds and coordinates from its track arrays.
+
+    Distances are in meters, times in seconds and speeds in meters per second. Speeds and splits are None/[] for tracks without times.
+    '''
+    latitudes = np.asarray(track.latitude, dtype = np.float64)
+    longitudes = np.asarray(track.longitude, dtype = np.float64)
+    elevations = np.asarray(track.elevation, dtype = np.float64)
+    times = np.asarray(track.time, dtype = np.float64)
+    segments = np.asarray(track.segment)
+    if not len(latitudes):
+        raise ValueError("Invalid .gpx file: no track points found")
+
+    # distance/time between consecutive points, nothing is counted between segments
+    same_segment = segments[1:] == segments[:-1]
+    steps = np.where(same_segment, consecutive_distances(latitudes, longitudes), 0.0)
+    step_times = np.diff(times)
+    step_times = np.where(same_segment & np.isfinite(step_times) & (step_times > 0), step_times, 0.0)
+
+    distance = float(steps.sum())
+    cumulative_distance = np.r_[0.0, np.cumsum(steps)]
+    cumulative_time = np.r_[0.0, np.cumsum(step_times)]
+
+    timed = step_times > 0
+    moving = timed & (steps >= stopped_speed * step_times)
+    moving_seconds = float(step_times[moving].sum())
+
+    has_times = bool(timed.any())
+    average_speed = distance / moving_seconds if moving_seconds else None
+    max_speed = None
+    if has_times:
+        window = max(1, min(max_speed_window, len(latitudes) - 1))
+        window_distance = cumulative_distance[window:] - cumulative_distance[:-window]
+        window_time = cumulative_time[window:] - cumulative_time[:-window]
+        valid = (segments[window:] == segments[:-window]) & (window_time > 0)
+        if valid.any():
+            max_speed = float((window_distance[valid] / window_time[valid]).max())
+
+    climb, descent, min_elevation, max_elevation = elevation_statistics(elevations, segments, spike_threshold, smoothing_window, hysteresis)
+
+    return {
+    "duration_seconds": int(elapsed_seconds(times, segments)),
+    "moving_seconds": int(moving_seconds),
+    "distance": distance,
+    "average_speed": average_speed,
+    "max_speed": max_speed,
+    "splits_km": compute_splits(cumulative_distance, cumulative_time, METERS_PER_KILOMETER) if has_times else [],
+    "splits_mile": compute_splits(cumulative_distance, cumulative_time, METERS_PER_MILE) if has_times else [],
+    "climb": climb,
+    "descent": descent,
+    "min_elevation": min_elevation,
+    "max_elevation": max_elevation,
+    "latitude_min": float(latitudes.min()),
+    "latitude_max": float(latitudes.max()),
+    "longitude_min": float(longitudes.min()),
+    "longitude_max": float(longitudes.max()),
+    "coordinates": np.column_stack((longitudes, latitudes)).tolist()
+    }
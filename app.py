@@ -1,12 +1,12 @@
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, send_from_directory
-from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db
-from models import User, Activity, Challenge, Landmark, Gear, UserFriends, Admin, UserGear, ActivityComment
+import gzip
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, send_file, Response, abort
+from models import db, connect_db, NEARBY_MAX_RADIUS
+from models import User, Activity, Challenge, Landmark, Gear, UserFriends, Admin, UserGear, ActivityComment, TrackBlob
 from forms import LoginForm, NewActivityForm, NewGearForm, NewLandmarkForm, NewChallengeForm, EditUserForm, NewUserForm, NewUserGearForm, NewCommentForm
 from werkzeug.utils import secure_filename
 import secret
-import requests as python_requests
 from datetime import datetime
 
 CURR_USER_KEY = "curr_user"
@@ -27,19 +27,43 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secret.FLASK_SECRET_KEY)
 app.config['SOKA_PRESIGNED_URL_ACCESS_KEY'] = os.environ.get('SOKA_PRESIGNED_URL_ACCESS_KEY', secret.SOKA_PRESIGNED_URL_ACCESS_KEY)
 app.config['SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY'] = os.environ.get('SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY', secret.SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY)
 app.config['SOKA_USER_IMAGE_BUCKET'] = os.environ.get("SOKA_USER_IMAGE_BUCKET", secret.SOKA_USER_IMAGE_BUCKET)
+# another S3 implementation to use instead of AWS (minio, moto's server), and the shared client's connection pool (see s3.py)
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['S3_MAX_POOL_CONNECTIONS'] = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 10))
+app.config['S3_CONNECT_TIMEOUT'] = float(os.environ.get('S3_CONNECT_TIMEOUT', 5))
+app.config['S3_READ_TIMEOUT'] = float(os.environ.get('S3_READ_TIMEOUT', 30))
 app.config['OPENWEATHERMAP_API_KEY'] = os.environ.get("OPENWEATHERMAP_API_KEY", secret.OPENWEATHERMAP_API_KEY)
 app.config['UPLOAD_FOLDER'] = GPX_FOLDER
 NUM_MEGABYTE_LIMIT = 10
 app.config['MAX_CONTENT_LENGTH'] = NUM_MEGABYTE_LIMIT * 1000 * 1000
+# where gpx files, track sidecars and thumbnails are kept, 'local' or 's3' (see storage.py)
+app.config['TRACK_STORAGE'] = os.environ.get('TRACK_STORAGE', 'local')
+app.config['TRACK_STORAGE_BUCKET'] = os.environ.get('TRACK_STORAGE_BUCKET', app.config['SOKA_USER_IMAGE_BUCKET'])
+app.config['TRACK_STORAGE_PREFIX'] = os.environ.get('TRACK_STORAGE_PREFIX', 'tracks/')
+app.config['TRACK_CACHE_DIRECTORY'] = os.environ.get('TRACK_CACHE_DIRECTORY', '/tmp/soka-track-cache')
+app.config['TRACK_CACHE_MAX_BYTES'] = int(os.environ.get('TRACK_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# a job running for longer than this is assumed to be left behind by a worker that stopped, and is run again
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 60 * 60))
+# a job that raised is retried after this many seconds, doubling after every attempt
+app.config['JOB_RETRY_DELAY'] = int(os.environ.get('JOB_RETRY_DELAY', 30))
+# run background jobs during the request that enqueues them, instead of in a `flask run-jobs` worker
+app.config['JOBS_RUN_INLINE'] = os.environ.get('JOBS_RUN_INLINE', 'false').lower() == 'true'
 
 
 
 
-toolbar = DebugToolbarExtension(app)
+# the toolbar is only useful (and only installed) when developing
+if app.debug:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
 import bp_activities , bp_challenges, bp_gear, bp_gearshed, bp_users, bp_landmarks
+import jobs
+import revalidation
+import migrations
+from storage import get_storage, get_folder_key, normalize_key
 
 app.register_blueprint(bp_activities.bp)
 app.register_blueprint(bp_challenges.bp)
@@ -48,6 +72,79 @@ app.register_blueprint(bp_gearshed.bp)
 app.register_blueprint(bp_users.bp)
 app.register_blueprint(bp_landmarks.bp)
 
+@app.cli.command('run-jobs')
+@click.option('--poll-interval', default = 2.0, help = 'Seconds to wait between checks of an empty queue.')
+@click.option('--once', is_flag = True, help = 'Exit once the queue is empty.')
+def run_jobs(poll_interval, once):
+    '''Run background jobs (activity processing) as they are enqueued'''
+    jobs.work(poll_interval = poll_interval, once = once)
+
+@app.cli.command('revalidate-challenge')
+@click.argument('challenge_id', type = int)
+@click.option('--processes', default = None, type = int, help = 'Number of worker processes, defaults to the number of cores.')
+def revalidate_challenge(challenge_id, processes):
+    '''Recompute whether every attempt at a challenge visited all of its landmarks'''
+    updated = revalidation.revalidate_challenge(challenge_id, processes = processes)
+    click.echo(f"Revalidated {updated} activities for challenge {challenge_id}")
+
+@app.cli.command('collect-gpx-files')
+def collect_gpx_files():
+    '''Delete the stored gpx files (and their sidecars and thumbnails) that no activity references anymore'''
+    click.echo(f"Deleted {TrackBlob.collect_garbage()} unreferenced gpx files")
+
+@app.cli.command('migrate-tables')
+def migrate_tables():
+    '''Create the tables added since the database was created, run this before the other migrations'''
+    created = migrations.migrate_tables()
+    if created:
+        click.echo(f"Created the tables {', '.join(created)}")
+    else:
+        click.echo("Every table already exists")
+
+@app.cli.command('migrate-landmark-coordinates')
+def migrate_landmark_coordinates():
+    '''Convert landmark coordinates stored as "38.7436 N" strings into indexed signed degrees, and fill their grid cells'''
+    if migrations.migrate_landmark_coordinates():
+        click.echo("Converted landmark coordinates to signed degrees")
+    else:
+        click.echo("Landmark coordinates are already numeric")
+    click.echo(f"Filled the grid cell of {migrations.migrate_landmark_grid_cells()} landmarks")
+
+@app.cli.command('migrate-activity-status')
+def migrate_activity_status():
+    '''Add the processing status of activities, which are analyzed by a background job after upload'''
+    if migrations.migrate_activity_status():
+        click.echo("Added the status of activities")
+    else:
+        click.echo("Activities already have a status")
+
+@app.cli.command('migrate-jobs')
+def migrate_jobs():
+    '''Add the time a failed job is retried after'''
+    if migrations.migrate_job_run_after():
+        click.echo("Added the retry time of jobs")
+    else:
+        click.echo("Jobs already have a retry time")
+
+@app.cli.command('migrate-activity-images')
+def migrate_activity_images():
+    '''Add the upload status, error and format variants of activity images'''
+    if migrations.migrate_activity_image_status():
+        click.echo("Added the status and error of activity images")
+    else:
+        click.echo("Activity images already have a status")
+    if migrations.migrate_activity_image_variants():
+        click.echo("Added the variants of activity images")
+    else:
+        click.echo("Activity images already have variants")
+
+@app.cli.command('migrate-gpx-files')
+@click.option('--delete-originals', is_flag = True, help = 'Remove the per activity files once they are moved.')
+def migrate_gpx_files(delete_originals):
+    '''Move gpx files into content addressed storage, so identical tracks share one file, and delete unreferenced ones'''
+    moved, deleted = migrations.migrate_gpx_files(delete_originals = delete_originals)
+    click.echo(f"Moved {moved} gpx files into content addressed storage, deleted {deleted} unreferenced files")
+
 ##############################################################################
 # User signup/login/logout
 
@@ -74,10 +171,39 @@ def add_user_to_g():
     else:
         g.user = None
 
-@app.route('/uploads/<name>')
+# stored gpx files are gzipped (see tracks.COMPRESSED_SUFFIX), and downloaded by their name without the suffix
+GPX_MIMETYPE = 'application/gpx+xml'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def stream_decompressed(filename):
+    with gzip.open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            yield chunk
+
+@app.route('/uploads/<path:name>')
 def download_file(name):
-    # taken from FLASK documentation
-    return send_from_directory(app.config["UPLOAD_FOLDER"], name)
+    '''Serve an uploaded file, a gpx file stored gzipped is sent compressed with Content-Encoding to clients that accept
+    gzip, and decompressed as it is streamed to the rest'''
+    storage = get_storage()
+    folder = get_folder_key(app.config["UPLOAD_FOLDER"])
+    try:
+        key = normalize_key(f"{folder}/{name}")
+    except ValueError:
+        abort(404)
+    if not key.startswith(folder + '/'):
+        abort(404)
+    if name.endswith('.gpx') and storage.exists(key + '.gz'):
+        compressed = storage.get_local_path(key + '.gz')
+        if 'gzip' in request.accept_encodings:
+            response = send_file(compressed, mimetype = GPX_MIMETYPE, conditional = True)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(stream_decompressed(compressed), mimetype = GPX_MIMETYPE)
+        response.vary.add('Accept-Encoding')
+        return response
+    if not storage.exists(key):
+        abort(404)
+    return send_file(storage.get_local_path(key), conditional = True)
 
 
 @app.route('/')
@@ -173,6 +299,7 @@ def handle_friendship(follower_id, following_id):
 
 def get_weather_data(landmark, units="imperial"):
     '''Perform the API call to open weather maps and return the JSON data'''
+    import requests as python_requests
     QUERY_STRING = f"?lat={landmark.get_latitude()}&lon={landmark.get_longitude()}&exclude=minutely,daily&appid={app.config['OPENWEATHERMAP_API_KEY']}&units={units}"
     response = python_requests.get(WEATHER_API_BASE_URL + QUERY_STRING)
     return response.status_code, response.json()
@@ -206,6 +333,37 @@ def get_weather(landmark_id):
     "current_weather":current,
     "hourly_weather":hourly}, 200)
 
+@app.route('/API/activities/<int:activity_id>/status')
+def get_activity_status(activity_id):
+    '''Report whether an activity is still being processed, polled by the activity page'''
+    activity = Activity.query.get_or_404(activity_id)
+
+    # the same users that can view the activity, without flashing messages at a page that polls
+    if not g.user:
+        return (jsonify({}), 401)
+    if (activity.user is not g.user) and (activity.user not in g.user.following) and not g.user.is_admin():
+        return (jsonify({}), 403)
+
+    return jsonify({
+    "id": activity.id,
+    "status": activity.status,
+    "was_successful": activity.was_successful})
+
+@app.route('/API/landmarks/nearby')
+def get_nearby_landmarks():
+    '''Landmarks visible to the current user within radius meters (default 10 km) of lat/lon, nearest first'''
+    latitude = request.args.get('lat', type = float)
+    longitude = request.args.get('lon', type = float)
+    radius = request.args.get('radius', 10000, type = float)
+    limit = request.args.get('limit', 50, type = int)
+    if latitude is None or longitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({"error": "lat and lon are required, in signed degrees"}), 400
+    if not 0 < radius <= NEARBY_MAX_RADIUS or not 0 < limit <= 500:
+        return jsonify({"error": f"radius must be between 0 and {NEARBY_MAX_RADIUS} meters, and limit between 1 and 500"}), 400
+
+    nearby = Landmark.find_nearby(latitude, longitude, radius, query = Landmark.get_visible_landmarks(g.user), limit = limit)
+    return jsonify({"landmarks": [dict(landmark.to_json(), distance = round(distance, 1)) for landmark, distance in nearby]})
+
 @app.route('/API/gearshed/<int:user_id>')
 def get_user_gear_api(user_id):
     user = User.query.get_or_404(user_id)
@@ -0,0 +1,69 @@
+"""Measure how long it takes to import the app, and which modules that time goes to.
+
+run like:
+
+    python benchmark_startup.py [--module app] [--runs 5] [--top 20]
+
+Each run imports the module in a fresh interpreter with `python -X importtime`, which is what a
+gunicorn worker boot or a test process pays before handling anything.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# dependencies that should only be imported when a request needs them
+HEAVY_MODULES = ['numpy', 'PIL', 'boto3', 'botocore', 'requests', 'gpxpy', 'pandas', 'flask_debugtoolbar']
+
+
+def import_times(module):
+    '''Import a module in a fresh interpreter, returns the wall time and {module name: (self us, cumulative us)}'''
+    env = dict(os.environ, FLASK_ENV = os.environ.get('FLASK_ENV', 'production'))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+    stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True, env = env)
+    wall_time = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return wall_time, times
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--module', default = 'app', help = 'module to import (default: app)')
+    parser.add_argument('--runs', type = int, default = 5, help = 'number of fresh interpreters to average over')
+    parser.add_argument('--top', type = int, default = 20, help = 'number of modules to report')
+    args = parser.parse_args()
+
+    wall_times = []
+    cumulative = {}
+    for run in range(args.runs):
+        wall_time, times = import_times(args.module)
+        wall_times.append(wall_time)
+        for name, (self_us, cumulative_us) in times.items():
+            cumulative.setdefault(name, []).append(cumulative_us)
+
+    wall_times.sort()
+    print(f"import {args.module}: median {wall_times[len(wall_times) // 2] * 1000:.0f} ms, "
+    f"best {wall_times[0] * 1000:.0f} ms over {args.runs} runs (including interpreter start up)")
+
+    print(f"\n{'cumulative ms':>14}  module")
+    medians = {name: sorted(values)[len(values) // 2] for name, values in cumulative.items()}
+    for name, cumulative_us in sorted(medians.items(), key = lambda item: -item[1])[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f}  {name}")
+
+    loaded = [name for name in HEAVY_MODULES if name in medians]
+    deferred = [name for name in HEAVY_MODULES if name not in medians]
+    print(f"\nheavy modules imported at start up: {', '.join(loaded) or 'none'}")
+    print(f"heavy modules deferred until first use: {', '.join(deferred) or 'none'}")
+
+if __name__ == '__main__':
+    main()
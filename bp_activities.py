@@ -1,14 +1,19 @@
 ##############################################################################
 # Activity pages (some require login)
 
-from flask import Blueprint, render_template, request, flash, redirect, g
+from flask import Blueprint, render_template, request, flash, redirect, g, current_app, abort, send_file
+import os
 from app import db
-from models import Activity, Gear
+from models import Activity, Gear, TrackBlob
 from forms import NewActivityForm, NewCommentForm
+from storage import get_storage
 
 from  helpers import validate_signed_in
 bp = Blueprint('activities', __name__, url_prefix='/activities')
 
+# thumbnail filenames include a hash of their content, so browsers never need to check for a new version
+STATIC_MAP_CACHE_SECONDS = 365 * 24 * 60 * 60
+
 def adjust_map_options_boundaries(map_options, BUFFER_SIZE = 0.01):
     '''Allows us to add a buffer to the map, so that the activity doesn't touch the map borders'''
     map_options["longitude_min"] -= BUFFER_SIZE
@@ -35,14 +40,15 @@ def create_activity():
             challenge_id = form.challenge.data
             style = form.style.data 
             if form.gps_file.data:
-                gps_data = request.files['gps_file'].read()
+                # pass the upload stream along, so the file is never read into memory all at once
+                gps_data = request.files['gps_file']
             else:
                 gps_data = None
             pics = request.files.getlist(form.images.name)
             notes = form.notes.data 
             gear = form.gear.data
 
-            activity = Activity.add_activity(g.user.id, name, challenge_id, style, gps_data, notes, gear, pics, directory = app.config['UPLOAD_FOLDER'])
+            activity = Activity.add_activity(g.user.id, name, challenge_id, style, gps_data, notes, gear, pics, directory = current_app.config['UPLOAD_FOLDER'])
             return redirect(f'/activities/{activity.id}')
         
         except Exception as e:
@@ -70,6 +76,25 @@ def show_activity(activity_id):
     return render_template('/activities/activity.html', activity=activity, num_photos_displayed=4, comment_form = comment_form)
 
 
+@bp.route('/<int:activity_id>/static_map/<name>', methods=['GET'])
+def show_static_map(activity_id, name):
+    '''Serve the png thumbnail of an activity's track, to the same users that can see the activity'''
+    activity = Activity.query.get_or_404(activity_id)
+    if g.user is None:
+        abort(401)
+    if (activity.user is not g.user) and (activity.user not in g.user.following) and not g.user.is_admin():
+        abort(403)
+
+    summary = activity.summary
+    storage = get_storage()
+    if not summary or not summary.static_map or os.path.basename(summary.static_map) != name or not storage.exists(summary.static_map):
+        abort(404)
+
+    response = send_file(storage.get_local_path(summary.static_map), mimetype = 'image/png', conditional = True, cache_timeout = STATIC_MAP_CACHE_SECONDS)
+    response.headers['Cache-Control'] = f"private, max-age={STATIC_MAP_CACHE_SECONDS}, immutable"
+    return response
+
+
 @bp.route('/<int:activity_id>/delete', methods=['POST'])
 def delete_user_activities(activity_id):
     '''Delete an activity from the database'''
@@ -83,7 +108,10 @@ def delete_user_activities(activity_id):
         return redirect(f'/users/{g.user.id}')
 
 
+    gps_file = activity.gps_file
     db.session.delete(activity)
     db.session.commit()
+    if gps_file:
+        TrackBlob.release(gps_file)
     flash("Activity deleted successfully", "success")
     return redirect(f"/users/{g.user.id}")
\ No newline at end of file
@@ -1,7 +1,7 @@
 import os
-from flask import Blueprint, render_template,  flash, redirect, g, current_app
+from flask import Blueprint, render_template,  flash, redirect, g, current_app, request
 from app import db
-from models import Challenge, Landmark, Gear
+from models import Challenge, Gear, Job
 from forms import NewChallengeForm, NewUserForm
 from helpers import validate_correct_user, validate_signed_in, get_landmark_map_options
 
@@ -88,18 +88,23 @@ def edit_challenge(challenge_id):
         return redirect(f'/challenges/{challenge_id}')
 
     form = NewChallengeForm()
-    if form.validate_on_submit():
-        form.populate_obj(challenge)
-        db.session.commit()
-        return redirect(f'/challenges/{challenge_id}', form = form)
-
-    form.name.data = challenge.name
-    form.description.data = challenge.description
     gear = Gear.query.all()
     form.gear.choices = [(item.id, f"{item.name}") for item in gear]
-
-    landmarks = Landmark.query.all()
     form.landmarks.choices = g.user.get_available_landmarks()
+
+    if form.validate_on_submit():
+        landmarks_changed = Challenge.update_challenge(challenge, form.name.data, form.description.data, form.gear.data, form.landmarks.data)
+        if landmarks_changed:
+            # every attempt at the challenge is rechecked by a background job
+            Job.enqueue('revalidate_challenge', challenge_id = challenge.id)
+            flash("Challenge updated, attempts will be revalidated shortly", 'success')
+        return redirect(f'/challenges/{challenge_id}')
+
+    if request.method == 'GET':
+        form.name.data = challenge.name
+        form.description.data = challenge.description
+        form.gear.data = [item.id for item in challenge.gear]
+        form.landmarks.data = [landmark.id for landmark in challenge.landmarks]
     return render_template('challenges/edit_challenge.html', form = form)
 
 @bp.route('/<int:challenge_id>/delete', methods=['POST'])
@@ -15,12 +15,7 @@ bp = Blueprint('landmarks', __name__, url_prefix='/landmarks')
 @bp.route('', methods=['GET'])
 def show_landmarks():
     '''Show a list of landmarks to the user'''
-    if not g.user:
-        landmarks = Landmark.get_official_landmarks()
-    elif g.user.is_admin():
-        landmarks = Landmark.query.all()
-    else:
-        landmarks = g.user.get_available_landmarks(return_objects=True)
+    landmarks = Landmark.get_visible_landmarks(g.user).all()
     form = NewUserForm()
     return render_template('/landmarks/landmarks.html', 
     landmarks=landmarks, 
@@ -78,12 +73,17 @@ def edit_landmarks(landmark_id):
     landmark = Landmark.query.get_or_404(landmark_id)
     form = NewLandmarkForm()
     if form.validate_on_submit():
-        form.populate_obj(landmark)
-        db.session.commit()
-        return redirect(f'/landmarks/{landmark_id}')
+        try:
+            # coordinates are submitted as e.g. "38.7436 N" and converted to signed degrees by the model
+            form.populate_obj(landmark)
+            db.session.commit()
+            return redirect(f'/landmarks/{landmark_id}')
+        except ValueError as e:
+            db.session.rollback()
+            flash(f"{e}", 'error')
     else:
-        form.latitude.data = landmark.latitude
-        form.longitude.data = landmark.longitude 
+        form.latitude.data = landmark.latitude_display
+        form.longitude.data = landmark.longitude_display
         form.img_url.data = landmark.img_url
         form.name.data = landmark.name
     return render_template('landmarks/edit_landmark.html', form = form)
@@ -1,5 +1,5 @@
 from flask import Blueprint, render_template,  redirect, session, g
-from models import User
+from models import User, Activity, TrackBlob
 from forms import  EditUserForm
 from helpers import validate_correct_user, validate_signed_in
 from app import db 
@@ -38,8 +38,13 @@ def delete_user(user_id):
     
     if not validate_correct_user("You can only delete your own account.",user_id):
         return redirect(f'/users/{g.user.id}')
+    # the activities are deleted along with the user, their gpx files are removed once no other activity uses them
+    gps_files = [gps_file for gps_file, in db.session.query(Activity.gps_file).filter(Activity.user_id == user_id,
+    Activity.gps_file.isnot(None)).distinct()]
     User.query.filter_by(id=user_id).delete()
     db.session.commit()
+    for gps_file in gps_files:
+        TrackBlob.release(gps_file)
     # remove user from the session
     session.clear()
     return redirect('/register')
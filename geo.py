@@ -0,0 +1,127 @@
+"""Geographic helpers for gps coordinates."""
+
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371008.8
+
+# number of track points compared against the landmarks at a time, bounds memory use on long tracks
+CHUNK_SIZE = 65536
+
+
+def haversine_term(latitudes, longitudes, target_latitudes, target_longitudes):
+    '''Compute the haversine term sin^2(dlat/2) + cos(lat1)cos(lat2)sin^2(dlon/2) from every point (rows) to every target (columns)'''
+    lat1 = np.radians(np.asarray(latitudes, dtype = np.float64))[:, None]
+    lon1 = np.radians(np.asarray(longitudes, dtype = np.float64))[:, None]
+    lat2 = np.radians(np.asarray(target_latitudes, dtype = np.float64))[None, :]
+    lon2 = np.radians(np.asarray(target_longitudes, dtype = np.float64))[None, :]
+
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    return sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+
+def haversine_distances(latitudes, longitudes, target_latitudes, target_longitudes):
+    '''Compute the distance in meters from every point (rows) to every target (columns).
+
+    Unlike the spherical law of cosines, the haversine formula stays accurate at distances of a few meters.
+    '''
+    a = haversine_term(latitudes, longitudes, target_latitudes, target_longitudes)
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def consecutive_distances(latitudes, longitudes):
+    '''Compute the distance in meters between each point and the next one (one fewer distance than points)'''
+    latitudes = np.radians(np.asarray(latitudes, dtype = np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype = np.float64))
+    sin_dlat = np.sin(np.diff(latitudes) / 2)
+    sin_dlon = np.sin(np.diff(longitudes) / 2)
+    a = sin_dlat * sin_dlat + np.cos(latitudes[:-1]) * np.cos(latitudes[1:]) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def haversine_threshold(radius):
+    '''The haversine term that corresponds to a distance of radius meters'''
+    return np.sin(radius / (2 * EARTH_RADIUS_METERS)) ** 2
+
+def targets_within_radius(latitudes, longitudes, target_latitudes, target_longitudes, radius):
+    '''For every target, determine if any of the points is within radius meters of it'''
+    latitudes = np.asarray(latitudes, dtype = np.float64)
+    longitudes = np.asarray(longitudes, dtype = np.float64)
+    hits = np.zeros(len(target_latitudes), dtype = bool)
+    if not len(hits):
+        return hits
+
+    # comparing the haversine term directly avoids an arcsin per point
+    threshold = haversine_threshold(radius)
+    for start in range(0, len(latitudes), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        a = haversine_term(latitudes[start:stop], longitudes[start:stop], target_latitudes, target_longitudes)
+        hits |= (a < threshold).any(axis = 0)
+        if hits.all():
+            break
+    return hits
+
+
+METERS_PER_DEGREE = np.pi * EARTH_RADIUS_METERS / 180
+
+# offsets that keep grid rows/columns positive when combined into a single integer key
+GRID_OFFSET = 2 ** 30
+GRID_STRIDE = 2 ** 31
+
+
+class GridIndex():
+    '''A uniform latitude/longitude grid over a set of points, used to find the points near a location without scanning all of them.
+
+    Points are sorted by grid cell, so the points in a cell are a contiguous slice of self.order.
+    Cells are at least cell_size meters wide, so a query of radius <= cell_size only touches a few cells.
+    '''
+    def __init__(self, latitudes, longitudes, cell_size = 50):
+        self.latitudes = np.asarray(latitudes, dtype = np.float64)
+        self.longitudes = np.asarray(longitudes, dtype = np.float64)
+
+        self.cell_latitude = cell_size / METERS_PER_DEGREE
+        # longitude cells shrink towards the poles, so size them for the point closest to a pole
+        max_latitude = min(float(np.abs(self.latitudes).max()) if len(self.latitudes) else 0, 89.0)
+        self.cell_longitude = self.cell_latitude / np.cos(np.radians(max_latitude))
+
+        keys = self.cell_keys(self.latitudes, self.longitudes)
+        self.order = np.argsort(keys, kind = 'stable')
+        self.keys, self.starts, self.counts = np.unique(keys[self.order], return_index = True, return_counts = True)
+
+    def cell_rows(self, latitudes):
+        '''The grid row of each latitude'''
+        return np.floor(np.asarray(latitudes) / self.cell_latitude).astype(np.int64)
+
+    def cell_columns(self, longitudes):
+        '''The grid column of each longitude'''
+        return np.floor(np.asarray(longitudes) / self.cell_longitude).astype(np.int64)
+
+    def cell_keys(self, latitudes, longitudes):
+        '''Combine the grid row and column of each point into a single integer'''
+        return (self.cell_rows(latitudes) + GRID_OFFSET) * GRID_STRIDE + (self.cell_columns(longitudes) + GRID_OFFSET)
+
+    def candidates(self, latitude, longitude, radius):
+        '''Indices of the points in every grid cell that overlaps the bounding box of a circle'''
+        delta_latitude = radius / METERS_PER_DEGREE
+        delta_longitude = delta_latitude / max(np.cos(np.radians(min(abs(latitude) + delta_latitude, 89.0))), 1e-6)
+        rows = np.arange(self.cell_rows(latitude - delta_latitude), self.cell_rows(latitude + delta_latitude) + 1)
+        columns = np.arange(self.cell_columns(longitude - delta_longitude), self.cell_columns(longitude + delta_longitude) + 1)
+
+        keys = ((rows[:, None] + GRID_OFFSET) * GRID_STRIDE + (columns[None, :] + GRID_OFFSET)).ravel()
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        positions = positions[found]
+        if not len(positions):
+            return np.empty(0, dtype = np.int64)
+        return np.concatenate([self.order[self.starts[p]:self.starts[p] + self.counts[p]] for p in positions])
+
+    def query_radius(self, latitude, longitude, radius):
+        '''Indices of the points within radius meters of a location'''
+        candidates = self.candidates(latitude, longitude, radius)
+        if not len(candidates):
+            return candidates
+        a = haversine_term(self.latitudes[candidates], self.longitudes[candidates], [latitude], [longitude])[:, 0]
+        return candidates[a < haversine_threshold(radius)]
+
+    def targets_within_radius(self, target_latitudes, target_longitudes, radius):
+        '''For every target, determine if any of the points is within radius meters of it'''
+        return np.array([len(self.query_radius(latitude, longitude, radius)) > 0
+        for latitude, longitude in zip(target_latitudes, target_longitudes)], dtype = bool)
@@ -0,0 +1,79 @@
+"""Resizing uploaded activity images: each upload is decoded once, and every size is scaled down from the size above it.
+
+Besides the upload's own format, every size is encoded in the modern formats this Pillow can write (see MODERN_FORMATS),
+which browsers that support them are offered through <picture> sources.
+"""
+
+import io
+import math
+
+from PIL import Image, ImageOps
+
+# the sizes each uploaded image is stored at, largest first
+IMAGE_SIZES = [(500, 500), (320, 320), (128, 128)]
+
+# format: (file extension, content type, save options), in the order browsers are offered them
+MODERN_FORMATS = {
+'AVIF': ('avif', 'image/avif', {"quality": 50}),
+'WEBP': ('webp', 'image/webp', {"quality": 70, "method": 6}),
+}
+
+# JPEGs are decoded at the smallest power of two scale that leaves at least this multiple of the largest size,
+# like Pillow's thumbnail(reducing_gap = 2.0), so the final resize still has enough pixels to antialias from
+DRAFT_REDUCING_GAP = 2
+
+
+def open_image(stream, largest_size):
+    '''Decode an image once, at reduced scale for JPEGs, and rotate it upright according to its EXIF orientation
+
+    Returns the image and the format it was uploaded in.
+    '''
+    image = Image.open(stream)
+    image_format = image.format
+    if image_format == 'JPEG':
+        # the orientation isn't applied yet, so the scale is picked from the longest side, whichever way up it ends
+        scale = max(largest_size) * DRAFT_REDUCING_GAP / max(image.size)
+        if scale < 1:
+            image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    image = ImageOps.exif_transpose(image)
+    image.load()
+    return image, image_format
+
+def resize_pyramid(image, sizes = IMAGE_SIZES):
+    '''Fit the image into each of sizes (largest first), scaling each level down from the previous one'''
+    levels = []
+    for size in sizes:
+        image = image.copy()
+        image.thumbnail(size, Image.LANCZOS)
+        levels.append(image)
+    return levels
+
+def get_modern_formats():
+    '''The MODERN_FORMATS this Pillow was built to write, AVIF needs Pillow 11.2 or the pillow-avif-plugin'''
+    Image.init()
+    return [image_format for image_format in MODERN_FORMATS if image_format in Image.SAVE]
+
+def get_variant_key(key, extension):
+    '''The name an image is stored under in another format, next to the upload's format ("500_1_a.jpg" -> "500_1_a.jpg.webp")'''
+    return f"{key}.{extension}"
+
+def encode_image(image, image_format, **options):
+    '''The image saved in image_format, as bytes'''
+    output = io.BytesIO()
+    image.save(output, format = image_format, **options)
+    return output.getvalue()
+
+def create_responsive_images(stream, sizes = IMAGE_SIZES, formats = None):
+    '''Resize an uploaded image to each of sizes, in the upload's format and each of formats (the modern formats by default)
+
+    Returns the widths of the resized images, largest first, and {format: encoded images} where None is the upload's format.
+    '''
+    if formats is None:
+        formats = get_modern_formats()
+    image, image_format = open_image(stream, sizes[0])
+    levels = resize_pyramid(image, sizes)
+    encoded = {None: [encode_image(level, image_format) for level in levels]}
+    for modern_format in formats:
+        extension, content_type, options = MODERN_FORMATS[modern_format]
+        encoded[modern_format] = [encode_image(level, modern_format, **options) for level in levels]
+    return [level.width for level in levels], encoded
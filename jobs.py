@@ -0,0 +1,51 @@
+"""Background jobs, and the worker that runs them.
+
+Jobs are rows in the jobs table (see models.Job). Start a worker with:
+
+    flask run-jobs
+
+or set JOBS_RUN_INLINE=true to run each job as soon as it is enqueued (e.g. for testing).
+"""
+
+import time
+from models import db, Job, Activity
+import revalidation
+
+
+@Job.handler('process_activity')
+def process_activity(activity_id, images = ()):
+    '''Analyze/validate an uploaded activity and resize its images'''
+    Activity.process_activity(activity_id, images)
+
+@Job.failure_handler('process_activity')
+def process_activity_failed(activity_id, images = ()):
+    '''Stop showing an activity as processing once its job is given up on'''
+    Activity.query.filter(Activity.id == activity_id).update({Activity.status: 'failed'}, synchronize_session = False)
+
+@Job.handler('revalidate_challenge')
+def revalidate_challenge(challenge_id):
+    '''Recompute was_successful for every attempt at a challenge'''
+    revalidation.revalidate_challenge(challenge_id)
+
+
+def run_pending_jobs(limit = None):
+    '''Run queued jobs until the queue is empty, or limit jobs have been run. Returns the number of jobs run.'''
+    count = 0
+    while limit is None or count < limit:
+        job = Job.claim_next()
+        if job is None:
+            break
+        job.run()
+        count += 1
+    return count
+
+def work(poll_interval = 2.0, once = False):
+    '''Run jobs as they are enqueued, sleeping for poll_interval seconds whenever the queue is empty'''
+    while True:
+        count = run_pending_jobs()
+        if once:
+            return count
+        if not count:
+            # release the connection while idle, so an idle worker doesn't hold a transaction open
+            db.session.remove()
+            time.sleep(poll_interval)
@@ -0,0 +1,159 @@
+"""One-off schema and data changes for databases created before a model changed (new databases get them from db.create_all()).
+
+Run them with the flask command named in each function's docstring.
+"""
+
+import os
+from sqlalchemy import inspect, text, Float
+from models import db
+
+# "38.7436 N" -> 38.7436, "109.4993 W" -> -109.4993
+NESW_TO_DEGREES = """CASE WHEN upper(right(trim({column}), 1)) IN ('S', 'W') THEN -1 ELSE 1 END
+    * CAST(regexp_replace({column}, '[^0-9.]', '', 'g') AS DOUBLE PRECISION)"""
+
+
+def migrate_tables():
+    '''flask migrate-tables: create the tables added since the database was created (activity summaries, jobs, track blobs,
+    completed challenges). Tables that exist are left alone, the other migrations add their new columns.
+
+    Returns the names of the tables created.
+    '''
+    existing = set(inspect(db.engine).get_table_names())
+    db.metadata.create_all(db.engine, checkfirst = True)
+    return sorted(set(db.metadata.tables) - existing)
+
+def migrate_landmark_coordinates():
+    '''flask migrate-landmark-coordinates: convert landmarks.latitude/longitude from NESW strings to signed degrees and index them.
+
+    Returns False if the columns were already numeric.
+    '''
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError("migrate_landmark_coordinates only supports postgresql")
+
+    columns = {column['name']: column['type'] for column in inspect(db.engine).get_columns('landmarks')}
+    converted = not isinstance(columns['latitude'], Float)
+    if converted:
+        db.session.execute(text(f"""ALTER TABLE landmarks
+        ALTER COLUMN latitude TYPE DOUBLE PRECISION USING {NESW_TO_DEGREES.format(column = 'latitude')},
+        ALTER COLUMN longitude TYPE DOUBLE PRECISION USING {NESW_TO_DEGREES.format(column = 'longitude')}"""))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_landmarks_latitude_longitude ON landmarks (latitude, longitude)"))
+    db.session.commit()
+    return converted
+
+def migrate_landmark_grid_cells(batch_size = 1000):
+    '''flask migrate-landmark-coordinates: add and fill landmarks.grid_cell, which proximity searches use.
+
+    Cells are computed with Landmark.get_grid_cell so they match newly added landmarks exactly. Returns the number of landmarks filled.
+    '''
+    from models import Landmark
+    if 'grid_cell' not in {column['name'] for column in inspect(db.engine).get_columns('landmarks')}:
+        db.session.execute(text("ALTER TABLE landmarks ADD COLUMN grid_cell INTEGER"))
+        db.session.commit()
+
+    rows = db.session.query(Landmark.id, Landmark.latitude, Landmark.longitude).filter(Landmark.grid_cell.is_(None)).all()
+    for start in range(0, len(rows), batch_size):
+        db.session.bulk_update_mappings(Landmark, [{"id": landmark_id, "grid_cell": Landmark.get_grid_cell(latitude, longitude)}
+        for landmark_id, latitude, longitude in rows[start:start + batch_size]])
+        db.session.commit()
+
+    db.session.execute(text("ALTER TABLE landmarks ALTER COLUMN grid_cell SET NOT NULL"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_landmarks_grid_cell ON landmarks (grid_cell)"))
+    db.session.commit()
+    return len(rows)
+
+def migrate_gpx_files(delete_originals = False):
+    '''flask migrate-gpx-files: move gpx files stored per activity (gpx_files/<activity id>.gpx) into compressed content
+    addressed storage, then delete the stored files no activity references (like flask collect-gpx-files).
+
+    Activities with identical files end up sharing one. The original files are read from this machine's disk (where they
+    were saved before the storage was configurable) or the configured storage, so with TRACK_STORAGE=s3 the migration
+    has to run on the machine that has them. The original files are only removed with delete_originals.
+    Returns the number of files moved and deleted.
+    '''
+    import gzip
+    import shutil
+    from models import Activity, ActivitySummary, TrackBlob
+    from tracks import open_gpx, HashingWriter, GZIP_LEVEL
+    from storage import get_storage, LocalStorage
+    storage = get_storage()
+    local = LocalStorage()
+
+    TrackBlob.__table__.create(db.engine, checkfirst = True)
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_activities_gps_file ON activities (gps_file)"))
+    db.session.commit()
+
+    moved = 0
+    paths = db.session.query(Activity.gps_file).filter(Activity.gps_file.isnot(None)).distinct().all()
+    for path, in paths:
+        if TrackBlob.query.filter(TrackBlob.path == path).first():
+            continue
+        original_storage = local if local.exists(path) else storage
+        if not original_storage.exists(path):
+            continue
+        directory = os.path.relpath(os.path.dirname(path))
+        os.makedirs(f"./{directory}/blobs", exist_ok = True)
+        temporary = f"./{directory}/blobs/migrate_{os.getpid()}.tmp"
+        with open_gpx(original_storage.get_local_path(path)) as original, open(temporary, 'wb') as copy, gzip.GzipFile(filename = '', mode = 'wb', fileobj = copy,
+        compresslevel = GZIP_LEVEL, mtime = 0) as compressed:
+            writer = HashingWriter(compressed)
+            shutil.copyfileobj(original, writer)
+
+        blob = TrackBlob.store(writer.hexdigest(), temporary, writer.size, directory)
+        activity_ids = db.session.query(Activity.id).filter(Activity.gps_file == path)
+        if delete_originals:
+            # thumbnails are named after the gpx file, and are rendered again when next shown
+            ActivitySummary.query.filter(ActivitySummary.activity_id.in_(activity_ids)).update(
+            {ActivitySummary.static_map: None}, synchronize_session = False)
+        Activity.query.filter(Activity.gps_file == path).update({Activity.gps_file: blob.path}, synchronize_session = False)
+        db.session.commit()
+        if delete_originals:
+            TrackBlob.remove_files(path, original_storage)
+        moved += 1
+
+    return moved, TrackBlob.collect_garbage()
+
+def migrate_activity_status():
+    '''flask migrate-activity-status: add activities.status, existing activities were processed when uploaded so they are 'ready'.
+
+    Returns False if the column already existed.
+    '''
+    if 'status' in {column['name'] for column in inspect(db.engine).get_columns('activities')}:
+        return False
+    db.session.execute(text("ALTER TABLE activities ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'ready'"))
+    db.session.commit()
+    return True
+
+def migrate_job_run_after():
+    '''flask migrate-jobs: add jobs.run_after, which delays retrying a failed job. Existing jobs can run right away.
+
+    Returns False if the column already existed.
+    '''
+    if 'run_after' in {column['name'] for column in inspect(db.engine).get_columns('jobs')}:
+        return False
+    db.session.execute(text("ALTER TABLE jobs ADD COLUMN run_after TIMESTAMP"))
+    db.session.commit()
+    return True
+
+def migrate_activity_image_status():
+    '''flask migrate-activity-images: add activities_images.status and error, existing images were uploaded so they are 'ready'.
+
+    Returns False if the columns already existed.
+    '''
+    columns = {column['name'] for column in inspect(db.engine).get_columns('activities_images')}
+    if 'status' in columns:
+        return False
+    db.session.execute(text("ALTER TABLE activities_images ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'ready'"))
+    db.session.execute(text("ALTER TABLE activities_images ADD COLUMN error TEXT"))
+    db.session.commit()
+    return True
+
+def migrate_activity_image_variants():
+    '''flask migrate-activity-images: add activities_images.variants, existing images are only stored in their uploaded format.
+
+    Returns False if the column already existed.
+    '''
+    if 'variants' in {column['name'] for column in inspect(db.engine).get_columns('activities_images')}:
+        return False
+    db.session.execute(text("ALTER TABLE activities_images ADD COLUMN variants TEXT"))
+    db.session.commit()
+    return True
@@ -1,26 +1,41 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import jsonify
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates
 import io
-from PIL import Image
-import gpxpy
-from gpx_converter import Converter
-from math import  pi, acos, sin, cos, floor
+import os
+import hashlib
 import json
+import shutil
+import gzip
+from math import  pi, acos, sin, cos, floor, degrees, radians
 from flask import current_app
 from werkzeug.utils import secure_filename
-import requests as python_requests
+from werkzeug.datastructures import FileStorage
 import logging
-import boto3
-from botocore.exceptions import ClientError
+from contextlib import ExitStack
+# gps tracks (numpy), images (PIL) and S3 (boto3) are imported by the methods that use them,
+# so app start up and each worker boot don't pay for them
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+LANDMARK_RADIUS = 50 # METERS
+
+# preview tracks may be off by a quarter of a pixel at the zoom level that fits the whole track
+PREVIEW_PIXEL_TOLERANCE = 0.25
+
+# landmarks are bucketed into cells of this many degrees (about 11 km of latitude) for proximity searches
+LANDMARK_GRID_DEGREES = 0.1
+LANDMARK_GRID_COLUMNS = int(round(360 / LANDMARK_GRID_DEGREES))
+NEARBY_MAX_RADIUS = 100000 # METERS
+EARTH_RADIUS_METERS = 6371008.8 # as in geo.py, which imports numpy
+
 def adjust_map_options_boundaries(map_options, BUFFER_SIZE = 0.01):
     '''Allows us to add a buffer to the map, so that the activity doesn't touch the map borders'''
     map_options["longitude_min"] -= BUFFER_SIZE
@@ -75,6 +90,20 @@ class ChallengeLandmark(db.Model):
     ForeignKey('landmarks.id', ondelete='cascade'),
     nullable = False)
 
+class ActivityCompletedChallenge(db.Model):
+    '''An intermediary table for linking activities to every challenge they completed, found by Activity.match_challenges'''
+    __tablename__='activities_completed_challenges'
+    __table_args__ = (db.UniqueConstraint('activity_id', 'challenge_id'),)
+    id = db.Column(db.Integer, primary_key = True, autoincrement=True)
+
+    activity_id = db.Column(db.Integer,
+    ForeignKey('activities.id', ondelete='cascade'),
+    nullable = False)
+
+    challenge_id = db.Column(db.Integer,
+    ForeignKey('challenges.id', ondelete='cascade'),
+    nullable = False, index = True)
+
 class ActivityComment(db.Model):
     '''An table for storing comments on activities'''
     __tablename__ = 'activities_comments'
@@ -152,40 +181,92 @@ class ActivityImages(db.Model):
     medium_image_url = db.Column(db.Text, nullable = True)
     large_image_url = db.Column(db.Text, nullable = True)
 
+    # one of 'uploading', 'ready', 'failed', error says why an image couldn't be resized or uploaded
+    status = db.Column(db.String(20), nullable = False, default = 'ready', server_default = 'ready')
+    error = db.Column(db.Text, nullable = True)
+
+    # json {"widths": [large, medium, tiny width], "formats": ["avif", "webp"]}, the stored sizes' widths and the
+    # formats each size is also stored in (see images.py), None for images stored before that
+    variants = db.Column(db.Text, nullable = True)
+
     activity = db.relationship("Activity", backref='images')
 
     user = db.relationship("User", backref = 'images')
 
     @classmethod
-    def create_activity_image(cls, activity_id, user_id, image_data):
+    def get_filenames(cls, user_id, filename):
+        '''The names an uploaded image is stored under in S3, one per size (largest first)'''
+        from images import IMAGE_SIZES
         # append user_id to the filename to minimize the chance of collisions
-        valid_filesizes = [(500, 500), (320, 320), (128, 128)]
-        filenames = []
-        for size in valid_filesizes:
-            filenames.append(f"{size[0]}_{user_id}_{secure_filename(image_data.filename)}")
-        
-        # Add the image to the database
-        activity_image = ActivityImages(activity_id = activity_id, 
+        return [f"{size[0]}_{user_id}_{secure_filename(filename)}" for size in IMAGE_SIZES]
+
+    @classmethod
+    def create_failed_image(cls, activity_id, user_id, filename, error):
+        '''Record an uploaded image that couldn't be resized or uploaded, so it isn't silently dropped. Doesn't commit.'''
+        filenames = ActivityImages.get_filenames(user_id, filename)
+        activity_image = ActivityImages(activity_id = activity_id,
         user_id = user_id,
         tiny_image_url = filenames[2],
         medium_image_url = filenames[1],
-        large_image_url = filenames[0]
+        large_image_url = filenames[0],
+        status = 'failed',
+        error = error
         )
-
         db.session.add(activity_image)
-        db.session.commit()
-
-        # replace the original image's filename with the new once, and submit to amazon S3 database
-        for idx, filename in enumerate(filenames):
-            local_img = Image.open(image_data)
-            in_memory_file = io.BytesIO()
-            size = valid_filesizes[idx]
-            local_img.thumbnail(size)
-            local_img.save(in_memory_file, format = local_img.format)
-            in_memory_file.seek(0)
-            response = upload_user_image_to_S3(in_memory_file, current_app.config['SOKA_USER_IMAGE_BUCKET'], filename, image_data.content_type)
         return activity_image
 
+    @classmethod
+    def create_activity_image(cls, activity_id, user_id, image_data):
+        return ActivityImages.create_activity_images(activity_id, user_id, [image_data])[0]
+
+    @classmethod
+    def create_activity_images(cls, activity_id, user_id, images_data):
+        '''Resize uploaded images to every size, upload all of them to amazon S3 at once and add them to the database
+
+        Each image is added with a status of 'ready', or 'failed' and the error if it couldn't be read or uploaded.
+        '''
+        from images import IMAGE_SIZES, MODERN_FORMATS, create_responsive_images, get_variant_key
+        from s3 import get_s3_upload_client, upload_objects
+        activity_images = []
+        uploads = []
+        for image_data in images_data:
+            filenames = ActivityImages.get_filenames(user_id, image_data.filename)
+            activity_image = ActivityImages(activity_id = activity_id,
+            user_id = user_id,
+            tiny_image_url = filenames[2],
+            medium_image_url = filenames[1],
+            large_image_url = filenames[0],
+            status = 'uploading'
+            )
+            try:
+                widths, encoded = create_responsive_images(image_data.stream, IMAGE_SIZES)
+            except (OSError, ValueError) as e:
+                activity_image.status = 'failed'
+                activity_image.error = f"Could not read {image_data.filename}: {e}"
+                activity_images.append((activity_image, filenames))
+                continue
+
+            uploads.extend((filename, variant, image_data.content_type) for filename, variant in zip(filenames, encoded.pop(None)))
+            extensions = []
+            for image_format, variants in encoded.items():
+                extension, content_type, options = MODERN_FORMATS[image_format]
+                variant_keys = [get_variant_key(filename, extension) for filename in filenames]
+                uploads.extend((key, variant, content_type) for key, variant in zip(variant_keys, variants))
+                filenames = filenames + variant_keys
+                extensions.append(extension)
+            activity_image.variants = json.dumps({"widths": widths, "formats": extensions})
+            activity_images.append((activity_image, filenames))
+
+        errors = upload_objects(get_s3_upload_client(), current_app.config['SOKA_USER_IMAGE_BUCKET'], uploads)
+        for activity_image, filenames in activity_images:
+            if activity_image.status == 'uploading':
+                failures = [f"Could not upload {filename}: {errors[filename]}" for filename in filenames if errors[filename] is not None]
+                activity_image.status = 'failed' if failures else 'ready'
+                activity_image.error = '\n'.join(failures) or None
+            db.session.add(activity_image)
+        db.session.commit()
+        return [activity_image for activity_image, filenames in activity_images]
+
     @classmethod
     def create_activity_image_from_url(cls, activity_id, user_id, image_url_list):
         activity_image = ActivityImages(activity_id = activity_id,
@@ -197,8 +278,9 @@ class ActivityImages(db.Model):
         db.session.commit()
         return activity_image
     
-    def get_activity_image_s3_url(self, image_size_str = 'medium'):
-        # use presigned URL to generate a URL that can display the image on a webpage
+    def get_activity_image_s3_url(self, image_size_str = 'medium', image_format = None):
+        # use presigned URL to generate a URL that can display the image on a webpage, image_format is one of the
+        # variants' formats ('webp') or None for the uploaded format
         image_object_to_request = None 
         if image_size_str.lower() == 'tiny':
             image_object_to_request = self.tiny_image_url 
@@ -208,13 +290,377 @@ class ActivityImages(db.Model):
             image_object_to_request = self.large_image_url
         else:
             raise ValueError("get_activity_image_s3_url: image_size_str must be a member of the set {'tiny', 'medium', 'large'}")
-        url = create_presigned_url(current_app.config['SOKA_USER_IMAGE_BUCKET'], f"{image_object_to_request}")
-        response = python_requests.get(url)
-        return response.url
+        # signing is done locally and cached (see s3.py), the image itself is only ever fetched by the browser
+        from s3 import get_presigned_url
+        if image_format:
+            from images import get_variant_key
+            image_object_to_request = get_variant_key(image_object_to_request, image_format)
+        return get_presigned_url(current_app.config['SOKA_USER_IMAGE_BUCKET'], f"{image_object_to_request}", image_size_str.lower())
+
+    def get_srcset(self, image_format = None):
+        '''The srcset of the image's sizes in one format (see get_activity_image_s3_url), empty if the widths weren't recorded'''
+        if not self.variants:
+            return ''
+        widths = json.loads(self.variants)["widths"]
+        return ', '.join(f"{self.get_activity_image_s3_url(size, image_format)} {width}w"
+        for size, width in zip(['large', 'medium', 'tiny'], widths))
+
+    def get_sources(self):
+        '''(content type, srcset) of each format the image is also stored in, for the <source>s of a <picture>'''
+        if not self.variants:
+            return []
+        from images import MODERN_FORMATS
+        content_types = {extension: content_type for extension, content_type, options in MODERN_FORMATS.values()}
+        return [(content_types[extension], self.get_srcset(extension)) for extension in json.loads(self.variants)["formats"]]
 
     def __repr__(self):
         return f"Activity Image {self.id} references activity {self.activity_id} stored at {self.tiny_image_url}."
 
+class TrackBlob(db.Model):
+    '''A table for the gpx files stored under their content hash, every activity that uploads the same track shares one copy
+
+    A blob is referenced by the activities whose gps_file is its path, and its files (the gpx, its track sidecar and
+    thumbnails) are deleted with it once none are left.
+    '''
+    __tablename__ = 'track_blobs'
+
+    sha256 = db.Column(db.String(64), primary_key = True)
+    path = db.Column(db.Text, nullable = False, unique = True)
+    size = db.Column(db.Integer, nullable = False)
+    created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+
+    @classmethod
+    def get_path(cls, directory, sha256):
+        '''Where a gpx file with this hash is stored, blobs are spread over subdirectories by the first byte of their hash'''
+        return f"./{directory}/blobs/{sha256[:2]}/{sha256}.gpx.gz"
+
+    @classmethod
+    def store(cls, sha256, temporary, size, directory, track = None):
+        '''Move a newly written gpx file into storage under its hash, or drop it if the same file is already stored
+
+        The blob row stays locked until the caller commits, so it can't be released before an activity references it.
+        A new row always stores the file: a released blob's files are gone from the storage, but can still be in this
+        node's cache.
+        '''
+        from tracks import store_track_sidecar, sidecar_path
+        from storage import get_storage
+        storage = get_storage()
+        path = TrackBlob.get_path(directory, sha256)
+        blob = TrackBlob.query.filter(TrackBlob.sha256 == sha256).with_for_update().first()
+        is_new = blob is None
+        if is_new:
+            blob = TrackBlob(sha256 = sha256, path = path, size = size)
+            db.session.add(blob)
+
+        if not is_new and storage.exists_remotely(blob.path):
+            os.remove(temporary)
+        else:
+            storage.put_file(blob.path, temporary)
+        if track is not None and (is_new or not storage.exists_remotely(sidecar_path(blob.path))):
+            store_track_sidecar(storage, sidecar_path(blob.path), track)
+        return blob
+
+    def get_reference_count(self):
+        '''The number of activities using this file'''
+        return Activity.query.filter(Activity.gps_file == self.path).count()
+
+    @classmethod
+    def release(cls, path):
+        '''Delete a stored gpx file and the files derived from it once no activity references it, returns whether it was deleted
+
+        Files that aren't blobs (activities uploaded before content addressed storage) are left alone.
+        '''
+        blob = TrackBlob.query.filter(TrackBlob.path == path).with_for_update().first()
+        if blob is None or blob.get_reference_count():
+            db.session.commit()
+            return False
+        # removed while the row is locked, an upload of the same track waits and then stores it again
+        TrackBlob.remove_files(blob.path)
+        db.session.delete(blob)
+        db.session.commit()
+        return True
+
+    @classmethod
+    def remove_files(cls, path, storage = None):
+        '''Remove a gpx file along with its track sidecar and thumbnails, from the app's storage by default'''
+        from tracks import gpx_stem
+        from storage import get_storage
+        storage = storage or get_storage()
+        stem = gpx_stem(path)
+        for key in [path, f"{stem}.trk"] + [key for key in storage.list_keys(f"{stem}_") if key.endswith('.png')]:
+            storage.delete(key)
+
+    @classmethod
+    def collect_garbage(cls):
+        '''Release every blob no activity references anymore (e.g. after their user was deleted), returns the number deleted'''
+        return sum(TrackBlob.release(path) for path, in db.session.query(TrackBlob.path).all())
+
+class ActivitySummary(db.Model):
+    '''A table for storing the statistics and map options of an activity's gpx track, computed once at upload'''
+    __tablename__ = 'activities_summaries'
+
+    activity_id = db.Column(db.Integer,
+    ForeignKey('activities.id', ondelete='cascade'),
+    primary_key = True)
+
+    duration_seconds = db.Column(db.Integer, nullable = False, default = 0)
+    climb = db.Column(db.Integer, nullable = True)
+    descent = db.Column(db.Integer, nullable = True)
+    min_elevation = db.Column(db.Integer, nullable = True)
+    max_elevation = db.Column(db.Integer, nullable = True)
+
+    # meters, seconds and meters per second, null for summaries created before these were computed
+    distance = db.Column(db.Float, nullable = True)
+    moving_seconds = db.Column(db.Integer, nullable = True)
+    average_speed = db.Column(db.Float, nullable = True)
+    max_speed = db.Column(db.Float, nullable = True)
+
+    # json encoded {"km": [[meters, seconds], ...], "mile": [[meters, seconds], ...]}
+    splits = db.Column(db.Text, nullable = True)
+
+    longitude_min = db.Column(db.Float, nullable = False)
+    latitude_min = db.Column(db.Float, nullable = False)
+    longitude_max = db.Column(db.Float, nullable = False)
+    latitude_max = db.Column(db.Float, nullable = False)
+    longitude_center = db.Column(db.Float, nullable = False)
+    latitude_center = db.Column(db.Float, nullable = False)
+    zoom = db.Column(db.Integer, nullable = False)
+
+    # the track as an encoded polyline, at full resolution and simplified for previews
+    polyline = db.Column(db.Text, nullable = False)
+    preview_polyline = db.Column(db.Text, nullable = False)
+
+    # png thumbnail of the preview track, stored next to the gpx file and named by its content hash
+    static_map = db.Column(db.Text, nullable = True)
+
+    @classmethod
+    def create_summary(cls, activity):
+        '''A method for parsing an activity's gpx file one time, and storing the results in the database
+
+        Activities sharing a gpx file (the same track uploaded again) copy the summary that was already computed for it.
+        '''
+        existing = ActivitySummary.query.join(Activity, Activity.id == ActivitySummary.activity_id).filter(
+        Activity.gps_file == activity.gps_file, Activity.id != activity.id).first()
+        if existing is not None:
+            summary = ActivitySummary(activity_id = activity.id,
+            **{column.name: getattr(existing, column.name) for column in ActivitySummary.__table__.columns if column.name != 'activity_id'})
+            db.session.add(summary)
+            db.session.commit()
+            return summary
+
+        gpx_object = GPXHandler(activity)
+        statistics = gpx_object.statistics
+        map_options = gpx_object.map_options
+
+        summary = ActivitySummary(activity_id = activity.id,
+        duration_seconds = statistics['duration_seconds'],
+        climb = statistics['climb'],
+        descent = statistics['descent'],
+        min_elevation = statistics['min_elevation'],
+        max_elevation = statistics['max_elevation'],
+        distance = statistics['distance_meters'],
+        moving_seconds = statistics['moving_seconds'],
+        average_speed = statistics['average_speed_mps'],
+        max_speed = statistics['max_speed_mps'],
+        splits = json.dumps({"km": statistics['splits_km'], "mile": statistics['splits_mile']}),
+        longitude_min = map_options['longitude_min'],
+        latitude_min = map_options['latitude_min'],
+        longitude_max = map_options['longitude_max'],
+        latitude_max = map_options['latitude_max'],
+        longitude_center = map_options['longitude_center'],
+        latitude_center = map_options['latitude_center'],
+        zoom = map_options['zoom'],
+        polyline = GPXHandler.encode_coordinates(map_options['coordinates']),
+        preview_polyline = GPXHandler.encode_coordinates(map_options['preview_coordinates'])
+        )
+        db.session.add(summary)
+        db.session.commit()
+        return summary
+
+    @property
+    def statistics(self):
+        '''The activity statistics, in the same format produced by GPXHandler
+
+        Formatted once per instance, templates look up each statistic separately.
+        '''
+        statistics = getattr(self, '_statistics', None)
+        if statistics is not None:
+            return statistics
+        splits = json.loads(self.splits) if self.splits else {"km": [], "mile": []}
+        self._statistics = {
+        "duration": GPXHandler.format_duration(self.duration_seconds),
+        "moving_time": '-' if self.moving_seconds is None else GPXHandler.format_duration(self.moving_seconds),
+        "distance": GPXHandler.format_distance(self.distance),
+        "average_speed": GPXHandler.format_speed(self.average_speed),
+        "max_speed": GPXHandler.format_speed(self.max_speed),
+        "splits_km": GPXHandler.format_splits(splits["km"], 'km'),
+        "splits_mile": GPXHandler.format_splits(splits["mile"], 'mi'),
+        "climb": self.climb,
+        "descent": self.descent,
+        "min_elevation": self.min_elevation,
+        "max_elevation": self.max_elevation
+        }
+        return self._statistics
+
+    @property
+    def map_options(self):
+        '''The map_options object needed to display the activity on a map, with the track as encoded polylines that are decoded by the browser'''
+        return {
+        "longitude_min": self.longitude_min,
+        "latitude_min": self.latitude_min,
+        "longitude_max": self.longitude_max,
+        "latitude_max": self.latitude_max,
+        "longitude_center": self.longitude_center,
+        "latitude_center": self.latitude_center,
+        "zoom": self.zoom,
+        "polyline": self.polyline
+        }
+
+    def __repr__(self):
+        return f"Activity Summary for activity {self.activity_id} with duration {self.statistics['duration']}"
+
+class Job(db.Model):
+    '''A table for storing work that is done outside of a request, by the worker started with `flask run-jobs` (see jobs.py)'''
+    __tablename__ = 'jobs'
+
+    # a job that raises is retried until it has been attempted this many times
+    MAX_ATTEMPTS = 3
+
+    # a job still running after this many seconds is assumed to have been left behind by a worker that stopped, and is
+    # run again (or given up on), can be overridden with app.config['JOB_STALE_SECONDS']
+    STALE_SECONDS = 60 * 60
+
+    # a job that raised waits this many seconds before it is retried, doubling after every attempt, so a short outage
+    # (e.g. of S3) doesn't use up its attempts, can be overridden with app.config['JOB_RETRY_DELAY']
+    RETRY_DELAY = 30
+
+    # functions that perform each kind of job, registered with Job.handler
+    handlers = {}
+
+    # functions called with a job's payload once it is given up on, registered with Job.failure_handler
+    failure_handlers = {}
+
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+
+    kind = db.Column(db.String(50), nullable = False)
+
+    # json encoded keyword arguments for the handler
+    payload = db.Column(db.Text, nullable = False, default = '{}')
+
+    # one of 'pending', 'running', 'done', 'failed'
+    status = db.Column(db.String(20), nullable = False, default = 'pending', index = True)
+
+    attempts = db.Column(db.Integer, nullable = False, default = 0)
+
+    # a pending job isn't claimed before this time, None to run it as soon as possible
+    run_after = db.Column(db.DateTime, nullable = True)
+
+    error = db.Column(db.Text, nullable = True)
+
+    created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+
+    updated_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow, onupdate = datetime.utcnow)
+
+    @classmethod
+    def handler(cls, kind):
+        '''A decorator for registering the function that performs a kind of job'''
+        def register(func):
+            cls.handlers[kind] = func
+            return func
+        return register
+
+    @classmethod
+    def failure_handler(cls, kind):
+        '''A decorator for registering the function that cleans up after a kind of job that failed for good'''
+        def register(func):
+            cls.failure_handlers[kind] = func
+            return func
+        return register
+
+    @classmethod
+    def enqueue(cls, kind, **payload):
+        '''A method for adding a job to the queue, the job is run right away when JOBS_RUN_INLINE is set (e.g. for testing)'''
+        job = Job(kind = kind, payload = json.dumps(payload))
+        db.session.add(job)
+        db.session.commit()
+        if current_app.config.get('JOBS_RUN_INLINE'):
+            job.status = 'running'
+            job.attempts += 1
+            db.session.commit()
+            job.run()
+        return job
+
+    @classmethod
+    def claim_next(cls):
+        '''Mark the oldest pending job that is due as running and return it, or None if no job is due.
+
+        On postgres, rows locked by another worker are skipped so several workers can share the queue.
+        '''
+        Job.requeue_stale()
+        query = Job.query.filter(Job.status == 'pending', or_(Job.run_after.is_(None), Job.run_after <= datetime.utcnow())
+        ).order_by(Job.id)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked = True)
+        job = query.first()
+        if job is None:
+            db.session.commit()
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        db.session.commit()
+        return job
+
+    @classmethod
+    def requeue_stale(cls):
+        '''Put jobs left running by a worker that stopped back in the queue, or give up on them after MAX_ATTEMPTS.
+        Returns the number of jobs found.'''
+        cutoff = datetime.utcnow() - timedelta(seconds = current_app.config.get('JOB_STALE_SECONDS', Job.STALE_SECONDS))
+        query = Job.query.filter(Job.status == 'running', Job.updated_at < cutoff)
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked = True)
+        stale = query.all()
+        for job in stale:
+            logging.warning(f"{job} was left running since {job.updated_at}")
+            job.error = "The worker running the job stopped"
+            if job.attempts >= Job.MAX_ATTEMPTS:
+                job.give_up()
+            else:
+                job.status = 'pending'
+        db.session.commit()
+        return len(stale)
+
+    def give_up(self):
+        '''Mark the job as failed for good, and let its failure handler clean up. Doesn't commit.'''
+        self.status = 'failed'
+        on_failure = Job.failure_handlers.get(self.kind)
+        if on_failure is not None:
+            on_failure(**json.loads(self.payload))
+
+    def run(self):
+        '''Perform the job, recording whether it succeeded. Failed jobs go back in the queue, to be retried after a delay, until
+        MAX_ATTEMPTS is reached.'''
+        try:
+            Job.handlers[self.kind](**json.loads(self.payload))
+        except Exception as e:
+            db.session.rollback()
+            logging.exception(f"{self} raised an exception")
+            self.error = f"{type(e).__name__}: {e}"
+            if self.attempts >= Job.MAX_ATTEMPTS:
+                self.give_up()
+            else:
+                self.status = 'pending'
+                delay = current_app.config.get('JOB_RETRY_DELAY', Job.RETRY_DELAY) * 2 ** (self.attempts - 1)
+                self.run_after = datetime.utcnow() + timedelta(seconds = delay)
+            db.session.commit()
+            return False
+        self.status = 'done'
+        self.error = None
+        db.session.commit()
+        return True
+
+    def __repr__(self):
+        return f"Job #{self.id} ({self.kind}) is {self.status} after {self.attempts} attempts"
+
 class Admin(db.Model):
     __tablename__ = 'admins'
     user_id = db.Column(db.Integer, ForeignKey('users.id', ondelete='cascade'), primary_key= True)
@@ -324,16 +770,17 @@ class User(db.Model):
                     options[idx] = (landmark.id, display_string + f"added by {landmark.creator.first_name} {landmark.creator.last_name}")
             return options
 
+    def get_challenge_creator_ids(self):
+        '''The users whose challenges this user has access to: themself, the users they follow, and admins'''
+        valid_ids = [user.id for user in self.following]
+        valid_ids.extend([admin.user_id for admin in Admin.query.all()])
+        valid_ids.append(self.id)
+        return valid_ids
+
     def get_available_challenges(self, return_objects = False):
         '''A user only has access to user created challenges if following the creator or the creator is an admin'''
-        if self.following:   
-            valid_ids = [user.id for user in self.following]
-        else:
-            valid_ids = []
         admin_ids = [admin.user_id for admin in Admin.query.all()]
-        valid_ids.extend(admin_ids)
-        valid_ids.append(self.id)
-        challenges = Challenge.query.filter(Challenge.created_by.in_(valid_ids)).all()
+        challenges = Challenge.query.filter(Challenge.created_by.in_(self.get_challenge_creator_ids())).all()
         if return_objects:
             return challenges
         options = [None] * len(challenges)
@@ -357,7 +804,7 @@ class User(db.Model):
             raise ValueError("get_activity_image_s3_url: image_size_str must be a member of the set {'tiny', 'medium', 'large'}")
         act_imgs = db.session\
             .query(ActivityImages, Activity.timestamp)\
-                .filter(ActivityImages.user_id==self.id, ActivityImages.activity_id==Activity.id)\
+                .filter(ActivityImages.user_id==self.id, ActivityImages.activity_id==Activity.id, ActivityImages.status == 'ready')\
                     .order_by(Activity.timestamp.desc())\
                         .limit(number).all()
         return [act_img[0] for act_img in act_imgs]
@@ -391,9 +838,13 @@ class Activity(db.Model):
 
     was_successful = db.Column(db.Boolean, nullable = True)
 
+    # one of 'processing', 'ready', 'failed', activities are processed by a background job after upload
+    status = db.Column(db.String(20), nullable = False, default = 'ready', server_default = 'ready')
+
     style = db.Column(db.String(40), nullable = True)
 
-    gps_file = db.Column(db.Text(), nullable = True)
+    # shared by activities that uploaded the same track, see TrackBlob
+    gps_file = db.Column(db.Text(), nullable = True, index = True)
 
     notes = db.Column(db.Text, nullable = True)
 
@@ -404,24 +855,45 @@ class Activity(db.Model):
     backref = 'activities')
 
     challenge = db.relationship('Challenge')
+
+    summary = db.relationship('ActivitySummary', uselist = False, cascade = 'all, delete-orphan')
+
+    # every challenge the track completed, not only the one picked when uploading
+    completed_challenges = db.relationship('Challenge', secondary = 'activities_completed_challenges', order_by = 'Challenge.name')
+
+    def get_images(self):
+        '''The activity's images that were uploaded, and can be shown'''
+        return [image for image in self.images if image.status == 'ready']
+
     def __repr__(self):
         return f"Activity #{self.id}, was_successful = {self.was_successful} at attempting challenge {self.challenge.name}"
     @classmethod 
     def add_activity(cls, user_id, name, challenge_id, style, gps_data, notes, gear, pics, directory='gpx_files'):
-        '''A method for creating a new activity, associating gear/images with the activity/ and adding each to the database'''
+        '''A method for creating a new activity, associating gear/images with the activity/ and adding each to the database
+
+        Only the uploads are saved during the request, the activity is analyzed/validated and its images are
+        resized by a 'process_activity' job, and its status is 'processing' until that job finishes.
+        '''
 
         new_activity = Activity(user_id = user_id, 
         name = name.capitalize(), 
         challenge_id = challenge_id, 
         style = style, 
-        notes = notes)
+        notes = notes,
+        status = 'processing')
 
         db.session.add(new_activity)
         db.session.commit()
 
         if gps_data:
-            gps_filename = Activity.save_gpx_file(new_activity, gps_data, directory)
-            new_activity.gps_file = gps_filename 
+            try:
+                Activity.save_gpx_file(new_activity, gps_data, directory)
+            except Exception:
+                # an upload that isn't a valid track leaves no activity behind, rather than one processing forever
+                db.session.rollback()
+                db.session.delete(new_activity)
+                db.session.commit()
+                raise
 
         gear_list = Gear.query.filter(Gear.id.in_(gear))
         if gear_list:
@@ -432,25 +904,120 @@ class Activity(db.Model):
             db.session.add_all(activity_gear)
             db.session.commit()
 
-        is_successful = Activity.validate_activity(new_activity)
-
-        new_activity.was_successful = is_successful 
-        db.session.add(new_activity)
-        db.session.commit()
-
+        images = []
         if pics:
-            for pic in pics:
-                ActivityImages.create_activity_image(new_activity.id, user_id, pic)
+            for idx, pic in enumerate(pics):
+                images.append(Activity.stage_image(new_activity, pic, idx, directory))
+
+        Job.enqueue('process_activity', activity_id = new_activity.id, images = images)
         return new_activity
 
+    @classmethod
+    def stage_image(cls, activity, image_data, idx, directory='gpx_files'):
+        '''Put an uploaded image in file storage until the process_activity job resizes it, returns what the job needs to find it
+
+        The job can run on another machine (see storage.py), so the upload is saved locally first and then stored.
+        '''
+        from storage import get_storage, get_folder_key, temporary_path
+        staging_directory = f"./{directory}/staging"
+        os.makedirs(staging_directory, exist_ok = True)
+        name = f"{activity.id}_{idx}_{secure_filename(image_data.filename)}"
+        key = f"{get_folder_key(directory)}/staging/{name}"
+        temporary = temporary_path(f"{staging_directory}/{name}")
+        image_data.save(temporary)
+        try:
+            get_storage().put_file(key, temporary)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return {"key": key, "filename": image_data.filename, "content_type": image_data.content_type}
+
+    @classmethod
+    def process_activity(cls, activity_id, images = ()):
+        '''Analyze and validate an uploaded activity, and resize/upload its staged images. Run by the process_activity job.'''
+        activity = Activity.query.get(activity_id)
+        if activity is None:
+            return None
+
+        try:
+            if activity.gps_file and not activity.summary:
+                ActivitySummary.create_summary(activity)
+            if activity.summary and not activity.summary.static_map:
+                activity.create_static_map()
+
+            activity.was_successful = Activity.validate_activity(activity)
+            activity.completed_challenges = activity.match_challenges()
+            db.session.commit()
+
+            from storage import get_storage
+            storage = get_storage()
+            staged = []
+            for image in images:
+                if storage.exists(image["key"]):
+                    staged.append(image)
+                # images that were already uploaded by an earlier attempt of this job are gone from staging too
+                elif not ActivityImages.query.filter(ActivityImages.activity_id == activity.id,
+                ActivityImages.large_image_url == ActivityImages.get_filenames(activity.user_id, image["filename"])[0]).count():
+                    ActivityImages.create_failed_image(activity.id, activity.user_id, image["filename"],
+                    f"The staged upload of {image['filename']} is missing")
+            db.session.commit()
+            if staged:
+                with ExitStack() as stack:
+                    images_data = [FileStorage(stream = stack.enter_context(storage.open(image["key"])), filename = image["filename"],
+                    content_type = image["content_type"]) for image in staged]
+                    ActivityImages.create_activity_images(activity.id, activity.user_id, images_data)
+                for image in staged:
+                    storage.delete(image["key"])
+        except Exception:
+            # the job is retried, the activity is only marked as failed once it is given up on (see jobs.py)
+            db.session.rollback()
+            raise
+
+        activity.status = 'ready'
+        db.session.commit()
+        return activity
+
     @classmethod 
     def save_gpx_file(self, activity, gps_data, directory):
-        '''A method for saving an uploaded gpx file to file storage'''
-        gpx = gpxpy.parse(gps_data)
-        filename = f"./{directory}/{activity.id}.gpx"
-        with open(filename, 'w') as storage_file:
-            storage_file.write(gpx.to_xml())
-        return filename
+        '''A method for streaming an uploaded gpx file to file storage, validating it and hashing it along the way
+
+        Files are gzipped and stored under the hash of their content (see TrackBlob), so uploading the same track again
+        reuses the stored copy.
+        Sets and commits the activity's gps_file, and returns it.
+        '''
+        from tracks import load_track, CopyingReader, HashingWriter, GZIP_LEVEL
+        if isinstance(gps_data, str):
+            gps_data = gps_data.encode()
+        if isinstance(gps_data, bytes):
+            gps_data = io.BytesIO(gps_data)
+        # werkzeug uploads wrap the underlying (possibly spooled to disk) stream
+        stream = getattr(gps_data, 'stream', gps_data)
+
+        # the hash is only known once the whole file is read, so it is written to a temporary file first
+        os.makedirs(f"./{directory}/blobs", exist_ok = True)
+        temporary = f"./{directory}/blobs/upload_{activity.id}_{os.getpid()}.tmp"
+        try:
+            # compressed as it is written, the hash is of the uncompressed file. No name or time in the gzip header,
+            # so the same track always compresses to the same bytes.
+            with open(temporary, 'wb') as storage_file, gzip.GzipFile(filename = '', mode = 'wb', fileobj = storage_file,
+            compresslevel = GZIP_LEVEL, mtime = 0) as compressed_file:
+                writer = HashingWriter(compressed_file)
+                track = load_track(CopyingReader(stream, writer))
+                shutil.copyfileobj(stream, writer)
+        except ValueError:
+            os.remove(temporary)
+            raise
+
+        blob = TrackBlob.store(writer.hexdigest(), temporary, writer.size, directory, track)
+        activity.gps_file = blob.path
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent upload of the same track stored it first
+            db.session.rollback()
+            activity.gps_file = TrackBlob.get_path(directory, writer.hexdigest())
+            db.session.commit()
+        return activity.gps_file
 
     @classmethod
     def validate_activity(cls, activity):
@@ -463,23 +1030,87 @@ class Activity(db.Model):
             return False 
 
         landmarks = challenge.landmarks
-        for landmark in landmarks:
-            if not Activity.validate_landmark(activity, landmark):
-                return False
-        return True
+        return all(Activity.validate_landmarks(activity, landmarks).values())
+
+    @classmethod
+    def validate_landmarks(cls, activity, landmarks, use_index = True):
+        '''A method for checking which landmarks a user visited, returns a dictionary of landmark.id: was_visited
+
+        With use_index, each landmark only looks at the track points in the grid cells around it, instead of every point.
+        '''
+        if not landmarks:
+            return {}
+        latitudes = [landmark.get_latitude() for landmark in landmarks]
+        longitudes = [landmark.get_longitude() for landmark in landmarks]
+        if use_index:
+            visited = activity.get_track_index().targets_within_radius(latitudes, longitudes, LANDMARK_RADIUS)
+        else:
+            from geo import targets_within_radius
+            track = activity.get_track()
+            visited = targets_within_radius(track.latitude, track.longitude, latitudes, longitudes, LANDMARK_RADIUS)
+        return {landmark.id: bool(was_visited) for landmark, was_visited in zip(landmarks, visited)}
+
+    def match_challenges(self):
+        '''Find every challenge available to the activity's user whose landmarks the track all passes within LANDMARK_RADIUS of
+
+        Only the landmarks inside the track's bounding box are checked against the track, and only the challenges that use
+        a visited landmark are considered, so the cost depends on the landmarks near the track rather than on the number of challenges.
+        '''
+        summary = self.summary
+        if not self.gps_file or summary is None:
+            return []
+
+        latitude_buffer = degrees(LANDMARK_RADIUS / EARTH_RADIUS_METERS)
+        widest_latitude = min(max(abs(summary.latitude_min), abs(summary.latitude_max)) + latitude_buffer, 89.9)
+        longitude_buffer = latitude_buffer / cos(radians(widest_latitude))
+        nearby = Landmark.within_bounds(summary.latitude_min - latitude_buffer, summary.longitude_min - longitude_buffer,
+        summary.latitude_max + latitude_buffer, summary.longitude_max + longitude_buffer
+        ).with_entities(Landmark.id, Landmark.latitude, Landmark.longitude).all()
+        if not nearby:
+            return []
+
+        ids, latitudes, longitudes = zip(*nearby)
+        hits = self.get_track_index().targets_within_radius(latitudes, longitudes, LANDMARK_RADIUS)
+        visited = {landmark_id for landmark_id, hit in zip(ids, hits) if hit}
+        if not visited:
+            return []
+
+        # every landmark of the challenges that use a visited landmark
+        candidates = db.session.query(ChallengeLandmark.challenge_id).filter(ChallengeLandmark.landmark_id.in_(visited))
+        challenge_landmarks = {}
+        for challenge_id, landmark_id in db.session.query(ChallengeLandmark.challenge_id, ChallengeLandmark.landmark_id
+        ).filter(ChallengeLandmark.challenge_id.in_(candidates)):
+            challenge_landmarks.setdefault(challenge_id, set()).add(landmark_id)
+
+        completed = [challenge_id for challenge_id, landmark_ids in challenge_landmarks.items() if landmark_ids <= visited]
+        if not completed:
+            return []
+        return Challenge.query.filter(Challenge.id.in_(completed),
+        Challenge.created_by.in_(self.user.get_challenge_creator_ids())).order_by(Challenge.name).all()
 
     @classmethod
     def validate_landmark(cls, activity, landmark):
         '''A method for ensuring a user visited a particular landmark'''
-        RADIUS = 50 # METERS
-        point1 = (landmark.get_longitude(), landmark.get_latitude())
-        
-        gpx_object = GPXHandler(activity)
-        coordinates = gpx_object.map_options['coordinates']
-        for coordinate in coordinates:
-            if GPXHandler.compute_distance_between_two_points(point1, coordinate) < RADIUS:
-                return True
-        return False
+        return Activity.validate_landmarks(activity, [landmark])[landmark.id]
+
+    def get_track(self):
+        '''Load the activity's gps track into numpy arrays, memory mapped from its binary sidecar (from the track storage)'''
+        track = getattr(self, '_track', None)
+        if track is None or self._track_file != self.gps_file:
+            from tracks import load_stored_track
+            from storage import get_storage
+            self._track = load_stored_track(get_storage(), self.gps_file)
+            self._track_file = self.gps_file
+            self._track_index = None
+        return self._track
+
+    def get_track_index(self):
+        '''Build a spatial index over the activity's track points, once per track'''
+        track = self.get_track()
+        if self._track_index is None:
+            from geo import GridIndex
+            self._track_index = GridIndex(track.latitude, track.longitude, cell_size = LANDMARK_RADIUS)
+        return self._track_index
 
     def get_processed_datetime_string(self):
         '''format the datetime into a more readable format'''
@@ -487,14 +1118,44 @@ class Activity(db.Model):
         return f"{t.month}-{t.day}-{t.year} at {t.hour}:{t.minute}"
 
     def setup_gpx_object(self):
-        if self.gps_file:
-            self.gpx = GPXHandler(self)
-        else:
-            self.gpx = None
+        '''Make sure the track summary exists, parsing the gpx file only for activities stored before summaries were added'''
+        if self.gps_file and not self.summary and self.status != 'processing':
+            ActivitySummary.create_summary(self)
         return self
 
+    def create_static_map(self):
+        '''Render the simplified track to a png thumbnail once, and store it next to the gpx file'''
+        from thumbnails import render_track_thumbnail
+        from tracks import decode_polyline, gpx_stem
+        from storage import get_storage
+        storage = get_storage()
+        png = render_track_thumbnail(decode_polyline(self.summary.preview_polyline))
+
+        # the filename changes with the content, so the image can be cached forever
+        filename = f"{gpx_stem(self.gps_file)}_{hashlib.sha256(png).hexdigest()[:12]}.png"
+        storage.put_bytes(filename, png, 'image/png')
+        if self.summary.static_map and self.summary.static_map != filename:
+            storage.delete(self.summary.static_map)
+        self.summary.static_map = filename
+        db.session.commit()
+        return filename
+
+    def get_gpx_url(self):
+        '''The /uploads url of the activity's gpx file, stored files are served decompressed under their name without .gz'''
+        from storage import get_folder_key, normalize_key
+        key = normalize_key(self.gps_file)
+        name = key[:-len('.gz')] if key.endswith('.gz') else key
+        folder = get_folder_key(current_app.config['UPLOAD_FOLDER'])
+        return f"/uploads/{name[len(folder) + 1:] if name.startswith(folder + '/') else name}"
+
     def get_static_map(self):
-        pass
+        '''The url of the activity's track thumbnail, or None if it has no track'''
+        if not self.summary:
+            return None
+        from storage import get_storage
+        if not self.summary.static_map or not get_storage().exists(self.summary.static_map):
+            self.create_static_map()
+        return f"/activities/{self.id}/static_map/{os.path.basename(self.summary.static_map)}"
 
 
 class Challenge(db.Model):
@@ -540,6 +1201,19 @@ class Challenge(db.Model):
         db.session.commit()
         return challenge
         
+    @classmethod
+    def update_challenge(cls, challenge, name, description, gear_ids, landmark_ids):
+        '''A method for editing a challenge and its gear/landmarks, returns True if the landmarks changed (so attempts need to be revalidated)'''
+        challenge.name = name.capitalize()
+        challenge.description = description.capitalize()
+        challenge.gear = Gear.query.filter(Gear.id.in_(gear_ids)).all()
+
+        landmarks_changed = set(landmark_ids) != {landmark.id for landmark in challenge.landmarks}
+        if landmarks_changed:
+            challenge.landmarks = Landmark.query.filter(Landmark.id.in_(landmark_ids)).all()
+        db.session.commit()
+        return landmarks_changed
+
     @classmethod
     def get_official_challenges(cls):
         admin_ids = db.session.query(Admin.user_id).all()
@@ -548,25 +1222,96 @@ class Challenge(db.Model):
 class Landmark(db.Model):
     '''A table for storing information about landmarks'''
     __tablename__= 'landmarks'
+    __table_args__ = (db.Index('ix_landmarks_latitude_longitude', 'latitude', 'longitude'),)
+
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-    latitude = db.Column(db.String(20), nullable = False)
-    longitude = db.Column(db.String(20), nullable = False)
+    # signed degrees (north/east positive), strings like "38.7436 N" are converted when assigned
+    latitude = db.Column(db.Float, nullable = False)
+    longitude = db.Column(db.Float, nullable = False)
+    # the LANDMARK_GRID_DEGREES cell containing the landmark, kept up to date with the coordinates
+    grid_cell = db.Column(db.Integer, nullable = False, index = True)
     img_url = db.Column(db.Text, nullable = False)
     name = db.Column(db.String(100), nullable = False)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable = False)
     creator = db.relationship('User', backref = 'created_landmarks')
 
+    @validates('latitude', 'longitude')
+    def validate_coordinate(self, key, value):
+        '''Accept coordinates as signed degrees, or in the NESW format (e.g. "38.7436 N") landmarks used to be stored in'''
+        value = Landmark.parse_coordinate(value) if isinstance(value, str) else float(value)
+        limit = 90 if key == 'latitude' else 180
+        if not -limit <= value <= limit:
+            raise ValueError(f"{key} must be between -{limit} and {limit} degrees")
+
+        latitude, longitude = (value, self.longitude) if key == 'latitude' else (self.latitude, value)
+        if latitude is not None and longitude is not None:
+            self.grid_cell = Landmark.get_grid_cell(latitude, longitude)
+        return value
+
+    @classmethod
+    def get_grid_row(cls, latitude):
+        '''The row of grid cells a latitude falls in, counting north from the south pole'''
+        return min(int(floor((latitude + 90) / LANDMARK_GRID_DEGREES)), int(round(180 / LANDMARK_GRID_DEGREES)) - 1)
+
+    @classmethod
+    def get_grid_column(cls, longitude):
+        '''The column of grid cells a longitude falls in, counting east from the antimeridian'''
+        return int(floor((longitude + 180) / LANDMARK_GRID_DEGREES)) % LANDMARK_GRID_COLUMNS
+
+    @classmethod
+    def get_grid_cell(cls, latitude, longitude):
+        '''The grid cell a coordinate falls in, cells are numbered along each row so a row's cells form a contiguous range'''
+        return Landmark.get_grid_row(latitude) * LANDMARK_GRID_COLUMNS + Landmark.get_grid_column(longitude)
+
+    @classmethod
+    def get_grid_cell_ranges(cls, latitude, longitude, radius):
+        '''The (first, last) grid cells, one range per row, covering every point within radius meters of a coordinate'''
+        latitude_delta = degrees(radius / EARTH_RADIUS_METERS)
+        first_row = Landmark.get_grid_row(max(latitude - latitude_delta, -90))
+        last_row = Landmark.get_grid_row(min(latitude + latitude_delta, 90))
+
+        # the widest row of the circle is at the latitude furthest from the equator
+        widest_latitude = min(abs(latitude) + latitude_delta, 90)
+        if widest_latitude >= 90 or latitude_delta / cos(radians(widest_latitude)) >= 180:
+            columns = [(0, LANDMARK_GRID_COLUMNS - 1)]
+        else:
+            longitude_delta = latitude_delta / cos(radians(widest_latitude))
+            first_column = Landmark.get_grid_column(longitude - longitude_delta)
+            last_column = Landmark.get_grid_column(longitude + longitude_delta)
+            if first_column <= last_column:
+                columns = [(first_column, last_column)]
+            else:
+                # wraps around the antimeridian
+                columns = [(first_column, LANDMARK_GRID_COLUMNS - 1), (0, last_column)]
+
+        return [(row * LANDMARK_GRID_COLUMNS + first, row * LANDMARK_GRID_COLUMNS + last)
+        for row in range(first_row, last_row + 1) for first, last in columns]
+
+    @classmethod
+    def parse_coordinate(cls, value):
+        '''A method for converting a coordinate string ("38.7436 N", "38.7436°N" or "-38.7436") into signed degrees'''
+        value = value.replace(u"\N{DEGREE SIGN}", "").replace(" ", "").upper()
+        direction = value[-1:] if value[-1:] in ('N', 'S', 'E', 'W') else ''
+        degrees = float(value[:-1] if direction else value)
+        return -degrees if direction in ('S', 'W') else degrees
+
+    @property
+    def latitude_display(self):
+        '''The latitude in NESW format, e.g. 38.743600 N'''
+        return f"{abs(self.latitude):09.6f} {'N' if self.latitude >= 0 else 'S'}"
+
+    @property
+    def longitude_display(self):
+        '''The longitude in NESW format, e.g. 109.499300 W'''
+        return f"{abs(self.longitude):010.6f} {'E' if self.longitude >= 0 else 'W'}"
+
     def get_latitude(self):
-        '''A method for taking one GPS format (NESW), and converting it into another (radial)'''
-        parsed_lat = self.latitude.split(' ')
-        latitude = float(parsed_lat[0])
-        return latitude if parsed_lat[1].upper() == 'N' else -1 * latitude
+        '''The latitude in signed degrees'''
+        return self.latitude
 
     def get_longitude(self):
-        '''A method for taking one GPS format (NESW), and converting it into another (radial)'''
-        parsed_long = self.longitude.split(' ')
-        longitude = float(parsed_long[0])
-        return longitude if parsed_long[1].upper() == 'E' else -1 * longitude
+        '''The longitude in signed degrees'''
+        return self.longitude
 
     def get_latitude_int(self):
         '''A method for grabbing a coarser GPS representation (integer) instead of float.'''
@@ -580,6 +1325,23 @@ class Landmark(db.Model):
         '''A method for extracting gps coordinates in the correct format'''
         return [self.get_longitude(),self.get_latitude()]
 
+    def to_json(self):
+        s = self
+        return {
+        "id": s.id,
+        "name": s.name,
+        "latitude": s.latitude,
+        "longitude": s.longitude,
+        "img_url": s.img_url,
+        "created_by": s.created_by
+        }
+
+    @classmethod
+    def within_bounds(cls, latitude_min, longitude_min, latitude_max, longitude_max):
+        '''A query for the landmarks inside a bounding box, which uses the latitude/longitude index'''
+        return Landmark.query.filter(Landmark.latitude.between(latitude_min, latitude_max),
+        Landmark.longitude.between(longitude_min, longitude_max))
+
     @classmethod 
     def format_lat_long(cls, latitude, longitude):
         '''A method to ensure the precision is correct on GPS coordinates'''
@@ -620,6 +1382,39 @@ class Landmark(db.Model):
         admin_ids = db.session.query(Admin.user_id).all()
         return Landmark.query.filter(Landmark.created_by.in_(admin_ids)).all()
 
+    @classmethod
+    def get_visible_landmarks(cls, user):
+        '''A query for the landmarks a user can see: official landmarks when logged out, everything for admins,
+        otherwise landmarks created by the user, the users they follow, or an admin'''
+        admin_ids = db.session.query(Admin.user_id)
+        if not user:
+            return Landmark.query.filter(Landmark.created_by.in_(admin_ids))
+        if user.is_admin():
+            return Landmark.query
+        valid_ids = [user.id] + [followed.id for followed in user.following]
+        return Landmark.query.filter(or_(Landmark.created_by.in_(valid_ids), Landmark.created_by.in_(admin_ids)))
+
+    @classmethod
+    def find_nearby(cls, latitude, longitude, radius, query = None, limit = 50):
+        '''The landmarks (from query, all landmarks by default) within radius meters of a coordinate, returns up to limit
+        (landmark, distance in meters) pairs sorted by distance
+
+        Only the id and coordinates of the landmarks in the grid cells around the coordinate are loaded to measure distances.
+        '''
+        from geo import haversine_distances
+        query = Landmark.query if query is None else query
+        cells = [Landmark.grid_cell.between(first, last) for first, last in Landmark.get_grid_cell_ranges(latitude, longitude, radius)]
+        candidates = query.filter(or_(*cells)).with_entities(Landmark.id, Landmark.latitude, Landmark.longitude).all()
+        if not candidates:
+            return []
+
+        ids, latitudes, longitudes = zip(*candidates)
+        distances = haversine_distances([latitude], [longitude], latitudes, longitudes)[0]
+        nearest = sorted((distance, landmark_id) for landmark_id, distance in zip(ids, distances.tolist()) if distance <= radius)[:limit]
+
+        landmarks = {landmark.id: landmark for landmark in Landmark.query.filter(Landmark.id.in_([landmark_id for distance, landmark_id in nearest]))}
+        return [(landmarks[landmark_id], distance) for distance, landmark_id in nearest]
+
 
 
 class Gear(db.Model):
@@ -686,62 +1481,128 @@ class UserGear(db.Model):
 
 class GPXHandler():
     '''A class for handling .gpx files and convenience functions'''
+
+    # zoom levels : meters per pixel (taken from MAPBOX api)
+    ZOOM_LEVELS = {"0": 60000,
+    "1": 30000,
+    "2": 15000,
+    "3": 7500,
+    "4": 4000,
+    "5": 1900,
+    "6": 1000,
+    "7": 500,
+    "8": 250,
+    "9": 120,
+    "10":60,
+    "11":30,
+    "12":15,
+    "13":7.5,
+    "14":4,
+    "15":2,
+    "16":1,
+    "17":0.5,
+    "18":0.299,
+    "19":0.149,
+    "20":0.075,
+    "21":0.037,
+    "22":0.019}
+
     def __init__(self, activity):
         self.gpx_filename = activity.gps_file
 
-        self.map_options = self.construct_map_options_from_gpx()
-        self.statistics = self.compute_statistics_from_gpx()
-        pass
+        from analytics import summarize_track
+        track = summarize_track(activity.get_track(), **GPXHandler.elevation_options())
+        self.statistics = self.compute_statistics_from_track(track)
+        self.map_options = self.construct_map_options_from_track(track)
 
-    def compute_statistics_from_gpx(self):
-        '''A method for computing any relevant activity statistics from a gpx file'''
-        gpx_filename = self.gpx_filename 
-        statistics =dict()
-        with open(gpx_filename, 'r') as f:
-            gpx = gpxpy.parse(f)
-            duration_in_seconds = int(gpx.get_duration())
-            minutes = duration_in_seconds / 60
-            seconds = floor(duration_in_seconds % 60)
-            hours = floor(minutes / 60)
-            minutes_remaining = floor(minutes % 60)
-            duration = f'{hours}:{minutes_remaining}:{seconds}'
-            statistics['duration'] = duration
-            climb_descent = gpx.get_uphill_downhill()
-            statistics['climb'] = int(climb_descent[0])
-            statistics['descent'] = int(climb_descent[1])
-            extreme_elevations = gpx.get_elevation_extremes()
-            statistics['min_elevation'] = int(extreme_elevations[0])
-            statistics['max_elevation'] = int(extreme_elevations[1])
+    @classmethod
+    def elevation_options(cls):
+        '''The elevation cleaning settings for summarize_track, from the app config (see analytics.py for what each does)'''
+        import analytics
+        return {
+        "spike_threshold": current_app.config.get('ELEVATION_SPIKE_THRESHOLD', analytics.ELEVATION_SPIKE_THRESHOLD),
+        "smoothing_window": current_app.config.get('ELEVATION_SMOOTHING_WINDOW', analytics.ELEVATION_SMOOTHING_WINDOW),
+        "hysteresis": current_app.config.get('ELEVATION_HYSTERESIS', analytics.ELEVATION_HYSTERESIS)
+        }
+
+    def compute_statistics_from_track(self, track):
+        '''A method for formatting the relevant activity statistics computed from a gpx file'''
+        statistics = dict()
+        statistics['duration_seconds'] = track['duration_seconds']
+        statistics['duration'] = GPXHandler.format_duration(track['duration_seconds'])
+        statistics['moving_seconds'] = track['moving_seconds']
+        statistics['moving_time'] = GPXHandler.format_duration(track['moving_seconds'])
+        statistics['distance_meters'] = track['distance']
+        statistics['distance'] = GPXHandler.format_distance(track['distance'])
+        statistics['average_speed_mps'] = track['average_speed']
+        statistics['average_speed'] = GPXHandler.format_speed(track['average_speed'])
+        statistics['max_speed_mps'] = track['max_speed']
+        statistics['max_speed'] = GPXHandler.format_speed(track['max_speed'])
+        statistics['splits_km'] = track['splits_km']
+        statistics['splits_mile'] = track['splits_mile']
+        statistics['climb'] = int(round(track['climb']))
+        statistics['descent'] = int(round(track['descent']))
+        statistics['min_elevation'] = None if track['min_elevation'] is None else int(track['min_elevation'])
+        statistics['max_elevation'] = None if track['max_elevation'] is None else int(track['max_elevation'])
         return statistics
 
-    def construct_map_options_from_gpx(self):
+    @classmethod
+    def format_duration(cls, duration_in_seconds):
+        '''A method for displaying a duration in seconds as hours:minutes:seconds'''
+        minutes = duration_in_seconds / 60
+        seconds = floor(duration_in_seconds % 60)
+        hours = floor(minutes / 60)
+        minutes_remaining = floor(minutes % 60)
+        return f'{hours}:{minutes_remaining}:{seconds}'
+
+    @classmethod
+    def format_distance(cls, meters):
+        '''A method for displaying a distance in meters as kilometers and miles'''
+        if meters is None:
+            return '-'
+        return f'{meters / 1000:.2f} km ({meters / 1609.344:.2f} mi)'
+
+    @classmethod
+    def format_speed(cls, meters_per_second):
+        '''A method for displaying a speed in meters per second as km/h and mph'''
+        if meters_per_second is None:
+            return '-'
+        return f'{meters_per_second * 3.6:.1f} km/h ({meters_per_second * 3600 / 1609.344:.1f} mph)'
+
+    @classmethod
+    def format_splits(cls, splits, unit):
+        '''A method for displaying [distance, seconds] splits, with the pace of partial splits scaled to a full unit'''
+        unit_meters = 1000 if unit == 'km' else 1609.344
+        formatted = []
+        for number, (distance, seconds) in enumerate(splits, start = 1):
+            formatted.append({
+            "number": number,
+            "distance": f"{distance / unit_meters:.2f} {unit}",
+            "time": GPXHandler.format_duration(seconds),
+            "pace": f"{GPXHandler.format_duration(seconds * unit_meters / distance)} /{unit}"
+            })
+        return formatted
+
+    def construct_map_options_from_track(self, track):
         '''A method for creating the map_options object needed to display the activity on a map'''
-        gpx_filename = self.gpx_filename
-        with open(gpx_filename,'r') as f:
-            gpx = gpxpy.parse(f)
-            bounds = gpx.get_bounds()
-            minlat, minlong, maxlat, maxlong = bounds.min_latitude, bounds.min_longitude, bounds.max_latitude, bounds.max_longitude
-            max_map_extent = GPXHandler.compute_map_distance(minlat, minlong, maxlat, maxlong)
-            zoom = GPXHandler.compute_map_zoom(max_map_extent)
-
-            map_options = dict()
-            map_options["longitude_min"] = minlong
-            map_options["latitude_min"]  = minlat
-            map_options["longitude_max"] = maxlong
-            map_options["latitude_max"]  = maxlat
-            map_options['latitude_center']  = (minlat + maxlat)/2
-            map_options['longitude_center'] = (minlong + maxlong)/2
-            map_options['zoom'] = zoom
-
-            map_options = adjust_map_options_boundaries(map_options)
-            self.convert_gpx_to_json(gpx_filename)
-
-            with open(gpx_filename.replace('.gpx', '.json')) as file:
-                json_data =json.load(file)
-
-            map_options['coordinates'] = self.convert_json_to_coordinates(json_data)
-            
+        minlat, minlong, maxlat, maxlong = track['latitude_min'], track['longitude_min'], track['latitude_max'], track['longitude_max']
+        max_map_extent = GPXHandler.compute_map_distance(minlat, minlong, maxlat, maxlong)
+        zoom = GPXHandler.compute_map_zoom(max_map_extent)
+
+        map_options = dict()
+        map_options["longitude_min"] = minlong
+        map_options["latitude_min"]  = minlat
+        map_options["longitude_max"] = maxlong
+        map_options["latitude_max"]  = maxlat
+        map_options['latitude_center']  = (minlat + maxlat)/2
+        map_options['longitude_center'] = (minlong + maxlong)/2
+        map_options['zoom'] = zoom
+
+        map_options = adjust_map_options_boundaries(map_options)
+        map_options['coordinates'] = track['coordinates']
+        map_options['preview_coordinates'] = GPXHandler.simplify_coordinates(track['coordinates'], zoom)
         return map_options
+
     @classmethod 
     def compute_map_distance(cls, min_lat, min_long, max_lat, max_long):
         '''Used to compute the size we need for displaying a map that covers specific gps points'''
@@ -761,76 +1622,47 @@ class GPXHandler():
 
         return max(map_width, map_height)
 
-    @classmethod 
-    def compute_distance_between_two_points(cls, point1, point2):
-        '''Used to compute the distance between two points on a map given lat/long'''
-        # https://www.geeksforgeeks.org/program-distance-two-points-earth/
-
-        # convert lat long to radians (long, lat, long, lat)
-        coordinate_array_degrees = [point1[1], point1[0], point2[1], point2[0]]
-        ca_radians = [deg * pi / 180 for deg in coordinate_array_degrees]
-
-        # Compute vertical and horizontal extent using fixed average values in the perpendicular direction, computed in meters
-        distance = abs(1000 * 1.609344 * 3963.0 * acos((sin(ca_radians[1]) * sin(ca_radians[3])) + cos(ca_radians[1]) * cos(ca_radians[3]) * cos(ca_radians[2] - ca_radians[0])))
-        return distance
-
     @classmethod
     def compute_map_zoom(cls, max_map_extent):
         '''A method for computing which map zoom to start a map on (approximately)'''
         # max extent should be in meters
-
-        # zoom levels : meters per pixel (taken from MAPBOX api)
-        zoom_levels = {"0": 60000,
-        "1": 30000,
-        "2": 15000,
-        "3": 7500,
-        "4": 4000,
-        "5": 1900,
-        "6": 1000,
-        "7": 500,
-        "8": 250,
-        "9": 120,
-        "10":60,
-        "11":30,
-        "12":15,
-        "13":7.5,
-        "14":4,
-        "15":2,
-        "16":1,
-        "17":0.5,
-        "18":0.299,
-        "19":0.149,
-        "20":0.075,
-        "21":0.037,
-        "22":0.019}
-
         zoom = 22
         NUM_PIXELS = 512
         while zoom > -1:
-            meters_per_pixel = zoom_levels[f"{zoom}"]
+            meters_per_pixel = GPXHandler.meters_per_pixel(zoom)
             map_size = NUM_PIXELS * meters_per_pixel
             if max_map_extent < map_size:
                 return zoom
             else:
                 zoom -= 1
         pass
-        
-    def convert_gpx_to_json(self, input_filename):
-        '''A method for converting gpx to json, and storing the resulting file on the filesystem'''
-        output_filename = input_filename.replace('.gpx', '.json')
-        Converter(input_file=f'{input_filename}').gpx_to_json(output_file=output_filename)
-        pass
 
-    def convert_json_to_coordinates(self, json_obj):
-        '''A method for extracting a coordinate list from the JSON file representation of the original .GPX file'''
-        latitudes = json_obj['latitude']
-        longitudes = json_obj['longitude']
-        times = json_obj['time']
-        altitudes=json_obj['altitude']
+    @classmethod
+    def meters_per_pixel(cls, zoom):
+        '''A method for looking up the (approximate) map resolution at a zoom level'''
+        return GPXHandler.ZOOM_LEVELS[f"{min(max(zoom, 0), 22)}"]
 
-        coordinates = [[long, lat] for long, lat in zip(longitudes.values(), latitudes.values())]
+    @classmethod
+    def encode_coordinates(cls, coordinates):
+        '''A method for converting a list of [longitude, latitude] pairs into a compact encoded polyline'''
+        if not coordinates:
+            return ''
+        import numpy as np
+        from tracks import encode_polyline
+        longitudes, latitudes = np.asarray(coordinates, dtype = np.float64).T
+        return encode_polyline(latitudes, longitudes)
 
-        return coordinates
+    @classmethod
+    def simplify_coordinates(cls, coordinates, zoom):
+        '''A method for dropping the points of a track that cannot be seen at a map zoom level'''
+        if not coordinates:
+            return coordinates
+        import numpy as np
+        from tracks import simplify_track
+        tolerance = GPXHandler.meters_per_pixel(zoom) * PREVIEW_PIXEL_TOLERANCE
+        longitudes, latitudes = np.asarray(coordinates, dtype = np.float64).T
+        keep = simplify_track(latitudes, longitudes, tolerance)
+        return [coordinate for coordinate, kept in zip(coordinates, keep) if kept]
 
 
 #### SETUP AWS, code generally formatted based on code from boto3
@@ -843,11 +1675,11 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     :return: Presigned URL as string. If error, returns None.
     """
 
+    from botocore.exceptions import ClientError
+    from s3 import get_s3_client
+
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3',
-    aws_access_key_id=current_app.config['SOKA_PRESIGNED_URL_ACCESS_KEY'],
-    aws_secret_access_key=current_app.config['SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY']
-    )
+    s3_client = get_s3_client()
 
     try:
         response = s3_client.generate_presigned_url('get_object',
@@ -860,25 +1692,3 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
 
     # The response contains the presigned URL
     return response
-
-def upload_user_image_to_S3(file, bucket_name, filename, content_type):
-    """
-    Docs: http://boto3.readthedocs.io/en/latest/guide/s3.html
-    """
-    try:
-        s3 = boto3.client(
-        "s3",
-        aws_access_key_id=current_app.config['SOKA_PRESIGNED_URL_ACCESS_KEY'],
-        aws_secret_access_key=current_app.config['SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY']
-        )
-        s3.upload_fileobj(
-            file,
-            bucket_name,
-            filename,
-            ExtraArgs={
-                "ContentType": content_type    #Set appropriate content type as per the file
-            }
-        )
-    except Exception as e:
-        return e
-    return filename
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""Recompute Activity.was_successful for every attempt at a challenge, e.g. after its landmarks change, and which activities
+completed it (the activities_completed_challenges rows found by Activity.match_challenges).
+
+Tracks are checked in a pool of worker processes, and the results are written back in batches. Run it with:
+
+    flask revalidate-challenge <challenge_id>
+
+or enqueue a 'revalidate_challenge' job.
+"""
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from models import db, Activity, ActivityCompletedChallenge, Challenge, LANDMARK_RADIUS
+from storage import get_storage
+
+# number of activities whose results are written back per UPDATE batch
+BATCH_SIZE = 500
+
+# below this many tracks, starting worker processes costs more than it saves
+MIN_PARALLEL_ACTIVITIES = 16
+
+
+def validate_track(storage, gps_file, latitudes, longitudes, radius = LANDMARK_RADIUS):
+    '''Determine if a gps track (in storage, see storage.py) passes within radius meters of every landmark.
+    Needs no database/app, so it can run in a worker process.'''
+    from tracks import load_stored_track
+    from geo import GridIndex
+    track = load_stored_track(storage, gps_file)
+    index = GridIndex(track.latitude, track.longitude, cell_size = radius)
+    return bool(index.targets_within_radius(latitudes, longitudes, radius).all())
+
+def validate_task(task):
+    '''Run validate_track for one (storage, activity_id, gps_file, latitudes, longitudes, radius) task, returns (activity_id, was_successful)
+
+    was_successful is None if the track could not be read (e.g. S3 refused or couldn't find it), so the stored result is left alone.
+    '''
+    from botocore.exceptions import ClientError
+    storage, activity_id, gps_file, latitudes, longitudes, radius = task
+    try:
+        return activity_id, validate_track(storage, gps_file, latitudes, longitudes, radius)
+    except (OSError, ValueError, ClientError):
+        logging.exception(f"Could not revalidate activity {activity_id} from {gps_file}")
+        return activity_id, None
+
+def write_results(results, challenge_id = None, attempt_ids = None, completed_ids = None):
+    '''Store a batch of (activity_id, was_successful) results in a single executemany UPDATE
+
+    With a challenge_id, the results are also whether each activity completed the challenge: its activities_completed_challenges
+    row is added or removed, completed_ids are the activities that already have one. Only the activities in attempt_ids
+    attempted it, and have their was_successful updated.
+    '''
+    mappings = [{"id": activity_id, "was_successful": was_successful} for activity_id, was_successful in results
+    if attempt_ids is None or activity_id in attempt_ids]
+    if mappings:
+        db.session.bulk_update_mappings(Activity, mappings)
+    if challenge_id is not None:
+        added = [{"activity_id": activity_id, "challenge_id": challenge_id} for activity_id, completed in results
+        if completed and activity_id not in completed_ids]
+        removed = [activity_id for activity_id, completed in results if not completed and activity_id in completed_ids]
+        if added:
+            db.session.bulk_insert_mappings(ActivityCompletedChallenge, added)
+        if removed:
+            ActivityCompletedChallenge.query.filter(ActivityCompletedChallenge.challenge_id == challenge_id,
+            ActivityCompletedChallenge.activity_id.in_(removed)).delete(synchronize_session = False)
+    db.session.commit()
+    return len(results)
+
+def revalidate_challenge(challenge_id, processes = None, batch_size = BATCH_SIZE):
+    '''Recompute was_successful for every activity attempting a challenge, and whether the activities that attempted or
+    completed it still complete it. Returns the number of activities updated.'''
+    challenge = Challenge.query.get(challenge_id)
+    if challenge is None:
+        return 0
+
+    attempts = db.session.query(Activity.id, Activity.gps_file).filter(Activity.challenge_id == challenge.id).all()
+
+    # same rules as Activity.validate_activity
+    if challenge.name == 'None':
+        return write_results([(activity_id, True) for activity_id, gps_file in attempts])
+
+    # activities can complete a challenge they didn't attempt (see Activity.match_challenges), those are checked again too
+    attempt_ids = {activity_id for activity_id, gps_file in attempts}
+    completed_ids = {activity_id for (activity_id,) in db.session.query(ActivityCompletedChallenge.activity_id
+    ).filter(ActivityCompletedChallenge.challenge_id == challenge.id)}
+    if completed_ids - attempt_ids:
+        attempts += db.session.query(Activity.id, Activity.gps_file).filter(Activity.id.in_(completed_ids - attempt_ids)).all()
+
+    if not challenge.landmarks:
+        # every track attempting it succeeds, but match_challenges never finds a challenge without landmarks
+        write_results([(activity_id, False) for activity_id, gps_file in attempts], challenge.id, set(), completed_ids)
+        return write_results([(activity_id, bool(gps_file)) for activity_id, gps_file in attempts if activity_id in attempt_ids])
+    results = [(activity_id, False) for activity_id, gps_file in attempts if not gps_file]
+
+    latitudes = [landmark.get_latitude() for landmark in challenge.landmarks]
+    longitudes = [landmark.get_longitude() for landmark in challenge.landmarks]
+    storage = get_storage()
+    tasks = [(storage, activity_id, gps_file, latitudes, longitudes, LANDMARK_RADIUS) for activity_id, gps_file in attempts if gps_file]
+
+    processes = processes or os.cpu_count() or 1
+    updated = 0
+    if processes > 1 and len(tasks) >= MIN_PARALLEL_ACTIVITIES:
+        pool = ProcessPoolExecutor(max_workers = processes)
+        task_results = pool.map(validate_task, tasks, chunksize = max(1, len(tasks) // (processes * 4)))
+    else:
+        pool = None
+        task_results = map(validate_task, tasks)
+
+    try:
+        for activity_id, was_successful in task_results:
+            if was_successful is None:
+                continue
+            results.append((activity_id, was_successful))
+            if len(results) >= batch_size:
+                updated += write_results(results, challenge.id, attempt_ids, completed_ids)
+                results = []
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return updated + write_results(results, challenge.id, attempt_ids, completed_ids)
@@ -0,0 +1,199 @@
+"""S3 access shared by the app: one client per process, concurrent uploads, and presigned urls for the images stored in
+S3, cached so a page showing many images doesn't sign each one on every render."""
+
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+# connections a client keeps open to S3, each can be overridden with the app.config key of the same name.
+# S3_MAX_ATTEMPTS is botocore's retries of a failed request, after the first attempt
+S3_MAX_POOL_CONNECTIONS = 10
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 30
+S3_MAX_ATTEMPTS = 3
+
+# uploads run on at most this many threads at once, and each is attempted this many times, waiting
+# S3_UPLOAD_RETRY_DELAY seconds (doubling every attempt) in between. The retries are only made here, by a client that
+# botocore doesn't retry with (see get_s3_upload_client)
+S3_UPLOAD_WORKERS = 8
+S3_UPLOAD_ATTEMPTS = 3
+S3_UPLOAD_RETRY_DELAY = 0.5
+
+# how long a presigned url stays valid
+PRESIGNED_URL_EXPIRATION = 3600
+# a cached url is signed again this many seconds before it expires, so a page is never rendered with an url that
+# expires before the browser (or its cache) is done loading it
+PRESIGNED_URL_MARGIN = 600
+# the least recently used urls are dropped past this many
+PRESIGNED_URL_CACHE_SIZE = 10000
+
+
+class S3ClientManager():
+    '''Builds boto3 S3 clients once per process and set of options, and hands the same client to every caller
+
+    Building a client loads botocore's service models and sets up credentials and a connection pool, so it is done the
+    first time a client is needed rather than per call or at import. Clients are thread safe once built, building them
+    isn't, so that is done under a lock. A forked process (e.g. a ProcessPoolExecutor worker) builds its own.
+    '''
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_client(self, aws_access_key_id = None, aws_secret_access_key = None, endpoint_url = None, region_name = None,
+        max_pool_connections = S3_MAX_POOL_CONNECTIONS, connect_timeout = S3_CONNECT_TIMEOUT, read_timeout = S3_READ_TIMEOUT,
+        max_attempts = S3_MAX_ATTEMPTS):
+        '''The client for these options, endpoint_url points it at another S3 implementation (minio, moto's server)'''
+        options = (aws_access_key_id, aws_secret_access_key, endpoint_url, region_name, max_pool_connections, connect_timeout,
+        read_timeout, max_attempts)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            client = self._clients.get(options)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                session = boto3.session.Session()
+                client = self._clients[options] = session.client('s3',
+                aws_access_key_id = aws_access_key_id,
+                aws_secret_access_key = aws_secret_access_key,
+                endpoint_url = endpoint_url,
+                region_name = region_name,
+                config = Config(max_pool_connections = max_pool_connections, connect_timeout = connect_timeout,
+                read_timeout = read_timeout, retries = {"max_attempts": max_attempts}))
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+client_manager = S3ClientManager()
+
+def get_client_options(config):
+    '''The S3ClientManager.get_client options set by an app config'''
+    return {
+    "aws_access_key_id": config.get('SOKA_PRESIGNED_URL_ACCESS_KEY'),
+    "aws_secret_access_key": config.get('SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY'),
+    "endpoint_url": config.get('S3_ENDPOINT_URL'),
+    "region_name": config.get('S3_REGION'),
+    "max_pool_connections": config.get('S3_MAX_POOL_CONNECTIONS', S3_MAX_POOL_CONNECTIONS),
+    "connect_timeout": config.get('S3_CONNECT_TIMEOUT', S3_CONNECT_TIMEOUT),
+    "read_timeout": config.get('S3_READ_TIMEOUT', S3_READ_TIMEOUT),
+    "max_attempts": config.get('S3_MAX_ATTEMPTS', S3_MAX_ATTEMPTS)
+    }
+
+def get_s3_client():
+    '''The shared S3 client of the current app'''
+    return client_manager.get_client(**get_client_options(current_app.config))
+
+def get_s3_upload_client():
+    '''The shared S3 client of the current app for upload_objects, which retries failed uploads itself, so botocore doesn't'''
+    return client_manager.get_client(**dict(get_client_options(current_app.config), max_attempts = 0))
+
+
+def upload_with_retries(client, bucket, key, data, content_type = None, attempts = S3_UPLOAD_ATTEMPTS, retry_delay = S3_UPLOAD_RETRY_DELAY):
+    '''Upload bytes to S3, trying again after a failure, returns None once uploaded or the last attempt's exception'''
+    extra = {"ContentType": content_type} if content_type else {}
+    for attempt in range(attempts):
+        try:
+            client.upload_fileobj(io.BytesIO(data), bucket, key, ExtraArgs = extra)
+            return None
+        except Exception as e:
+            logging.warning(f"Uploading {key} to {bucket} failed (attempt {attempt + 1} of {attempts}): {e}")
+            error = e
+            if attempt + 1 < attempts:
+                time.sleep(retry_delay * 2 ** attempt)
+    return error
+
+def upload_objects(client, bucket, uploads, max_workers = S3_UPLOAD_WORKERS, attempts = S3_UPLOAD_ATTEMPTS,
+    retry_delay = S3_UPLOAD_RETRY_DELAY):
+    '''Upload (key, bytes, content type) objects concurrently on a bounded thread pool, so uploading takes about as long as
+    the slowest object rather than the sum. Returns {key: None once uploaded, or the exception of its last attempt}.
+
+    Clients are thread safe, so the threads share the one passed in. Of objects with the same key, the last one is uploaded.
+    '''
+    objects = {key: (data, content_type) for key, data, content_type in uploads}
+    if not objects:
+        return {}
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(objects))) as pool:
+        futures = {key: pool.submit(upload_with_retries, client, bucket, key, data, content_type, attempts, retry_delay)
+        for key, (data, content_type) in objects.items()}
+    return {key: future.result() for key, future in futures.items()}
+
+
+class PresignedUrlCache():
+    '''Presigned urls by (bucket, key, size), each kept until PRESIGNED_URL_MARGIN seconds before it expires
+
+    sign(bucket, key, expiration) creates an url, it only computes a signature and makes no requests. The cache is
+    shared by a process' threads.
+    '''
+    def __init__(self, sign, expiration = PRESIGNED_URL_EXPIRATION, margin = PRESIGNED_URL_MARGIN,
+        max_entries = PRESIGNED_URL_CACHE_SIZE, clock = time.monotonic):
+        if margin >= expiration:
+            raise ValueError("The margin must be shorter than the expiration, or cached urls would already have expired")
+        self.sign = sign
+        self.expiration = expiration
+        self.time_to_live = expiration - margin
+        self.max_entries = max_entries
+        self.clock = clock
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket, key, size = None):
+        '''A presigned url for an object, valid for at least the margin. None if it could not be signed.'''
+        cache_key = (bucket, key, size)
+        now = self.clock()
+        with self._lock:
+            cached = self._urls.get(cache_key)
+            if cached is not None and cached[1] > now:
+                self._urls.move_to_end(cache_key)
+                return cached[0]
+
+        url = self.sign(bucket, key, self.expiration)
+        if url is None:
+            return None
+        with self._lock:
+            self._urls[cache_key] = (url, now + self.time_to_live)
+            self._urls.move_to_end(cache_key)
+            self.evict(now)
+        return url
+
+    def evict(self, now):
+        '''Drop the least recently used urls past max_entries, and the expired ones among the least recently used. Called
+        with the lock held.
+
+        Only the front of the (least recently used first) order is looked at, so a miss doesn't scan every entry. An
+        expired url further back is replaced by get when it is next looked up, or dropped once it reaches the front.
+        '''
+        while self._urls:
+            url, expires_at = next(iter(self._urls.values()))
+            if expires_at > now and len(self._urls) <= self.max_entries:
+                break
+            self._urls.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+    def __len__(self):
+        return len(self._urls)
+
+
+def get_presigned_url_cache():
+    '''The presigned url cache of the current app, created once'''
+    cache = current_app.extensions.get('presigned_urls')
+    if cache is None:
+        from models import create_presigned_url
+        cache = current_app.extensions['presigned_urls'] = PresignedUrlCache(create_presigned_url)
+    return cache
+
+def get_presigned_url(bucket, key, size = None):
+    '''A cached presigned url to display an S3 object, see PresignedUrlCache'''
+    return get_presigned_url_cache().get(bucket, key, size)
@@ -0,0 +1,309 @@
+"""Where gpx files and the files derived from them (track sidecars, thumbnails) are kept.
+
+Files are addressed by keys, the relative paths stored in e.g. Activity.gps_file ("./gpx_files/blobs/6f/6f70...gpx.gz").
+The backend is picked by app.config['TRACK_STORAGE']:
+
+    'local'  files in a directory on this machine (TRACK_STORAGE_ROOT, the working directory by default)
+    's3'     files in an S3 bucket (TRACK_STORAGE_BUCKET, under TRACK_STORAGE_PREFIX), with a local disk cache
+             (TRACK_CACHE_DIRECTORY, at most TRACK_CACHE_MAX_BYTES) so each node downloads a file once rather than on every view
+
+Every backend has the same methods: exists, exists_remotely, get_local_path, open, download, put_file, put_bytes, delete
+and list_keys. exists is enough to read a file, writes that are skipped when a file is already stored check exists_remotely,
+since a node's cache can still hold a file another node deleted.
+"""
+
+import os
+import posixpath
+import shutil
+import threading
+
+from flask import current_app
+
+DEFAULT_CACHE_DIRECTORY = '/tmp/soka-track-cache'
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# the cache directory is scanned (and the least recently used files evicted) once a process has added this fraction of
+# max_bytes since its last scan, or its running total is over max_bytes
+CACHE_SCAN_FRACTION = 1 / 16
+
+
+def normalize_key(key):
+    '''Turn a stored path into a storage key ("./gpx_files/1.gpx" -> "gpx_files/1.gpx"), keys can't leave the storage'''
+    normalized = posixpath.normpath(key.replace('\\', '/'))
+    if normalized.startswith('/') or normalized == '..' or normalized.startswith('../') or normalized == '.':
+        raise ValueError(f"Invalid storage key {key}")
+    return normalized
+
+def get_folder_key(folder):
+    '''The key of a folder files are saved in as "./{folder}/...", which is relative even when folder starts with a /'''
+    return normalize_key(f"./{folder}")
+
+def temporary_path(path):
+    '''A name to write a file under before moving it into place, unique to this process and thread'''
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+class LocalStorage():
+    '''Files in a directory on this machine'''
+    def __init__(self, root = '.'):
+        self.root = root
+
+    def get_local_path(self, key):
+        '''The absolute path of the file on this machine, files are read there directly'''
+        return os.path.abspath(os.path.join(self.root, normalize_key(key)))
+
+    def exists(self, key):
+        return os.path.isfile(self.get_local_path(key))
+
+    def exists_remotely(self, key):
+        return self.exists(key)
+
+    def open(self, key):
+        return open(self.get_local_path(key), 'rb')
+
+    def download(self, key, filename):
+        shutil.copyfile(self.get_local_path(key), filename)
+
+    def put_file(self, key, filename):
+        '''Move a local file into storage'''
+        path = self.get_local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        try:
+            os.replace(filename, path)
+        except OSError:
+            # from another file system, copy it next to its destination first so it still appears all at once
+            temporary = temporary_path(path)
+            shutil.copyfile(filename, temporary)
+            os.replace(temporary, path)
+            os.remove(filename)
+
+    def put_bytes(self, key, data, content_type = None):
+        path = self.get_local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temporary = temporary_path(path)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_keys(self, prefix):
+        '''The keys starting with prefix, prefix is a directory followed by the start of a filename'''
+        if prefix.endswith('/'):
+            directory, start = normalize_key(prefix), ''
+        else:
+            directory, start = posixpath.split(normalize_key(prefix))
+        try:
+            names = os.listdir(os.path.join(self.root, directory))
+        except FileNotFoundError:
+            return []
+        return [posixpath.join(directory, name) for name in names if name.startswith(start) and not name.endswith('.tmp')]
+
+
+class S3Storage():
+    '''Files in an S3 bucket, under a key prefix. Files have to be downloaded to be read, see CachedStorage.'''
+    def __init__(self, bucket, prefix = '', client_options = None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client_options = client_options or {}
+
+    @property
+    def client(self):
+        '''The process' shared client (see s3.S3ClientManager), so worker processes the storage is passed to build their own'''
+        from s3 import client_manager
+        return client_manager.get_client(**self.client_options)
+
+    def get_object_key(self, key):
+        return self.prefix + normalize_key(key)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket = self.bucket, Key = self.get_object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def exists_remotely(self, key):
+        return self.exists(key)
+
+    def get_local_path(self, key):
+        raise NotImplementedError("S3 files have to be downloaded, wrap the storage in a CachedStorage")
+
+    def open(self, key):
+        '''A file-like object streaming the file from S3'''
+        return self.client.get_object(Bucket = self.bucket, Key = self.get_object_key(key))['Body']
+
+    def download(self, key, filename):
+        self.client.download_file(self.bucket, self.get_object_key(key), filename)
+
+    def put_file(self, key, filename):
+        '''Upload a local file, which is removed once it is stored'''
+        self.client.upload_file(filename, self.bucket, self.get_object_key(key))
+        os.remove(filename)
+
+    def put_bytes(self, key, data, content_type = None):
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.put_object(Bucket = self.bucket, Key = self.get_object_key(key), Body = data, **extra)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket = self.bucket, Key = self.get_object_key(key))
+
+    def list_keys(self, prefix):
+        object_prefix = self.get_object_key(prefix) + ('/' if prefix.endswith('/') else '')
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket = self.bucket, Prefix = object_prefix):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return keys
+
+
+class CachedStorage():
+    '''A remote storage with a local disk cache in front of it, bounded to max_bytes by evicting the least recently used files.
+
+    Files are downloaded the first time this machine reads them and kept when they are written. The cache directory can
+    be shared by all of a node's processes: a file's modification time is its last use, and is updated on every read.
+    Each process keeps a running total of the cache's size instead of scanning it on every write, the files other
+    processes add are counted at the next scan, so the cache can outgrow max_bytes by CACHE_SCAN_FRACTION per process.
+    '''
+    def __init__(self, backend, directory = DEFAULT_CACHE_DIRECTORY, max_bytes = DEFAULT_CACHE_MAX_BYTES):
+        self.backend = backend
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # the cache's size at the last scan (None before the first), and the bytes this process added since
+        self._scanned_bytes = None
+        self._added_bytes = 0
+        self._lock = threading.Lock()
+
+    def get_cache_path(self, key):
+        return os.path.join(self.directory, normalize_key(key))
+
+    def exists(self, key):
+        return os.path.isfile(self.get_cache_path(key)) or self.backend.exists(key)
+
+    def exists_remotely(self, key):
+        '''Whether the backend has the file, whatever this machine's cache holds'''
+        return self.backend.exists(key)
+
+    def get_local_path(self, key):
+        '''The path of the cached copy of a file, downloading it if this machine hasn't got it (or evicted it)'''
+        path = self.get_cache_path(key)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temporary = temporary_path(path)
+        try:
+            self.backend.download(key, temporary)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.added(os.path.getsize(path))
+        return path
+
+    def open(self, key):
+        return open(self.get_local_path(key), 'rb')
+
+    def download(self, key, filename):
+        shutil.copyfile(self.get_local_path(key), filename)
+
+    def put_file(self, key, filename):
+        '''Store a local file, which is kept in the cache'''
+        path = self.get_cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temporary = temporary_path(path)
+        shutil.copyfile(filename, temporary)
+        try:
+            self.backend.put_file(key, filename)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.added(os.path.getsize(path))
+
+    def put_bytes(self, key, data, content_type = None):
+        self.backend.put_bytes(key, data, content_type)
+        path = self.get_cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temporary = temporary_path(path)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        self.added(len(data))
+
+    def delete(self, key):
+        self.backend.delete(key)
+        try:
+            os.remove(self.get_cache_path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_keys(self, prefix):
+        return self.backend.list_keys(prefix)
+
+    def added(self, size):
+        '''Count a file added to the cache, evicting once the cache may have outgrown max_bytes'''
+        with self._lock:
+            self._added_bytes += size
+            due = (self._scanned_bytes is None or self._scanned_bytes + self._added_bytes > self.max_bytes
+            or self._added_bytes >= self.max_bytes * CACHE_SCAN_FRACTION)
+        if due:
+            self.evict()
+
+    def evict(self):
+        '''Remove the least recently used files until the cache fits in max_bytes, returns the number removed'''
+        files = []
+        for directory, subdirectories, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in files)
+        removed = 0
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._scanned_bytes = total
+            self._added_bytes = 0
+        return removed
+
+
+def create_storage(config):
+    '''Build the storage described by an app config, see the module docstring'''
+    kind = config.get('TRACK_STORAGE', 'local')
+    if kind == 'local':
+        return LocalStorage(config.get('TRACK_STORAGE_ROOT', '.'))
+    if kind == 's3':
+        from s3 import get_client_options
+        backend = S3Storage(config['TRACK_STORAGE_BUCKET'], config.get('TRACK_STORAGE_PREFIX', ''), get_client_options(config))
+        return CachedStorage(backend, config.get('TRACK_CACHE_DIRECTORY', DEFAULT_CACHE_DIRECTORY),
+        config.get('TRACK_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+    raise ValueError(f"Unknown TRACK_STORAGE {kind}, expected 'local' or 's3'")
+
+def get_storage():
+    '''The storage of the current app, created once'''
+    storage = current_app.extensions.get('track_storage')
+    if storage is None:
+        storage = current_app.extensions['track_storage'] = create_storage(current_app.config)
+    return storage
@@ -5,9 +5,18 @@
 #    FLASK_ENV=production python -m unittest <name-of-python-file>
 
 import os
+import io
+import glob
+import gzip
+import hashlib
+import json
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
+from werkzeug.datastructures import FileStorage
 
-from models import db, Activity, User, ActivityGear, ActivityImages, Gear, Challenge, ChallengeGear, Landmark, ChallengeLandmark
+from models import db, Activity, User, ActivityGear, ActivityImages, ActivitySummary, Job, Gear, Challenge, ChallengeGear, Landmark, ChallengeLandmark, GPXHandler, TrackBlob
+from tracks import decode_polyline
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -18,12 +27,14 @@ os.environ['DATABASE_URL'] = "postgresql:///SOKA-test"
 TEST_IMAGE_URL = 'https://en.wikipedia.org/wiki/Standard_test_image#/media/File:SIPI_Jelly_Beans_4.1.07.tiff'
 # Now we can import app
 
-from app import app
+from app import app, CURR_USER_KEY
+import jobs
 
 GPX_FOLDER = 'test_gpx_files'
 ALLOWED_EXTENSIONS = {'gpx'}
 app.config['UPLOAD_FOLDER'] = GPX_FOLDER
 app.config['TESTING'] = True
+app.config['JOBS_RUN_INLINE'] = True
 print("CONFIG", app.config['UPLOAD_FOLDER'])
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -38,7 +49,9 @@ class ActivityModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Job.query.delete()
         Activity.query.delete()  # change to Model.query.delete()
+        TrackBlob.collect_garbage()
         User.query.delete()
         ActivityGear.query.delete()
         ActivityImages.query.delete()
@@ -117,3 +130,314 @@ class ActivityModelTestCase(TestCase):
             unsuccessful_activity = Activity.add_activity(user_id,name, challenge_id, style, gps_data, notes, gear, pics, directory=GPX_FOLDER)
             self.assertFalse(unsuccessful_activity.was_successful)
             pass
+
+    def test_activity_summary(self):
+        """Are track statistics stored when an activity is uploaded?"""
+        with self.client as c:
+            resp = c.get('/uploads/test.gpx')
+            gps_data = resp.data
+
+            activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            summary = ActivitySummary.query.get(activity.id)
+            self.assertIsNotNone(summary)
+            self.assertIs(activity.summary, summary)
+
+            # the stored summary should match a fresh parse of the gpx file
+            gpx_object = GPXHandler(activity)
+            self.assertEqual(summary.statistics['duration'], gpx_object.statistics['duration'])
+            self.assertEqual(summary.statistics['climb'], gpx_object.statistics['climb'])
+            self.assertEqual(summary.statistics['distance'], gpx_object.statistics['distance'])
+            self.assertEqual(summary.statistics['moving_time'], GPXHandler.format_duration(gpx_object.statistics['moving_seconds']))
+            self.assertEqual(len(summary.statistics['splits_km']), len(gpx_object.statistics['splits_km']))
+            # formatted once, however many statistics a template shows
+            self.assertIs(summary.statistics, summary.statistics)
+            self.assertEqual(summary.map_options['zoom'], gpx_object.map_options['zoom'])
+            coordinates = decode_polyline(summary.map_options['polyline'])
+            self.assertEqual(len(coordinates), len(gpx_object.map_options['coordinates']))
+            for decoded, original in zip(coordinates, gpx_object.map_options['coordinates']):
+                self.assertAlmostEqual(decoded[0], original[0], places = 5)
+                self.assertAlmostEqual(decoded[1], original[1], places = 5)
+            self.assertLess(len(decode_polyline(summary.preview_polyline)), len(coordinates))
+
+            # activities without a summary get one the first time they are displayed
+            db.session.delete(summary)
+            db.session.commit()
+            activity.setup_gpx_object()
+            self.assertIsNotNone(activity.summary)
+
+    def test_validate_landmarks(self):
+        """Are landmarks validated individually in one pass?"""
+        with self.client as c:
+            resp = c.get('/uploads/test.gpx')
+            gps_data = resp.data
+
+            activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            visited = Activity.validate_landmarks(activity, [self.landmark, self.wrong_landmark])
+            self.assertEqual(visited, {self.landmark.id: True, self.wrong_landmark.id: False})
+            self.assertTrue(Activity.validate_landmark(activity, self.landmark))
+            self.assertFalse(Activity.validate_landmark(activity, self.wrong_landmark))
+
+            # the spatial index and a full scan should agree
+            visited = Activity.validate_landmarks(activity, [self.landmark, self.wrong_landmark], use_index = False)
+            self.assertEqual(visited, {self.landmark.id: True, self.wrong_landmark.id: False})
+
+    def test_match_challenges(self):
+        """Are uploads matched against every available challenge they complete?"""
+        other_user = User.sign_up('other@email.com', "other", 'user', 'testpassword', 'testlocation')
+        other = Challenge(name='Other Challenge', description='same landmark', created_by = self.testuser.id)
+        incomplete = Challenge(name='Incomplete Challenge', description='misses a landmark', created_by = self.testuser.id)
+        hidden = Challenge(name='Hidden Challenge', description='not followed', created_by = other_user.id)
+        db.session.add_all([other, incomplete, hidden])
+        db.session.commit()
+        db.session.add_all([ChallengeLandmark(challenge_id = other.id, landmark_id = self.landmark.id),
+        ChallengeLandmark(challenge_id = incomplete.id, landmark_id = self.landmark.id),
+        ChallengeLandmark(challenge_id = incomplete.id, landmark_id = self.wrong_landmark.id),
+        ChallengeLandmark(challenge_id = hidden.id, landmark_id = self.landmark.id)])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/uploads/test.gpx')
+            gps_data = resp.data
+
+            activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            self.assertEqual([challenge.name for challenge in activity.completed_challenges], ['Other Challenge', 'Test Challenge'])
+
+            # following the creator makes their challenges available
+            self.testuser.following.append(other_user)
+            db.session.commit()
+            self.assertEqual([challenge.name for challenge in activity.match_challenges()], ['Hidden Challenge', 'Other Challenge', 'Test Challenge'])
+
+    def test_background_processing(self):
+        """Are uploaded activities processed by a job, outside of the request?"""
+        app.config['JOBS_RUN_INLINE'] = False
+        try:
+            with self.client as c:
+                resp = c.get('/uploads/test.gpx')
+                gps_data = resp.data
+
+                activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+                self.assertEqual(activity.status, 'processing')
+                self.assertIsNone(activity.summary)
+                self.assertEqual(Job.query.filter_by(kind = 'process_activity', status = 'pending').count(), 1)
+
+                # only users that can view the activity see its status
+                resp = c.get(f'/API/activities/{activity.id}/status')
+                self.assertEqual(resp.status_code, 401)
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                resp = c.get(f'/API/activities/{activity.id}/status')
+                self.assertEqual(resp.json['status'], 'processing')
+
+                self.assertEqual(jobs.run_pending_jobs(), 1)
+                activity = Activity.query.get(activity.id)
+                self.assertEqual(activity.status, 'ready')
+                self.assertTrue(activity.was_successful)
+                self.assertIsNotNone(activity.summary)
+                self.assertEqual(Job.query.filter_by(status = 'done').count(), 1)
+                # the job also renders the track thumbnail
+                self.assertTrue(os.path.exists(activity.summary.static_map))
+                self.assertTrue(activity.get_static_map().endswith(os.path.basename(activity.summary.static_map)))
+
+                resp = c.get(f'/API/activities/{activity.id}/status')
+                self.assertEqual(resp.json['status'], 'ready')
+        finally:
+            app.config['JOBS_RUN_INLINE'] = True
+
+    def test_staged_images(self):
+        """Are uploaded images staged in file storage, and recorded as failed when their staged upload is missing?"""
+        from storage import get_storage
+        app.config['JOBS_RUN_INLINE'] = False
+        try:
+            pics = [FileStorage(stream = io.BytesIO(b"not an image"), filename = name, content_type = 'image/jpeg')
+            for name in ['kept.jpg', 'lost.jpg']]
+            activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", None, "", [], pics, directory=GPX_FOLDER)
+            staged = json.loads(Job.query.filter_by(kind = 'process_activity').one().payload)['images']
+            self.assertTrue(all(get_storage().exists(image['key']) for image in staged))
+
+            # e.g. staged on a node that is gone
+            get_storage().delete(staged[1]['key'])
+            self.assertEqual(jobs.run_pending_jobs(), 1)
+
+            images = {image.large_image_url.split('_', 2)[2]: image for image in ActivityImages.query.filter_by(activity_id = activity.id)}
+            self.assertEqual(sorted(images), ['kept.jpg', 'lost.jpg'])
+            self.assertEqual({image.status for image in images.values()}, {'failed'})
+            self.assertIn('missing', images['lost.jpg'].error)
+            self.assertIn('Could not read', images['kept.jpg'].error)
+            self.assertFalse(get_storage().exists(staged[0]['key']))
+        finally:
+            app.config['JOBS_RUN_INLINE'] = True
+
+    def test_invalid_gpx_upload(self):
+        """Are invalid gpx uploads rejected without leaving a file behind?"""
+        activity = Activity(user_id = self.testuser.id, name = 'bad upload', challenge_id = self.challenge.id)
+        db.session.add(activity)
+        db.session.commit()
+        with self.assertRaises(ValueError):
+            Activity.save_gpx_file(activity, b"<gpx><trk><trkseg><trkpt lat=", GPX_FOLDER)
+        self.assertEqual(glob.glob(f"./{GPX_FOLDER}/blobs/upload_{activity.id}_*"), [])
+        self.assertIsNone(activity.gps_file)
+
+        # uploading one through add_activity leaves no activity stuck processing
+        count = Activity.query.count()
+        with self.assertRaises(ValueError):
+            Activity.add_activity(self.testuser.id, 'bad upload', self.challenge.id, "Biking", b"not a gpx file", "", [], [], directory=GPX_FOLDER)
+        self.assertEqual(Activity.query.count(), count)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_stale_jobs(self):
+        """Are jobs left running by a worker that stopped run again, and given up on after MAX_ATTEMPTS?"""
+        app.config['JOBS_RUN_INLINE'] = False
+        try:
+            with self.client as c:
+                gps_data = c.get('/uploads/test.gpx').data
+            activity = Activity.add_activity(self.testuser.id, 'test name', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            job = Job.query.filter_by(kind = 'process_activity').one()
+            long_ago = datetime.utcnow() - timedelta(seconds = Job.STALE_SECONDS + 60)
+
+            # a worker claimed the job and stopped
+            Job.query.filter_by(id = job.id).update({Job.status: 'running', Job.attempts: 1, Job.updated_at: long_ago})
+            db.session.commit()
+            self.assertEqual(jobs.run_pending_jobs(), 1)
+            self.assertEqual(Job.query.get(job.id).status, 'done')
+            self.assertEqual(Activity.query.get(activity.id).status, 'ready')
+
+            # and again, on its last attempt
+            Activity.query.filter_by(id = activity.id).update({Activity.status: 'processing'})
+            Job.query.filter_by(id = job.id).update({Job.status: 'running', Job.attempts: Job.MAX_ATTEMPTS, Job.updated_at: long_ago})
+            db.session.commit()
+            self.assertEqual(jobs.run_pending_jobs(), 0)
+            self.assertEqual(Job.query.get(job.id).status, 'failed')
+            self.assertEqual(Activity.query.get(activity.id).status, 'failed')
+        finally:
+            app.config['JOBS_RUN_INLINE'] = True
+
+    def test_job_retries(self):
+        """Is a failed job retried after a delay, with its activity processing until the job is given up on?"""
+        app.config['JOBS_RUN_INLINE'] = False
+        try:
+            activity = Activity(user_id = self.testuser.id, name = 'missing track', challenge_id = self.challenge.id,
+            gps_file = f"./{GPX_FOLDER}/missing.gpx", status = 'processing')
+            db.session.add(activity)
+            db.session.commit()
+            job = Job.enqueue('process_activity', activity_id = activity.id)
+
+            for attempt in range(1, Job.MAX_ATTEMPTS):
+                # run once, and not again before the delay
+                self.assertEqual(jobs.run_pending_jobs(), 1)
+                job = Job.query.get(job.id)
+                self.assertEqual((job.status, job.attempts), ('pending', attempt))
+                self.assertGreater(job.run_after, datetime.utcnow())
+                self.assertEqual(Activity.query.get(activity.id).status, 'processing')
+                Job.query.filter_by(id = job.id).update({Job.run_after: datetime.utcnow() - timedelta(seconds = 1)})
+                db.session.commit()
+
+            self.assertEqual(jobs.run_pending_jobs(), 1)
+            self.assertEqual(Job.query.get(job.id).status, 'failed')
+            self.assertEqual(Activity.query.get(activity.id).status, 'failed')
+        finally:
+            app.config['JOBS_RUN_INLINE'] = True
+
+    def test_unreadable_image(self):
+        """Is an image that can't be read recorded as failed, and not shown?"""
+        activity = Activity(user_id = self.testuser.id, name = 'bad image', challenge_id = self.challenge.id)
+        db.session.add(activity)
+        db.session.commit()
+        image_data = FileStorage(stream = io.BytesIO(b"not an image"), filename = 'photo.jpg', content_type = 'image/jpeg')
+        activity_image = ActivityImages.create_activity_image(activity.id, self.testuser.id, image_data)
+
+        self.assertEqual(activity_image.status, 'failed')
+        self.assertIn('photo.jpg', activity_image.error)
+        self.assertEqual(activity.images, [activity_image])
+        self.assertEqual(activity.get_images(), [])
+        self.assertEqual(self.testuser.get_recent_images(), [])
+
+    def test_absolute_upload_folder(self):
+        """Are files downloaded when the upload folder is configured with a leading / like in production?"""
+        with self.client as c:
+            gps_data = c.get('/uploads/test.gpx').data
+            app.config['UPLOAD_FOLDER'] = '/' + GPX_FOLDER
+            try:
+                resp = c.get('/uploads/test.gpx')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.data, gps_data)
+
+                activity = Activity.add_activity(self.testuser.id, 'absolute', self.challenge.id, "Biking", gps_data, "", [], [],
+                directory = app.config['UPLOAD_FOLDER'])
+                self.assertEqual(activity.get_gpx_url(),
+                f"/uploads/blobs/{os.path.basename(activity.gps_file)[:2]}/{os.path.basename(activity.gps_file)[:-len('.gz')]}")
+                resp = c.get(activity.get_gpx_url())
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.data, gps_data)
+                self.assertEqual(c.get('/uploads/../app.py').status_code, 404)
+            finally:
+                app.config['UPLOAD_FOLDER'] = GPX_FOLDER
+
+    def test_deduplicated_uploads(self):
+        """Do uploads of the same track share one file and one analysis?"""
+        with self.client as c:
+            resp = c.get('/uploads/test.gpx')
+            gps_data = resp.data
+            sha256 = hashlib.sha256(gps_data).hexdigest()
+
+            first = Activity.add_activity(self.testuser.id, 'first', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            second = Activity.add_activity(self.testuser.id, 'second', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+            self.assertEqual(first.gps_file, second.gps_file)
+            self.assertEqual(first.gps_file, TrackBlob.get_path(GPX_FOLDER, sha256))
+            self.assertEqual(TrackBlob.query.get(sha256).get_reference_count(), 2)
+            self.assertEqual(first.summary.polyline, second.summary.polyline)
+            self.assertEqual(first.summary.static_map, second.summary.static_map)
+
+            # stored compressed, and downloaded either compressed or decompressed
+            self.assertTrue(first.gps_file.endswith('.gpx.gz'))
+            self.assertLess(os.path.getsize(first.gps_file), len(gps_data) / 4)
+            resp = c.get(first.get_gpx_url(), headers = {'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(resp.data), gps_data)
+            resp = c.get(first.get_gpx_url())
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.data, gps_data)
+
+            # the files are kept until the last activity using them is deleted
+            path = first.gps_file
+            db.session.delete(first)
+            db.session.commit()
+            self.assertFalse(TrackBlob.release(path))
+            self.assertTrue(os.path.exists(path))
+
+            static_map = second.summary.static_map
+            db.session.delete(second)
+            db.session.commit()
+            self.assertTrue(TrackBlob.release(path))
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(os.path.exists(static_map))
+            self.assertIsNone(TrackBlob.query.get(sha256))
+
+    def test_deduplicated_uploads_on_two_nodes(self):
+        """Is a track uploaded again on a node that still has it cached, after another node deleted it, stored again?"""
+        from storage import LocalStorage, CachedStorage
+        with self.client as c:
+            gps_data = c.get('/uploads/test.gpx').data
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(app.extensions.pop, 'track_storage', None)
+        remote = LocalStorage(os.path.join(directory.name, 'remote'))
+        node_a = CachedStorage(remote, os.path.join(directory.name, 'a'))
+        node_b = CachedStorage(remote, os.path.join(directory.name, 'b'))
+
+        app.extensions['track_storage'] = node_a
+        first = Activity.add_activity(self.testuser.id, 'first', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+        path = first.gps_file
+
+        app.extensions['track_storage'] = node_b
+        db.session.delete(first)
+        db.session.commit()
+        self.assertTrue(TrackBlob.release(path))
+        self.assertFalse(remote.exists(path))
+
+        app.extensions['track_storage'] = node_a
+        second = Activity.add_activity(self.testuser.id, 'second', self.challenge.id, "Biking", gps_data, "", [], [], directory=GPX_FOLDER)
+        self.assertEqual(second.gps_file, path)
+        self.assertTrue(remote.exists(path))
+        # and every other node can read it
+        from tracks import load_stored_track
+        self.assertEqual(len(load_stored_track(node_b, path).latitude), len(second.get_track().latitude))
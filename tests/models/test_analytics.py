@@ -0,0 +1,157 @@
+"""Track statistics tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_analytics.py
+
+import io
+from unittest import TestCase
+
+import gpxpy
+import numpy as np
+
+from tracks import load_track, Track
+from analytics import summarize_track, compute_splits, elevation_statistics, hysteresis_climb, moving_average, METERS_PER_KILOMETER
+
+GPX_FILE = 'test_gpx_files/test.gpx'
+
+TWO_SEGMENT_GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="test">
+  <trk>
+    <trkseg>
+      <trkpt lat="38.0" lon="-109.0"><ele>100</ele><time>2022-01-01T00:00:00Z</time></trkpt>
+      <trkpt lat="38.1" lon="-109.1"><ele>110</ele><time>2022-01-01T00:00:10Z</time></trkpt>
+      <trkpt lat="38.2" lon="-109.2"><ele>105</ele><time>2022-01-01T00:00:20Z</time></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="38.3" lon="-109.3"><ele>120</ele><time>2022-01-01T01:00:00.500Z</time></trkpt>
+      <trkpt lat="38.4" lon="-109.4"><ele>90</ele><time>2022-01-01T01:00:30.500Z</time></trkpt>
+    </trkseg>
+  </trk>
+</gpx>"""
+
+
+def straight_track(count, step_meters = 10.0, step_seconds = 2.0):
+    '''A track heading north at a constant speed, with a single segment'''
+    latitudes = 30 + np.arange(count) * step_meters / 111194.93
+    return Track(latitudes, np.full(count, -96.0), np.full(count, 100.0), np.arange(count) * step_seconds, np.zeros(count, dtype = np.int32))
+
+
+class TrackStatisticsTestCase(TestCase):
+    """Test the vectorized track statistics"""
+
+    def test_matches_gpxpy(self):
+        """Do the statistics match gpxpy's?"""
+        summary = summarize_track(load_track(GPX_FILE))
+        with open(GPX_FILE, 'r') as f:
+            gpx = gpxpy.parse(f)
+
+        self.assertEqual(summary['duration_seconds'], int(gpx.get_duration()))
+        min_elevation, max_elevation = gpx.get_elevation_extremes()
+        self.assertEqual(summary['min_elevation'], min_elevation)
+        self.assertEqual(summary['max_elevation'], max_elevation)
+
+        bounds = gpx.get_bounds()
+        self.assertEqual(summary['latitude_min'], bounds.min_latitude)
+        self.assertEqual(summary['latitude_max'], bounds.max_latitude)
+        self.assertEqual(summary['longitude_min'], bounds.min_longitude)
+        self.assertEqual(summary['longitude_max'], bounds.max_longitude)
+
+        points = [[p.longitude, p.latitude] for t in gpx.tracks for s in t.segments for p in s.points]
+        self.assertEqual(summary['coordinates'], points)
+
+        # gpxpy uses a slightly different earth radius
+        self.assertAlmostEqual(summary['distance'] / gpx.length_2d(), 1, places = 2)
+        self.assertAlmostEqual(summary['moving_seconds'], gpx.get_moving_data().moving_time, delta = 60)
+
+    def test_segments(self):
+        """Are durations, climbs and distances computed per segment?"""
+        # without any elevation cleaning, to check the climbs of each segment
+        summary = summarize_track(load_track(io.BytesIO(TWO_SEGMENT_GPX)), spike_threshold = 0, smoothing_window = 1, hysteresis = 0)
+        gpx = gpxpy.parse(TWO_SEGMENT_GPX.decode())
+
+        self.assertEqual(summary['duration_seconds'], 50)
+        self.assertEqual(summary['duration_seconds'], int(gpx.get_duration()))
+        self.assertEqual(summary['climb'], 10)
+        self.assertEqual(summary['descent'], 35)
+        # the hour between segments is not moving time, and its distance is not counted
+        self.assertEqual(summary['moving_seconds'], 50)
+        self.assertAlmostEqual(summary['distance'] / gpx.length_2d(), 1, places = 2)
+
+    def test_moving_time_and_speed(self):
+        """Are stops excluded from moving time and average speed?"""
+        track = straight_track(101)
+        # stand still for 100 seconds in the middle of the track
+        times = track.time.copy()
+        times[51:] += 100
+        summary = summarize_track(track._replace(time = times))
+
+        self.assertAlmostEqual(summary['distance'], 1000, delta = 1)
+        self.assertEqual(summary['duration_seconds'], 300)
+        # the step that includes the stop is too slow to count as moving
+        self.assertEqual(summary['moving_seconds'], 198)
+        self.assertAlmostEqual(summary['average_speed'], summary['distance'] / 198)
+        self.assertAlmostEqual(summary['max_speed'], 5, places = 2)
+
+        # without times there is nothing to compute speeds from
+        untimed = summarize_track(track._replace(time = np.full(len(track.time), np.nan)))
+        self.assertIsNone(untimed['average_speed'])
+        self.assertIsNone(untimed['max_speed'])
+        self.assertEqual(untimed['splits_km'], [])
+        self.assertAlmostEqual(untimed['distance'], 1000, delta = 1)
+
+    def test_splits(self):
+        """Are split times interpolated between points?"""
+        # 2500 meters at 5 meters per second
+        summary = summarize_track(straight_track(251))
+        splits = summary['splits_km']
+        self.assertEqual(len(splits), 3)
+        for distance, seconds in splits[:2]:
+            self.assertAlmostEqual(distance, 1000, delta = 0.5)
+            self.assertAlmostEqual(seconds, 200, delta = 0.5)
+        self.assertAlmostEqual(splits[2][0], 500, delta = 1)
+        self.assertAlmostEqual(splits[2][1], 100, delta = 0.5)
+        self.assertAlmostEqual(sum(seconds for distance, seconds in splits), 500, places = 3)
+        self.assertEqual(len(summary['splits_mile']), 2)
+
+        # boundaries that fall between points
+        splits = compute_splits(np.array([0, 600, 1500, 2000.0]), np.array([0, 100, 200, 300.0]), METERS_PER_KILOMETER)
+        self.assertEqual(splits, [[1000.0, 144.4], [1000.0, 155.6]])
+
+    def test_elevation_noise(self):
+        """Are climbs stable when elevations are noisy or have spikes?"""
+        # three 100 meter hills
+        count = 3000
+        true_elevations = 50 - 50 * np.cos(np.linspace(0, 6 * np.pi, count))
+        segments = np.zeros(count, dtype = np.int32)
+        rng = np.random.default_rng(0)
+        for noise in [0.5, 1.5, 3.0]:
+            elevations = true_elevations + rng.normal(0, noise, count)
+            elevations[rng.choice(count, 10, replace = False)] += 150
+            climb, descent, min_elevation, max_elevation = elevation_statistics(elevations, segments)
+            self.assertAlmostEqual(climb, 300, delta = 15)
+            self.assertAlmostEqual(descent, 300, delta = 15)
+            # the spikes are rejected from the extremes too
+            self.assertLess(max_elevation, 100 + 5 * noise)
+
+            # without cleaning, noise and spikes add up to several times the real climb
+            raw_climb = elevation_statistics(elevations, segments, spike_threshold = 0, smoothing_window = 1, hysteresis = 0)[0]
+            self.assertGreater(raw_climb, 1000)
+
+    def test_short_segments(self):
+        """Are the climbs of segments shorter than the smoothing window kept, with the default cleaning?"""
+        segments = np.zeros(4, dtype = np.int32)
+        self.assertEqual(elevation_statistics(np.array([100, 110, 120, 130.0]), segments), (30.0, 0.0, 100.0, 130.0))
+        self.assertEqual(len(moving_average(np.array([100, 110, 120, 130.0]), 9)), 4)
+        self.assertEqual(elevation_statistics(np.array([100, 130.0]), segments[:2])[:2], (30.0, 0.0))
+
+        # two short segments after an auto-pause, climbing 30 and descending 20
+        elevations = np.array([100, 110, 120, 130, 130, 120, 110.0])
+        self.assertEqual(elevation_statistics(elevations, np.array([0, 0, 0, 0, 1, 1, 1], dtype = np.int32))[:2], (30.0, 20.0))
+
+    def test_hysteresis(self):
+        """Are changes smaller than the hysteresis threshold ignored?"""
+        self.assertEqual(hysteresis_climb(np.array([0, 2, 0, 2, 0, 2.0]), 3), (0.0, 0.0))
+        # a small dip on the way up doesn't reset the climb
+        self.assertEqual(hysteresis_climb(np.array([0, 5, 3, 8, 8, 0.0]), 3), (8.0, 8.0))
+        self.assertEqual(hysteresis_climb(np.array([0, 2, 0, 2.0]), 0), (4.0, 2.0))
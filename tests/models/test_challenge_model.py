@@ -7,7 +7,7 @@
 import os
 from unittest import TestCase
 
-from models import db, Activity, User, ActivityGear, ActivityImages, Gear, Challenge, ChallengeGear, Landmark, ChallengeLandmark
+from models import db, Activity, User, ActivityGear, ActivityImages, ActivityCompletedChallenge, Gear, Challenge, ChallengeGear, Landmark, ChallengeLandmark
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,6 +20,7 @@ TEST_IMAGE_URL = 'https://en.wikipedia.org/wiki/Standard_test_image#/media/File:
 # Now we can import app
 
 from app import app
+import revalidation
 
 GPX_FOLDER = 'test_gpx_files'
 ALLOWED_EXTENSIONS = {'gpx'}
@@ -80,3 +81,70 @@ class ChallengeModelTestCase(TestCase):
         self.assertEqual(len(ChallengeGear.query.all()), 2)
         self.assertEqual(len(ChallengeLandmark.query.all()), 2)
         pass
+
+    def test_revalidate_challenge(self):
+        """Are all attempts revalidated when a challenge's landmarks change?"""
+        gear_ids = [item.id for item in self.gear]
+        challenge = Challenge.create_challenge("test challenge", "this is a test challenge.", gear_ids, [self.landmarks[0].id], self.testuser.id)
+
+        # enough attempts to use the process pool, sharing one gps track
+        activities = [Activity(user_id = self.testuser.id, name = f"attempt {idx}", challenge_id = challenge.id,
+        gps_file = f"./{GPX_FOLDER}/test.gpx", was_successful = False)
+        for idx in range(revalidation.MIN_PARALLEL_ACTIVITIES)]
+        activities.append(Activity(user_id = self.testuser.id, name = "no track", challenge_id = challenge.id, was_successful = True))
+        db.session.add_all(activities)
+        db.session.commit()
+        activity_ids = [activity.id for activity in activities]
+
+        updated = revalidation.revalidate_challenge(challenge.id, processes = 2, batch_size = 5)
+        self.assertEqual(updated, len(activities))
+        results = [Activity.query.get(activity_id).was_successful for activity_id in activity_ids]
+        self.assertEqual(results, [True] * (len(activities) - 1) + [False])
+
+        # the second landmark isn't on the track, so every attempt now fails
+        landmarks_changed = Challenge.update_challenge(challenge, challenge.name, challenge.description, gear_ids, [landmark.id for landmark in self.landmarks])
+        self.assertTrue(landmarks_changed)
+        revalidation.revalidate_challenge(challenge.id, processes = 1)
+        results = [Activity.query.get(activity_id).was_successful for activity_id in activity_ids]
+        self.assertEqual(results, [False] * len(activities))
+
+    def test_revalidate_completed_challenges(self):
+        """Are the activities that completed a challenge without attempting it checked again when its landmarks change?"""
+        gear_ids = [item.id for item in self.gear]
+        challenge = Challenge.create_challenge("test challenge", "this is a test challenge.", gear_ids, [self.landmarks[0].id], self.testuser.id)
+        other_challenge = Challenge.create_challenge("other challenge", "this is another challenge.", gear_ids, [self.landmarks[0].id], self.testuser.id)
+
+        attempt = Activity(user_id = self.testuser.id, name = "attempt", challenge_id = challenge.id, gps_file = f"./{GPX_FOLDER}/test.gpx")
+        # found by match_challenges when it was uploaded
+        other = Activity(user_id = self.testuser.id, name = "other attempt", challenge_id = other_challenge.id,
+        gps_file = f"./{GPX_FOLDER}/test.gpx", was_successful = True)
+        other.completed_challenges = [challenge, other_challenge]
+        db.session.add_all([attempt, other])
+        db.session.commit()
+        attempt_id, other_id = attempt.id, other.id
+
+        self.assertEqual(revalidation.revalidate_challenge(challenge.id, processes = 1), 2)
+        def completed():
+            return sorted(activity_id for (activity_id,) in db.session.query(ActivityCompletedChallenge.activity_id
+            ).filter(ActivityCompletedChallenge.challenge_id == challenge.id))
+        self.assertEqual(completed(), sorted([attempt_id, other_id]))
+
+        # the second landmark isn't on the track, so neither activity completes it anymore
+        Challenge.update_challenge(challenge, challenge.name, challenge.description, gear_ids, [landmark.id for landmark in self.landmarks])
+        revalidation.revalidate_challenge(challenge.id, processes = 1)
+        self.assertEqual(completed(), [])
+        self.assertFalse(Activity.query.get(attempt_id).was_successful)
+        # the challenge the other activity attempted is left alone
+        other = Activity.query.get(other_id)
+        self.assertTrue(other.was_successful)
+        self.assertEqual([challenge.name for challenge in other.completed_challenges], ['Other challenge'])
+
+    def test_revalidate_unreadable_track(self):
+        """Is the stored result left alone when a track can't be read from S3?"""
+        from botocore.exceptions import ClientError
+
+        class DeniedStorage():
+            def exists(self, key):
+                raise ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, 'HeadObject')
+
+        self.assertEqual(revalidation.validate_task((DeniedStorage(), 1, f"./{GPX_FOLDER}/test.gpx", [30.6], [-96.3], 25)), (1, None))
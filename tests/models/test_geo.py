@@ -0,0 +1,71 @@
+"""Geographic helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_geo.py
+
+from unittest import TestCase
+
+import numpy as np
+
+from geo import haversine_distances, targets_within_radius, GridIndex
+from tracks import load_track
+
+GPX_FILE = 'test_gpx_files/test.gpx'
+
+
+class GeoTestCase(TestCase):
+    """Test distance computations and landmark hit testing"""
+
+    def test_haversine_distances(self):
+        """Are short and long distances computed accurately?"""
+        # one thousandth of a degree of latitude is about 111 meters
+        distances = haversine_distances([30.0, 30.0], [-96.0, -96.0], [30.001, 30.0], [-96.0, -96.0])
+        self.assertEqual(distances.shape, (2, 2))
+        self.assertAlmostEqual(distances[0, 0], 111.19, places = 1)
+        self.assertEqual(distances[0, 1], 0)
+
+        # distances of a few centimeters should not collapse to zero
+        distances = haversine_distances([30.0], [-96.0], [30.0000001], [-96.0])
+        self.assertAlmostEqual(distances[0, 0], 0.0111, places = 3)
+
+        # Boston to Denver is about 2840 kilometers
+        distances = haversine_distances([42.3601], [-71.0589], [39.7392], [-104.9903])
+        self.assertAlmostEqual(distances[0, 0] / 1000, 2840, delta = 10)
+
+    def test_targets_within_radius(self):
+        """Are landmarks on and off the track detected?"""
+        track = load_track(GPX_FILE)
+        hits = targets_within_radius(track.latitude, track.longitude,
+        [30.610927, 31.610927, 30.6112], [-96.318101, -96.318101, -96.3181], 50)
+        self.assertEqual(hits.tolist(), [True, False, True])
+
+        # no landmarks means nothing to visit
+        self.assertEqual(len(targets_within_radius(track.latitude, track.longitude, [], [], 50)), 0)
+
+    def test_radius_boundary(self):
+        """Is a point just inside/outside the radius classified correctly?"""
+        # 0.0004 degrees of latitude is about 44.5 meters
+        latitudes = np.array([30.0004])
+        longitudes = np.array([-96.0])
+        self.assertTrue(targets_within_radius(latitudes, longitudes, [30.0], [-96.0], 50)[0])
+        self.assertFalse(targets_within_radius(latitudes, longitudes, [30.0], [-96.0], 40)[0])
+
+    def test_grid_index(self):
+        """Does the grid index find exactly the points a full scan finds?"""
+        track = load_track(GPX_FILE)
+        index = GridIndex(track.latitude, track.longitude, cell_size = 50)
+
+        rng = np.random.default_rng(0)
+        for radius in [10, 50, 500]:
+            for _ in range(20):
+                latitude = rng.uniform(track.latitude.min(), track.latitude.max())
+                longitude = rng.uniform(track.longitude.min(), track.longitude.max())
+                distances = haversine_distances(track.latitude, track.longitude, [latitude], [longitude])[:, 0]
+                expected = set(np.nonzero(distances < radius)[0].tolist())
+                self.assertEqual(set(index.query_radius(latitude, longitude, radius).tolist()), expected)
+
+        latitudes = [30.610927, 31.610927, 30.6112]
+        longitudes = [-96.318101, -96.318101, -96.3181]
+        self.assertEqual(index.targets_within_radius(latitudes, longitudes, 50).tolist(),
+        targets_within_radius(track.latitude, track.longitude, latitudes, longitudes, 50).tolist())
@@ -0,0 +1,78 @@
+"""Image resizing tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_images.py
+
+import io
+from unittest import TestCase
+
+from PIL import Image
+
+from images import create_responsive_images, get_modern_formats, open_image, IMAGE_SIZES
+
+# the EXIF tag for how the camera was held
+ORIENTATION = 0x0112
+
+
+def jpeg(size, orientation = None):
+    '''A JPEG with a red left half, optionally tagged with an EXIF orientation'''
+    image = Image.new('RGB', size, (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    exif = Image.Exif()
+    if orientation:
+        exif[ORIENTATION] = orientation
+    output = io.BytesIO()
+    image.save(output, format = 'JPEG', exif = exif.tobytes())
+    output.seek(0)
+    return output
+
+
+class ImageResizingTestCase(TestCase):
+    """Test resizing uploaded images to every stored size"""
+
+    def test_sizes(self):
+        """Is every size fitted within its bounds, keeping the format and aspect ratio?"""
+        widths, encoded = create_responsive_images(jpeg((4000, 3000)), formats = [])
+        variants = encoded[None]
+        self.assertEqual(len(variants), len(IMAGE_SIZES))
+        for variant, size in zip(variants, [(500, 375), (320, 240), (128, 96)]):
+            image = Image.open(io.BytesIO(variant))
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, size)
+
+        # images smaller than a size aren't enlarged
+        output = io.BytesIO()
+        Image.new('RGBA', (200, 100)).save(output, format = 'PNG')
+        output.seek(0)
+        sizes = [Image.open(io.BytesIO(variant)).size for variant in create_responsive_images(output, formats = [])[1][None]]
+        self.assertEqual(sizes, [(200, 100), (200, 100), (128, 64)])
+
+    def test_draft_and_orientation(self):
+        """Are large JPEGs decoded at a reduced scale, and rotated upright?"""
+        image, image_format = open_image(jpeg((4000, 3000)), (500, 500))
+        self.assertEqual(image_format, 'JPEG')
+        self.assertEqual(image.size, (1000, 750))
+
+        # rotated 90 degrees clockwise to display, the red half ends up on top
+        image, image_format = open_image(jpeg((400, 300), orientation = 6), (500, 500))
+        self.assertEqual(image.size, (300, 400))
+        red, green, blue = image.getpixel((150, 50))
+        self.assertGreater(red, 200)
+        self.assertLess(blue, 50)
+
+    def test_modern_formats(self):
+        """Is every size also encoded in the modern formats, and smaller than the uploaded format?"""
+        formats = get_modern_formats()
+        self.assertIn('WEBP', formats)
+        widths, encoded = create_responsive_images(jpeg((3000, 4000)))
+        self.assertEqual(widths, [375, 240, 96])
+        self.assertEqual(set(encoded), {None, *formats})
+        for image_format in formats:
+            for variant, original, width in zip(encoded[image_format], encoded[None], widths):
+                image = Image.open(io.BytesIO(variant))
+                self.assertEqual((image.format, image.width), (image_format, width))
+                self.assertLess(len(variant), len(original))
+
+        widths, encoded = create_responsive_images(jpeg((400, 300)), formats = [])
+        self.assertEqual(list(encoded), [None])
@@ -0,0 +1,169 @@
+"""S3 client and presigned url cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_s3.py
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from flask import Flask
+
+from s3 import PresignedUrlCache, S3ClientManager, upload_objects, get_s3_client, get_s3_upload_client
+
+# nothing listens here, the clients are only built and used to sign urls
+LOCAL_ENDPOINT = 'http://127.0.0.1:9000'
+
+
+class Clock():
+    '''A clock the tests move by hand'''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class PresignedUrlCacheTestCase(TestCase):
+    """Test that presigned urls are reused until shortly before they expire"""
+
+    def setUp(self):
+        self.signed = []
+        self.clock = Clock()
+
+    def sign(self, bucket, key, expiration):
+        self.signed.append((bucket, key))
+        return f"https://{bucket}.s3.amazonaws.com/{key}?Expires={self.clock.now + expiration}&n={len(self.signed)}"
+
+    def test_reuse(self):
+        """Is an url signed once per object and size, while it is valid for longer than the margin?"""
+        cache = PresignedUrlCache(self.sign, expiration = 3600, margin = 600, clock = self.clock)
+        urls = [cache.get('bucket', f"{number}.jpg", 'medium') for number in range(40)]
+        self.clock.now = 2999
+        self.assertEqual([cache.get('bucket', f"{number}.jpg", 'medium') for number in range(40)], urls)
+        self.assertEqual(len(self.signed), 40)
+
+        cache.get('bucket', '0.jpg', 'large')
+        self.assertEqual(len(self.signed), 41)
+
+        # close to expiring, the url is signed again
+        self.clock.now = 3000
+        self.assertNotEqual(cache.get('bucket', '0.jpg', 'medium'), urls[0])
+        self.assertEqual(len(self.signed), 42)
+
+    def test_eviction(self):
+        """Are expired and least recently used urls dropped?"""
+        cache = PresignedUrlCache(self.sign, expiration = 100, margin = 10, max_entries = 2, clock = self.clock)
+        cache.get('bucket', 'a.jpg')
+        cache.get('bucket', 'b.jpg')
+        cache.get('bucket', 'a.jpg')
+        cache.get('bucket', 'c.jpg')
+        self.assertEqual(len(cache), 2)
+        cache.get('bucket', 'a.jpg')
+        self.assertEqual(len(self.signed), 3)
+
+        self.clock.now = 90
+        cache.get('bucket', 'd.jpg')
+        self.assertEqual(len(cache), 1)
+
+        # only the least recently used end is checked for expired urls, those behind a valid one stay until looked up
+        cache = PresignedUrlCache(self.sign, expiration = 100, margin = 10, max_entries = 10, clock = self.clock)
+        self.clock.now = 0
+        cache.get('bucket', 'a.jpg')
+        self.clock.now = 50
+        cache.get('bucket', 'b.jpg')
+        cache.get('bucket', 'a.jpg')
+        self.clock.now = 120
+        cache.get('bucket', 'c.jpg')
+        self.assertEqual(len(cache), 3)
+        signed = len(self.signed)
+        cache.get('bucket', 'a.jpg')
+        self.assertEqual(len(self.signed), signed + 1)
+        self.assertEqual(len(cache), 3)
+
+    def test_failed_signature(self):
+        """Is a failure to sign not cached?"""
+        cache = PresignedUrlCache(lambda bucket, key, expiration: None, clock = self.clock)
+        self.assertIsNone(cache.get('bucket', 'a.jpg'))
+        self.assertEqual(len(cache), 0)
+        with self.assertRaises(ValueError):
+            PresignedUrlCache(self.sign, expiration = 60, margin = 60)
+
+
+class FlakyClient():
+    '''Stands in for an S3 client, the first failures uploads of each key fail, and uploads take delay seconds'''
+    def __init__(self, failures = 0, delay = 0):
+        self.failures = failures
+        self.delay = delay
+        self.attempts = {}
+        self.uploaded = {}
+        self.lock = threading.Lock()
+
+    def upload_fileobj(self, file, bucket, key, ExtraArgs = None):
+        with self.lock:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            attempt = self.attempts[key]
+        time.sleep(self.delay)
+        if attempt <= self.failures:
+            raise ConnectionError(f"attempt {attempt} failed")
+        self.uploaded[key] = (file.read(), ExtraArgs)
+
+
+class S3ClientManagerTestCase(TestCase):
+    """Test that S3 clients are built once and shared"""
+
+    def test_shared_client(self):
+        """Do concurrent callers get the same client, configured with the pool size and timeouts?"""
+        manager = S3ClientManager()
+        options = {"aws_access_key_id": 'key', "aws_secret_access_key": 'secret', "endpoint_url": LOCAL_ENDPOINT,
+        "region_name": 'us-east-1', "max_pool_connections": 4, "connect_timeout": 2, "read_timeout": 7}
+        with ThreadPoolExecutor(max_workers = 8) as pool:
+            clients = list(pool.map(lambda number: manager.get_client(**options), range(32)))
+        self.assertTrue(all(client is clients[0] for client in clients))
+
+        client = clients[0]
+        self.assertEqual(client.meta.config.max_pool_connections, 4)
+        self.assertEqual(client.meta.config.connect_timeout, 2)
+        self.assertEqual(client.meta.config.read_timeout, 7)
+        url = client.generate_presigned_url('get_object', Params = {"Bucket": 'bucket', "Key": 'a.jpg'}, ExpiresIn = 60)
+        self.assertTrue(url.startswith(f"{LOCAL_ENDPOINT}/bucket/a.jpg?"))
+
+        # other options get their own client
+        self.assertIsNot(manager.get_client(**dict(options, max_pool_connections = 8)), client)
+        manager.clear()
+        self.assertIsNot(manager.get_client(**options), client)
+
+    def test_upload_client(self):
+        """Are uploads only retried by upload_objects, and not by botocore as well?"""
+        app = Flask(__name__)
+        app.config.update(SOKA_PRESIGNED_URL_ACCESS_KEY = 'key', SOKA_PRESIGNED_URL_SECRET_ACCESS_KEY = 'secret',
+        S3_ENDPOINT_URL = LOCAL_ENDPOINT, S3_REGION = 'us-east-1')
+        with app.app_context():
+            self.assertEqual(get_s3_upload_client().meta.config.retries['total_max_attempts'], 1)
+            self.assertGreater(get_s3_client().meta.config.retries['total_max_attempts'], 1)
+
+
+class UploadTestCase(TestCase):
+    """Test uploading objects concurrently"""
+
+    def test_concurrent_uploads(self):
+        """Do uploads run at once, and are failed attempts retried?"""
+        uploads = [(f"{size}_1_{number}.jpg", bytes([number]), 'image/jpeg') for number in range(4) for size in (500, 320, 128)]
+        client = FlakyClient(failures = 1, delay = 0.1)
+        started = time.perf_counter()
+        errors = upload_objects(client, 'bucket', uploads, max_workers = 12, retry_delay = 0)
+        self.assertLess(time.perf_counter() - started, 0.2 * len(uploads) / 2)
+
+        self.assertEqual(errors, {key: None for key, data, content_type in uploads})
+        self.assertEqual(set(client.attempts.values()), {2})
+        self.assertEqual(client.uploaded['500_1_3.jpg'], (bytes([3]), {"ContentType": 'image/jpeg'}))
+
+    def test_failed_uploads(self):
+        """Is the last error returned for uploads that fail every attempt?"""
+        client = FlakyClient(failures = 3)
+        errors = upload_objects(client, 'bucket', [('a.jpg', b'a', None)], attempts = 3, retry_delay = 0)
+        self.assertIsInstance(errors['a.jpg'], ConnectionError)
+        self.assertEqual(str(errors['a.jpg']), 'attempt 3 failed')
+        self.assertEqual(upload_objects(client, 'bucket', []), {})
@@ -0,0 +1,141 @@
+"""Track storage tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_storage.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from storage import LocalStorage, CachedStorage, normalize_key, get_folder_key
+from tracks import load_stored_track, load_track, sidecar_path
+
+GPX_FILE = 'test_gpx_files/test.gpx'
+
+
+class CountingStorage(LocalStorage):
+    '''A directory standing in for a remote storage, counting downloads'''
+    downloads = 0
+
+    def download(self, key, filename):
+        self.downloads += 1
+        super().download(key, filename)
+
+
+class StorageTestCase(TestCase):
+    """Test the local storage and the cache in front of remote storages"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_keys(self):
+        """Are stored paths normalized, and kept inside the storage?"""
+        self.assertEqual(normalize_key('./gpx_files/blobs/ab/ab.gpx.gz'), 'gpx_files/blobs/ab/ab.gpx.gz')
+        for key in ['../secret.py', '/etc/passwd', 'gpx_files/../../secret.py', '.']:
+            with self.assertRaises(ValueError):
+                normalize_key(key)
+
+        # upload folders are relative to the working directory, even when configured as /gpx_files
+        self.assertEqual(get_folder_key('/gpx_files'), 'gpx_files')
+        self.assertEqual(get_folder_key('test_gpx_files'), 'test_gpx_files')
+
+    def test_local_storage(self):
+        """Can files be stored, listed and deleted?"""
+        storage = LocalStorage(self.directory.name)
+        storage.put_bytes('./gpx_files/1_abc.png', b'png')
+        temporary = os.path.join(self.directory.name, 'upload.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(b'gpx')
+        storage.put_file('./gpx_files/1.gpx.gz', temporary)
+
+        self.assertFalse(os.path.exists(temporary))
+        self.assertTrue(storage.exists('./gpx_files/1.gpx.gz'))
+        with storage.open('gpx_files/1.gpx.gz') as f:
+            self.assertEqual(f.read(), b'gpx')
+        self.assertEqual(storage.list_keys('./gpx_files/1_'), ['gpx_files/1_abc.png'])
+
+        storage.delete('./gpx_files/1_abc.png')
+        storage.delete('./gpx_files/1_abc.png')
+        self.assertFalse(storage.exists('./gpx_files/1_abc.png'))
+        self.assertEqual(storage.list_keys('./missing/1_'), [])
+
+    def test_cache(self):
+        """Are remote files downloaded once, and the least recently used evicted?"""
+        remote = CountingStorage(os.path.join(self.directory.name, 'remote'))
+        cache_directory = os.path.join(self.directory.name, 'cache')
+        storage = CachedStorage(remote, cache_directory, max_bytes = 250)
+        for number in range(3):
+            storage.put_bytes(f"./gpx_files/{number}.png", bytes(100))
+            # modification times order the files by last use
+            os.utime(storage.get_cache_path(f"./gpx_files/{number}.png"), (number, number))
+
+        # the oldest file didn't fit, but is still stored remotely
+        self.assertFalse(os.path.exists(storage.get_cache_path('./gpx_files/0.png')))
+        self.assertTrue(storage.exists('./gpx_files/0.png'))
+        self.assertEqual(sorted(storage.list_keys('./gpx_files/')), ['gpx_files/0.png', 'gpx_files/1.png', 'gpx_files/2.png'])
+
+        # reading it downloads it once, and makes room by evicting the least recently used file
+        for attempt in range(2):
+            with storage.open('./gpx_files/0.png') as f:
+                self.assertEqual(f.read(), bytes(100))
+        self.assertEqual(remote.downloads, 1)
+        self.assertFalse(os.path.exists(storage.get_cache_path('./gpx_files/1.png')))
+        self.assertTrue(os.path.exists(storage.get_cache_path('./gpx_files/2.png')))
+
+        storage.delete('./gpx_files/2.png')
+        self.assertFalse(storage.exists('./gpx_files/2.png'))
+
+    def test_cache_scans(self):
+        """Is the cache directory only scanned once enough was added to it?"""
+        remote = LocalStorage(os.path.join(self.directory.name, 'remote'))
+        storage = CachedStorage(remote, os.path.join(self.directory.name, 'cache'), max_bytes = 16000)
+        scans = []
+        evict = storage.evict
+        storage.evict = lambda: scans.append(evict())
+
+        for number in range(30):
+            storage.put_bytes(f"./gpx_files/{number}.png", bytes(100))
+        # the first write scans, then every 1000 bytes (CACHE_SCAN_FRACTION of max_bytes): the 11th and 21st writes
+        self.assertEqual(len(scans), 3)
+
+        # until the running total is over max_bytes, which evicts right away
+        storage.put_bytes('./gpx_files/large.png', bytes(14000))
+        self.assertEqual(len(scans), 4)
+        self.assertEqual(scans[-1], 10)
+
+    def test_shared_storage(self):
+        """Does a node see that a file it still has cached was deleted by another node?"""
+        remote = LocalStorage(os.path.join(self.directory.name, 'remote'))
+        node_a = CachedStorage(remote, os.path.join(self.directory.name, 'a'), max_bytes = 10 * 1024 * 1024)
+        node_b = CachedStorage(remote, os.path.join(self.directory.name, 'b'), max_bytes = 10 * 1024 * 1024)
+        node_a.put_bytes('./gpx_files/1.gpx.gz', b'gpx')
+        with node_b.open('./gpx_files/1.gpx.gz') as f:
+            self.assertEqual(f.read(), b'gpx')
+
+        node_b.delete('./gpx_files/1.gpx.gz')
+        self.assertFalse(node_b.exists('./gpx_files/1.gpx.gz'))
+        # node A can still read its copy, but mustn't skip storing the file again because of it
+        self.assertTrue(node_a.exists('./gpx_files/1.gpx.gz'))
+        self.assertFalse(node_a.exists_remotely('./gpx_files/1.gpx.gz'))
+
+    def test_stored_track(self):
+        """Is a stored track's sidecar created once and put in the storage?"""
+        remote = CountingStorage(os.path.join(self.directory.name, 'remote'))
+        storage = CachedStorage(remote, os.path.join(self.directory.name, 'cache'), max_bytes = 10 * 1024 * 1024)
+        with open(GPX_FILE, 'rb') as f:
+            storage.put_bytes('./gpx_files/test.gpx', f.read())
+        # start with an empty cache, like another node
+        os.remove(storage.get_cache_path('./gpx_files/test.gpx'))
+
+        track = load_stored_track(storage, './gpx_files/test.gpx')
+        np.testing.assert_array_equal(track.latitude, load_track(GPX_FILE).latitude)
+        self.assertTrue(remote.exists(sidecar_path('./gpx_files/test.gpx')))
+        self.assertEqual(remote.downloads, 1)
+
+        # once cached, neither file is downloaded again
+        np.testing.assert_array_equal(load_stored_track(storage, './gpx_files/test.gpx').latitude, track.latitude)
+        self.assertEqual(remote.downloads, 1)
@@ -0,0 +1,151 @@
+"""Track analysis tests."""
+
+# run these tests like:
+#
+#    python -m unittest tests/models/test_tracks.py
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+import numpy as np
+
+from tracks import (iter_track_points, parse_gpx_time, load_track, simplify_track, encode_polyline, decode_polyline,
+    write_track_sidecar, open_track_sidecar, load_stored_track, sidecar_path, CopyingReader, gpx_stem)
+from storage import LocalStorage
+
+GPX_FILE = 'test_gpx_files/test.gpx'
+
+TWO_SEGMENT_GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="test">
+  <trk>
+    <trkseg>
+      <trkpt lat="38.0" lon="-109.0"><ele>100</ele><time>2022-01-01T00:00:00Z</time></trkpt>
+      <trkpt lat="38.1" lon="-109.1"><ele>110</ele><time>2022-01-01T00:00:10Z</time></trkpt>
+      <trkpt lat="38.2" lon="-109.2"><ele>105</ele><time>2022-01-01T00:00:20Z</time></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="38.3" lon="-109.3"><ele>120</ele><time>2022-01-01T01:00:00.500Z</time></trkpt>
+      <trkpt lat="38.4" lon="-109.4"><ele>90</ele><time>2022-01-01T01:00:30.500Z</time></trkpt>
+    </trkseg>
+  </trk>
+</gpx>"""
+
+
+class TrackAnalysisTestCase(TestCase):
+    """Test reading gpx files into track arrays"""
+
+    def test_segments(self):
+        """Are points numbered by segment?"""
+        self.assertEqual([p[0] for p in iter_track_points(io.BytesIO(TWO_SEGMENT_GPX))], [0, 0, 0, 1, 1])
+        track = load_track(io.BytesIO(TWO_SEGMENT_GPX))
+        self.assertEqual(track.segment.tolist(), [0, 0, 0, 1, 1])
+        self.assertEqual(track.time[3] - track.time[0], 3600.5)
+
+    def test_invalid_gpx(self):
+        """Are invalid files rejected?"""
+        with self.assertRaises(ValueError):
+            load_track(io.BytesIO(b"this is not xml"))
+        with self.assertRaises(ValueError):
+            load_track(io.BytesIO(b"<gpx><trk><trkseg></trkseg></trk></gpx>"))
+
+    def test_parse_gpx_time(self):
+        """Are gpx timestamps parsed with and without fractional seconds?"""
+        self.assertEqual(parse_gpx_time("2014-09-23T01:17:04Z").second, 4)
+        self.assertEqual(parse_gpx_time("2014-09-23T01:17:04.5Z").microsecond, 500000)
+        self.assertEqual(parse_gpx_time("2014-09-23T01:17:04.123456789+02:00").microsecond, 123456)
+
+    def test_track_sidecar(self):
+        """Does a track survive a round trip through the binary sidecar?"""
+        track = load_track(GPX_FILE)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_track_sidecar(os.path.join(directory, 'test.trk'), track)
+            self.assertLess(os.path.getsize(filename), os.path.getsize(GPX_FILE) / 3)
+
+            mapped = open_track_sidecar(filename)
+            np.testing.assert_array_equal(mapped.latitude, track.latitude)
+            np.testing.assert_array_equal(mapped.longitude, track.longitude)
+            np.testing.assert_array_equal(mapped.time, track.time)
+            np.testing.assert_array_equal(mapped.segment, track.segment)
+            np.testing.assert_allclose(mapped.elevation, track.elevation, atol = 1e-3)
+            # the arrays are read only views of the file
+            self.assertFalse(mapped.latitude.flags.writeable)
+
+            # truncated files are rejected
+            with open(filename, 'r+b') as f:
+                f.truncate(os.path.getsize(filename) - 4)
+            with self.assertRaises(ValueError):
+                open_track_sidecar(filename)
+
+    def test_compressed_gpx(self):
+        """Are gzipped gpx files decompressed transparently, with their sidecar named after the uncompressed file?"""
+        with tempfile.TemporaryDirectory() as directory:
+            gpx_filename = os.path.join(directory, 'test.gpx.gz')
+            with open(GPX_FILE, 'rb') as source, gzip.open(gpx_filename, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            self.assertEqual(gpx_stem(gpx_filename), os.path.join(directory, 'test'))
+            self.assertEqual(sidecar_path(gpx_filename), os.path.join(directory, 'test.trk'))
+
+            track = load_stored_track(LocalStorage(directory), 'test.gpx.gz')
+            np.testing.assert_array_equal(track.latitude, load_track(GPX_FILE).latitude)
+            self.assertTrue(os.path.exists(sidecar_path(gpx_filename)))
+
+    def test_simplify_track(self):
+        """Does simplification keep the shape of the track within the tolerance?"""
+        track = load_track(GPX_FILE)
+        keep = simplify_track(track.latitude, track.longitude, 15)
+        self.assertTrue(keep[0] and keep[-1])
+        self.assertLess(keep.sum(), len(keep) / 10)
+
+        # every dropped point should be within the tolerance of the simplified line
+        from geo import haversine_distances
+        kept = np.nonzero(keep)[0]
+        for start, end in zip(kept[:-1], kept[1:]):
+            for index in range(start + 1, end):
+                distances = haversine_distances([track.latitude[index]], [track.longitude[index]],
+                np.linspace(track.latitude[start], track.latitude[end], 200), np.linspace(track.longitude[start], track.longitude[end], 200))
+                self.assertLess(distances.min(), 15 + 1)
+
+        # a larger tolerance keeps fewer points
+        self.assertLess(simplify_track(track.latitude, track.longitude, 60).sum(), keep.sum())
+        # short tracks are kept as is
+        self.assertEqual(simplify_track([30, 31], [-96, -97], 15).tolist(), [True, True])
+
+    def test_encoded_polyline(self):
+        """Are tracks encoded with Google's polyline algorithm?"""
+        # example from Google's documentation
+        polyline = encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453])
+        self.assertEqual(polyline, "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(decode_polyline(polyline), [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]])
+        self.assertEqual(encode_polyline([], []), '')
+
+        track = load_track(GPX_FILE)
+        polyline = encode_polyline(track.latitude, track.longitude)
+        coordinates = np.array(decode_polyline(polyline))
+        np.testing.assert_allclose(coordinates, np.column_stack((track.longitude, track.latitude)), atol = 1e-5)
+
+    def test_streaming_upload(self):
+        """Are uploads stored byte for byte while being parsed, without holding the whole file in memory?"""
+        with open(GPX_FILE, 'rb') as f:
+            original = f.read()
+
+        destination = io.BytesIO()
+        track = load_track(CopyingReader(io.BytesIO(original), destination))
+        self.assertEqual(destination.getvalue(), original)
+        self.assertEqual(len(track.latitude), len(load_track(GPX_FILE).latitude))
+
+        # a large upload should need much less memory than the file itself
+        points = b''.join(b'<trkpt lat="%.6f" lon="-96.0"><ele>100.0</ele><time>2022-01-01T00:00:00Z</time></trkpt>\n' % (30 + idx * 1e-6)
+        for idx in range(50000))
+        upload = b'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>' + points + b'</trkseg></trk></gpx>'
+        source = io.BytesIO(upload)
+        tracemalloc.start()
+        with tempfile.TemporaryFile() as destination:
+            load_track(CopyingReader(source, destination))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, len(upload) / 2)
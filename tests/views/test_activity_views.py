@@ -131,6 +131,28 @@ class ActivityViewTestCase(TestCase):
             self.assertIn("Activity deleted successfully", html)
 
 
+    def test_static_map(self):
+        """Are track thumbnails served with long cache headers, only to users who can see the activity?"""
+        self.test_activity.setup_gpx_object()
+        url = self.test_activity.get_static_map()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin.id
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/png')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertTrue(resp.data.startswith(b'\x89PNG'))
+
+            resp = c.get(f'/activities/{self.test_activity.id}/static_map/not-the-thumbnail.png')
+            self.assertEqual(resp.status_code, 404)
+
+            # users that aren't following the athlete can't see the thumbnail either
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 403)
+
     def test_new_activity(self):
         """Can user add an activity?"""
 
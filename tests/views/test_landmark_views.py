@@ -170,6 +170,30 @@ class LandmarkViewTestCase(TestCase):
             # should not be able to view user landmarks
             pass
 
+    def test_nearby_landmarks(self):
+        """Are nearby landmarks sorted by distance, and limited to the ones the user can see?"""
+        url = '/API/landmarks/nearby?lat=38.7436&lon=-109.4993&radius=20000'
+        with self.client as c:
+            # logged out users only see official landmarks
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            landmarks = resp.get_json()['landmarks']
+            self.assertEqual([landmark['name'] for landmark in landmarks], ['Delicate arch'])
+            self.assertEqual(landmarks[0]['distance'], 0)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.landmark_owner.id
+            landmarks = c.get(url).get_json()['landmarks']
+            self.assertEqual([landmark['name'] for landmark in landmarks], ['Delicate arch', 'Balanced rock', 'Landscape arch', 'Double o arch'])
+            distances = [landmark['distance'] for landmark in landmarks]
+            self.assertEqual(distances, sorted(distances))
+
+            # Devil's Bridge is about 500 km away
+            resp = c.get('/API/landmarks/nearby?lat=38.7436&lon=-109.4993&radius=20000&limit=1')
+            self.assertEqual(len(resp.get_json()['landmarks']), 1)
+            self.assertEqual(c.get('/API/landmarks/nearby?lat=38.7436').status_code, 400)
+            self.assertEqual(c.get('/API/landmarks/nearby?lat=38.7436&lon=-109.4993&radius=1000000').status_code, 400)
+
 def seed_test_file():
     """Seed database with sample data."""
     users = [User(first_name='Brian', last_name='Burrows', 
@@ -7,7 +7,7 @@
 import os, io
 from unittest import TestCase
 
-from models import db, User, Admin, Activity, Challenge, Landmark, Gear, ChallengeLandmark, ActivityGear, ChallengeGear
+from models import db, User, Admin, Activity, Challenge, Landmark, Gear, ChallengeLandmark, ActivityGear, ChallengeGear, TrackBlob
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -175,6 +175,23 @@ class ActivityViewTestCase(TestCase):
             self.assertNotIn("You must be logged in to delete your account", html)
             self.assertNotIn("You can only delete your own account.", html)
 
+    def test_delete_user_tracks(self):
+        """Are the stored gpx files of a deleted user's activities removed?"""
+        with open('./test_gpx_files/test.gpx', 'rb') as f:
+            gps_data = f.read()
+        activity = Activity.add_activity(self.testuser.id, 'test activity', Challenge.query.first().id, "Biking", gps_data, "", [], [], directory = 'test_gpx_files')
+        path = activity.gps_file
+        self.assertTrue(os.path.exists(path))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post(f'/users/{self.testuser.id}/delete', follow_redirects=True)
+
+        self.assertIsNone(User.query.filter(User.email == 'testemail@email.com').first())
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(TrackBlob.query.filter(TrackBlob.path == path).first())
+
 
 
 
@@ -0,0 +1,58 @@
+"""Static PNG thumbnails of activity tracks, for cards that shouldn't load an interactive map."""
+
+import io
+import math
+
+from PIL import Image, ImageDraw
+
+THUMBNAIL_SIZE = (320, 200)
+THUMBNAIL_PADDING = 12
+BACKGROUND_COLOR = (244, 246, 245)
+TRACK_COLOR = (25, 135, 84)
+START_COLOR = (25, 135, 84)
+END_COLOR = (220, 53, 69)
+LINE_WIDTH = 3
+
+# lines are drawn at a multiple of the final size and scaled down, Pillow doesn't antialias lines itself
+SUPERSAMPLING = 3
+
+
+def project(coordinates):
+    '''Web mercator projection of [longitude, latitude] pairs, so the thumbnail has the same shape as the map'''
+    points = []
+    for longitude, latitude in coordinates:
+        latitude = max(min(latitude, 85.0), -85.0)
+        points.append((math.radians(longitude), math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))))
+    return points
+
+def fit_to_image(points, size, padding):
+    '''Scale and center projected points into an image of size (width, height) pixels, keeping the aspect ratio'''
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    width, height = size[0] - 2 * padding, size[1] - 2 * padding
+    span_x, span_y = max(xs) - min(xs), max(ys) - min(ys)
+    scale = min(width / span_x if span_x else math.inf, height / span_y if span_y else math.inf)
+    if scale == math.inf:
+        scale = 0
+    center_x, center_y = (max(xs) + min(xs)) / 2, (max(ys) + min(ys)) / 2
+    # image rows count down from the top, northings count up
+    return [(size[0] / 2 + (x - center_x) * scale, size[1] / 2 - (y - center_y) * scale) for x, y in points]
+
+def render_track_thumbnail(coordinates, size = THUMBNAIL_SIZE):
+    '''Draw a track of [longitude, latitude] pairs, with its start and end marked, and return it as png bytes'''
+    large_size = (size[0] * SUPERSAMPLING, size[1] * SUPERSAMPLING)
+    image = Image.new('RGB', large_size, BACKGROUND_COLOR)
+    if coordinates:
+        draw = ImageDraw.Draw(image)
+        points = fit_to_image(project(coordinates), large_size, THUMBNAIL_PADDING * SUPERSAMPLING)
+        width = LINE_WIDTH * SUPERSAMPLING
+        if len(points) > 1:
+            draw.line(points, fill = TRACK_COLOR, width = width, joint = 'curve')
+        radius = width * 1.5
+        for (x, y), color in [(points[0], START_COLOR), (points[-1], END_COLOR)]:
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill = color, outline = (255, 255, 255), width = SUPERSAMPLING)
+
+    image = image.resize(size, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format = 'PNG', optimize = True)
+    return output.getvalue()
@@ -0,0 +1,277 @@
+"""Reading and analyzing .gpx tracks."""
+
+from array import array
+from collections import namedtuple
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import os
+import tempfile
+from xml.etree.ElementTree import iterparse, ParseError
+
+import numpy as np
+
+from geo import EARTH_RADIUS_METERS
+
+# a track stored as numpy arrays, missing elevations and times are nan
+Track = namedtuple('Track', ['latitude', 'longitude', 'elevation', 'time', 'segment'])
+
+# decimal places kept by encoded polylines, 5 places is about a meter
+POLYLINE_PRECISION = 5
+
+# stored gpx files are gzipped and named <hash>.gpx.gz, files without the suffix (stored before compression) are read as is
+COMPRESSED_SUFFIX = '.gz'
+GZIP_LEVEL = 6
+
+# Binary track sidecar: a 32 byte header followed by one fixed width little endian column per field.
+# Wider columns come first so that every column stays aligned inside the memory map.
+SIDECAR_MAGIC = b'SOKATRAK'
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('reserved', '<u4'), ('count', '<u8'), ('padding', '<u8')])
+SIDECAR_COLUMNS = [('latitude', '<f8'), ('longitude', '<f8'), ('time', '<f8'), ('elevation', '<f4'), ('segment', '<i4')]
+
+
+def local_name(tag):
+    '''Strip the xml namespace from a tag, e.g. {http://www.topografix.com/GPX/1/1}trkpt -> trkpt'''
+    return tag.rsplit('}', 1)[-1]
+
+def parse_gpx_time(text):
+    '''Convert a gpx timestamp (e.g. 2014-09-23T01:17:04Z) into a timezone aware datetime'''
+    text = text.strip().replace('Z', '+00:00')
+    if '.' in text:
+        # fromisoformat only accepts 3 or 6 digits of fractional seconds
+        whole, rest = text.split('.', 1)
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        text = f"{whole}.{rest[:digits][:6].ljust(6, '0')}{rest[digits:]}"
+    time = datetime.fromisoformat(text)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo = timezone.utc)
+    return time
+
+class CopyingReader():
+    '''A file-like object that writes everything read from a stream into a destination file, so a file can be parsed and stored in one pass'''
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+    def read(self, size = -1):
+        data = self.source.read(size)
+        self.destination.write(data)
+        return data
+
+class HashingWriter():
+    '''A file-like object that writes to a destination file while computing the sha256 and size of everything written'''
+    def __init__(self, destination):
+        self.destination = destination
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.destination.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+def iter_track_points(source):
+    '''Yield (segment_number, latitude, longitude, elevation, time) for every track point, without building the whole document in memory'''
+    segment_number = -1
+    segment = None
+    try:
+        for event, elem in iterparse(source, events = ('start', 'end')):
+            name = local_name(elem.tag)
+            if event == 'start':
+                if name == 'trkseg':
+                    segment_number += 1
+                    segment = elem
+                continue
+
+            if name != 'trkpt':
+                continue
+
+            elevation = None
+            time = None
+            for child in elem:
+                child_name = local_name(child.tag)
+                if child_name == 'ele' and child.text:
+                    elevation = float(child.text)
+                elif child_name == 'time' and child.text:
+                    time = parse_gpx_time(child.text)
+
+            yield segment_number, float(elem.get('lat')), float(elem.get('lon')), elevation, time
+
+            # points that have been read are no longer needed
+            if segment is not None:
+                segment.clear()
+    except (ParseError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid .gpx file: {e}")
+
+
+def open_gpx(filename):
+    '''Open a stored gpx file for reading, gzipped files (see COMPRESSED_SUFFIX) are decompressed as they are read'''
+    if filename.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def gpx_stem(gpx_filename):
+    '''A gpx filename without its extensions, derived files are named after it, e.g. gpx_files/1.gpx.gz -> gpx_files/1'''
+    if gpx_filename.endswith(COMPRESSED_SUFFIX):
+        gpx_filename = gpx_filename[:-len(COMPRESSED_SUFFIX)]
+    return os.path.splitext(gpx_filename)[0]
+
+def load_track(source):
+    '''Read a gpx file (filename or file object) into numpy arrays, times are seconds since the epoch'''
+    if isinstance(source, str):
+        with open_gpx(source) as f:
+            return load_track(f)
+    columns = [array('d'), array('d'), array('d'), array('d'), array('i')]
+    latitudes, longitudes, elevations, times, segments = columns
+    nan = float('nan')
+    for segment_number, latitude, longitude, elevation, time in iter_track_points(source):
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        elevations.append(nan if elevation is None else elevation)
+        times.append(nan if time is None else time.timestamp())
+        segments.append(segment_number)
+    if not latitudes:
+        raise ValueError("Invalid .gpx file: no track points found")
+    return Track(*(np.frombuffer(column, dtype = column.typecode) for column in columns))
+
+def simplify_track(latitudes, longitudes, tolerance):
+    '''Douglas-Peucker simplification, returns a mask of the points to keep so that no dropped point is more than tolerance meters from the simplified line'''
+    latitudes = np.asarray(latitudes, dtype = np.float64)
+    longitudes = np.asarray(longitudes, dtype = np.float64)
+    count = len(latitudes)
+    keep = np.zeros(count, dtype = bool)
+    if count <= 2:
+        keep[:] = True
+        return keep
+
+    # project onto a flat plane in meters, accurate enough over the extent of a single activity
+    center = np.radians(latitudes.mean())
+    x = np.radians(longitudes) * np.cos(center) * EARTH_RADIUS_METERS
+    y = np.radians(latitudes) * EARTH_RADIUS_METERS
+
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length_squared = dx * dx + dy * dy
+        if length_squared == 0:
+            distances = np.hypot(px, py)
+        else:
+            # distance to the closest point on the segment between start and end
+            t = np.clip((px * dx + py * dy) / length_squared, 0, 1)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+def encode_polyline(latitudes, longitudes, precision = POLYLINE_PRECISION):
+    '''Encode a track with Google's encoded polyline algorithm (delta encoded, zigzag, 5 bit varint characters)'''
+    factor = 10 ** precision
+    points = np.column_stack((np.round(np.asarray(latitudes, dtype = np.float64) * factor),
+    np.round(np.asarray(longitudes, dtype = np.float64) * factor))).astype(np.int64)
+    if not len(points):
+        return ''
+    deltas = np.diff(points, axis = 0, prepend = np.zeros((1, 2), dtype = np.int64)).ravel()
+    values = (deltas << 1) ^ (deltas >> 63)
+
+    # split each value into 5 bit chunks, least significant first, setting 0x20 on every chunk but the last
+    shifts = np.arange(0, 35, 5)
+    chunks = (values[:, None] >> shifts) & 0x1f
+    counts = 1 + ((values[:, None] >> shifts[1:]) > 0).sum(axis = 1)
+    positions = np.arange(len(shifts))[None, :]
+    characters = (chunks | np.where(positions < (counts - 1)[:, None], 0x20, 0)) + 63
+    return characters[positions < counts[:, None]].astype(np.uint8).tobytes().decode('ascii')
+
+def decode_polyline(polyline, precision = POLYLINE_PRECISION):
+    '''Decode an encoded polyline into a list of [longitude, latitude] pairs'''
+    coordinates = []
+    values = []
+    value = shift = 0
+    for character in polyline:
+        chunk = ord(character) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if not chunk & 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+
+    factor = 10 ** precision
+    latitude = longitude = 0
+    for delta_latitude, delta_longitude in zip(values[::2], values[1::2]):
+        latitude += delta_latitude
+        longitude += delta_longitude
+        coordinates.append([longitude / factor, latitude / factor])
+    return coordinates
+
+def sidecar_path(gpx_filename):
+    '''The location of the binary sidecar for a gpx file, e.g. gpx_files/1.gpx -> gpx_files/1.trk'''
+    return gpx_stem(gpx_filename) + '.trk'
+
+def write_track_sidecar(filename, track):
+    '''Write a track to the binary sidecar format, so later reads can memory map it instead of parsing xml'''
+    header = np.zeros(1, dtype = SIDECAR_HEADER)
+    header['magic'] = SIDECAR_MAGIC
+    header['version'] = SIDECAR_VERSION
+    header['count'] = len(track.latitude)
+
+    # write to a temporary file first, so readers never map a partially written sidecar
+    temporary_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, 'wb') as f:
+        f.write(header.tobytes())
+        for name, dtype in SIDECAR_COLUMNS:
+            f.write(np.ascontiguousarray(getattr(track, name), dtype = dtype).tobytes())
+    os.replace(temporary_filename, filename)
+    return filename
+
+def open_track_sidecar(filename):
+    '''Memory map a binary sidecar, the returned arrays are read only views of the file (no parsing or copying)'''
+    data = np.memmap(filename, dtype = np.uint8, mode = 'r')
+    header = data[:SIDECAR_HEADER.itemsize].view(SIDECAR_HEADER)[0]
+    if header['magic'] != SIDECAR_MAGIC or header['version'] != SIDECAR_VERSION:
+        raise ValueError(f"{filename} is not a track sidecar")
+
+    count = int(header['count'])
+    offset = SIDECAR_HEADER.itemsize
+    columns = dict()
+    for name, dtype in SIDECAR_COLUMNS:
+        size = count * np.dtype(dtype).itemsize
+        columns[name] = data[offset:offset + size].view(dtype)
+        offset += size
+    if offset != len(data):
+        raise ValueError(f"{filename} is truncated or corrupt")
+    return Track(**columns)
+
+def store_track_sidecar(storage, key, track):
+    '''Write a track's sidecar and put it in a storage (see storage.py)'''
+    handle, temporary = tempfile.mkstemp(suffix = '.trk')
+    os.close(handle)
+    try:
+        storage.put_file(key, write_track_sidecar(temporary, track))
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def load_stored_track(storage, gpx_key):
+    '''Load a track kept in a storage (see storage.py) from its sidecar, creating and storing the sidecar the first time'''
+    key = sidecar_path(gpx_key)
+    if storage.exists(key):
+        return open_track_sidecar(storage.get_local_path(key))
+    track = load_track(storage.get_local_path(gpx_key))
+    try:
+        store_track_sidecar(storage, key, track)
+    except OSError:
+        # the track is still usable if the storage is read only
+        pass
+    return track